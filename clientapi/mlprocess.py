@@ -1,6 +1,6 @@
 """Interact with mldata.org without clicking on the website"""
 
-from numpy import zeros
+from numpy import zeros, append, arange, ndim
 import h5py
 from ml2h5.converter.basehandler import BaseHandler
 from mleval.output import init_output
@@ -44,11 +44,11 @@ def parse_task(task_filename):
 
     return task_type, fidx, lidx, train_idx, test_idx
 
-def parse_data(data_filename):
-    """Manually parse the data file"""
+def parse_data(data_filename, fidx, lidx, idx):
+    """Read only the input and output variables of examples idx
+    from the data file"""
     df = BaseHandler(data_filename)
-    all_data = df.read_data_as_array()
-    return all_data
+    return df.read_subset(append(fidx, lidx), idx)
 
 def _split_data(cur_data, fidx, lidx):
     """Split data into examples and labels"""
@@ -61,13 +61,20 @@ def _split_data(cur_data, fidx, lidx):
 
     return ex, lab
 
-def split_data(all_data, fidx, lidx, train_idx, test_idx):
-    """Split array all_data into training and testing sets,
+def split_data(data_filename, fidx, lidx, train_idx, test_idx):
+    """Read training and testing sets from the data file,
     as well as examples and labels"""
-    train_data = all_data[train_idx]
-    train_ex, train_lab = _split_data(train_data, fidx, lidx)
-    test_data = all_data[test_idx]
-    test_ex, test_lab = _split_data(test_data, fidx, lidx)
+    num_feats = len(append([], fidx))
+    pos_fidx = arange(num_feats)
+    if ndim(lidx) == 0:
+        pos_lidx = num_feats
+    else:
+        pos_lidx = arange(num_feats, num_feats + len(lidx))
+
+    train_data = parse_data(data_filename, fidx, lidx, train_idx)
+    train_ex, train_lab = _split_data(train_data, pos_fidx, pos_lidx)
+    test_data = parse_data(data_filename, fidx, lidx, test_idx)
+    test_ex, test_lab = _split_data(test_data, pos_fidx, pos_lidx)
 
     return train_ex, train_lab, test_ex, test_lab
 
@@ -75,8 +82,7 @@ def mlprocess(task_filename, data_filename, pred_filename, verbose=True):
     """Demo of creating machine learning process."""
     task_type, fidx, lidx, train_idx, test_idx = parse_task(task_filename)
     outputs = init_output(task_type)
-    all_data = parse_data(data_filename)
-    train_ex, train_lab, test_ex, test_lab = split_data(all_data, fidx, lidx, train_idx, test_idx)
+    train_ex, train_lab, test_ex, test_lab = split_data(data_filename, fidx, lidx, train_idx, test_idx)
     label_train = outputs.str2label(train_lab)
 
     if verbose:
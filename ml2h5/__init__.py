@@ -3,7 +3,14 @@ Utility functions around HDF5, mostly for mldata.org.
 """
 
 __all__ = ['task', 'data', 'fileformat', 'converter']
-VERSION_MLDATA = '0'
+# version of the HDF5 layout, stored in attribute 'mldata' of the file root.
+# Since version 1, string variables under /data are stored as integer codes
+# (uint8 or uint16) into the fixed-width strings of dataset <name>_categories,
+# or as fixed-width strings (S<n>) of UTF-8 if no longer than
+# converter.FIXED_STRING_MAX bytes; in version 0 all were variable-length
+# strings. Sparse variables have <name>_indices and <name>_indptr next to
+# their values in both versions.
+VERSION_MLDATA = '1'
 NUM_EXTRACT = 10
 # maximum value length 
 LEN_EXTRACT = 6
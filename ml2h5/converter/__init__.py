@@ -4,39 +4,77 @@ Convert from and to HDF5 (spec of mldata.org)
 
 ALLOWED_SEPERATORS = (None, ',', ' ', '\t')
 
-TO_H5 = ['libsvm', 'arff', 'csv', 'matlab', 'octave']
+TO_H5 = ['libsvm', 'arff', 'csv', 'matlab', 'octave', 'rdata']
 FROM_H5 = ['libsvm','arff', 'csv', 'matlab', 'octave', 'xml', 'rdata']
 EPSILON = 1e-15
 
 #1 MB is maximum line len for autodetection
 AUTODETECTION_MAXBUFLEN=1*1024*1024
 
-import os, sys, numpy, h5py
+#1 GB is maximum size of sparse data converted to dense
+MEMORY_BUDGET=1*1024*1024*1024
+
+# presets of HDF5 filters to compress written datasets with
+COMPRESSION_PRESETS = {
+    'gzip': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+    'gzip9': {'compression': 'gzip', 'compression_opts': 9, 'shuffle': True},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+}
+
+#256 KB is the size chunks of HDF5 datasets are aimed at
+CHUNK_BYTES=256*1024
+
+#64 MB is the maximum size of data written to HDF5 at once
+WRITE_BLOCK_BYTES=64*1024*1024
+
+#string data with at most this many distinct values (and at most half as many
+#as values) is stored as integer codes into categories
+CATEGORIES_MAX=65536
+
+#64 bytes is maximum length of other strings to be stored with fixed width
+FIXED_STRING_MAX=64
+
+import os, sys, time, numpy, h5py
+import importlib
 import subprocess
 from gettext import gettext as _
 from scipy.sparse import csc_matrix
 
 import ml2h5.fileformat
-from ml2h5.converter.h5_arff import H5_ARFF
-from ml2h5.converter.h5_libsvm import H5_LibSVM
-from ml2h5.converter.h5_csv import H5_CSV
-from ml2h5.converter.h5_mat import H5_MAT
-from ml2h5.converter.h5_octave import H5_OCTAVE
-from ml2h5.converter.h5_rdata import H5_RData
-#from ml2h5.converter.h5_uci import H5_UCI
-from ml2h5.converter.basehandler import BaseHandler
+from ml2h5.converter.basehandler import BaseHandler, DatasetProxy, SparseProxy
 
+# handler classes by format, given by name to import their modules only when
+# the format is used, see get_handler()
 HANDLERS = {
-    'libsvm': H5_LibSVM,
-    'arff': H5_ARFF,
-    'csv': H5_CSV,
-    'matlab': H5_MAT,
-    'octave' : H5_OCTAVE,
-    'rdata': H5_RData,
-    #'uci' : H5_UCI,
+    'libsvm': 'ml2h5.converter.h5_libsvm.H5_LibSVM',
+    'arff': 'ml2h5.converter.h5_arff.H5_ARFF',
+    'csv': 'ml2h5.converter.h5_csv.H5_CSV',
+    'matlab': 'ml2h5.converter.h5_mat.H5_MAT',
+    'octave' : 'ml2h5.converter.h5_octave.H5_OCTAVE',
+    'rdata': 'ml2h5.converter.h5_rdata.H5_RData',
+    #'uci' : 'ml2h5.converter.h5_uci.H5_UCI',
     'h5': BaseHandler
 }
 
+
+def get_handler(format):
+    """Get handler class of given format.
+
+    The module of the handler is imported on first use.
+
+    @param format: format to get handler for
+    @type format: string
+    @return: handler class
+    @rtype: derivate of BaseHandler
+    @raises: KeyError if format is unknown
+    """
+    handler = HANDLERS[format]
+    if isinstance(handler, str):
+        module, name = handler.rsplit('.', 1)
+        handler = getattr(importlib.import_module(module), name)
+        HANDLERS[format] = handler
+    return handler
+
 class ConversionError(Exception):
     def __init__(self, value):
         self.value = value
@@ -77,7 +115,10 @@ class Converter(object):
             seperator=None,
             attribute_names_first=False,
             merge=True,
-            type='data'):
+            type='data',
+            stream=False,
+            processes=None,
+            compression=None):
         """
         @param fname_in: name of in-file
         @type fname_in: string
@@ -91,10 +132,18 @@ class Converter(object):
         @type seperator: string
         @param attribute_names_first: first line contains attributes (for CSV only)
         @type attribute_names_first: boolean
+        @param stream: convert block by block straight to HDF5 if in-handler supports it
+        @type stream: boolean
+        @param processes: number of processes to read with if in-handler supports it
+        @type processes: integer
+        @param compression: preset of COMPRESSION_PRESETS or HDF5 filter to write HDF5 with
+        @type compression: string
         """
         self.fname_in = fname_in
         self.fname_out = fname_out
         self.type = type
+        self.stream = stream
+        self.seconds = None
         if format_in:
             self.format_in = format_in
         else:
@@ -110,11 +159,15 @@ class Converter(object):
             return
 
         try:
-            self.handler_in = HANDLERS[self.format_in](fname_in, seperator,merge=merge)
+            self.handler_in = get_handler(self.format_in)(fname_in, seperator,
+                compression=compression, merge=merge)
 
             if self.format_in == 'csv':
                 self.handler_in.attribute_names_first = attribute_names_first
-            self.handler_out = HANDLERS[self.format_out](fname_out, seperator,merge=merge)
+            if hasattr(self.handler_in, 'processes'):
+                self.handler_in.processes = processes
+            self.handler_out = get_handler(self.format_out)(fname_out, seperator,
+                compression=compression, merge=merge)
             if self.format_out == 'csv':
                 self.handler_out.attribute_names_first = attribute_names_first
         except KeyError:
@@ -142,16 +195,42 @@ class Converter(object):
         if remove_out and os.path.exists(self.fname_out):
             os.remove(self.fname_out)
 
+        start = time.time()
         try:
             if self.format_in == 'h5' and self.format_out == 'xml':
                 cmd = 'h5dump --xml ' + self.fname_in + ' > ' + self.fname_out
                 if not subprocess.call(cmd, shell=True) == 0:
                     raise ConversionError('Failed conversion of %s to XML' % (self.fname_in))
+            elif self.stream and self.format_out == 'h5' and \
+                    hasattr(self.handler_in, 'stream_to_h5'):
+                self.handler_in.stream_to_h5(self.fname_out)
+            elif self.format_in == 'h5' and self.format_out in ('h5', 'matlab', 'rdata'):
+                # copy block by block, e.g. to change compression or to
+                # MATLAB 7.3
+                data = self.handler_in.read(lazy=True)
+                try:
+                    self.handler_out.write(data)
+                finally:
+                    self.handler_in.close()
             else:
                 data = self.handler_in.read()
                 self.handler_out.write(data)
         except Exception as e: # reformat all exceptions to ConversionError
             raise ConversionError(ConversionError(str(e))).with_traceback(sys.exc_info()[2])
+        self.seconds = time.time() - start
+
+
+    def report(self):
+        """Report compression ratio and throughput of the last run to HDF5.
+
+        @return: report
+        @rtype: string
+        """
+        raw, stored = BaseHandler(self.fname_out).get_storage_size()
+        ratio = float(raw) / max(1, stored)
+        throughput = raw / (1024. * 1024.) / max(self.seconds, EPSILON)
+        return 'Stored %d bytes of data in %d bytes (ratio %.2f) at %.1f MB/s' % \
+            (raw, stored, ratio, throughput)
 
 
     def _compare(self, A, B):
@@ -201,6 +280,21 @@ class Converter(object):
         return True
 
 
+    def _read_for_verify(self, format, handler):
+        """Read data to verify, lazily if handler is for HDF5.
+
+        @param format: format of file to read
+        @type format: string
+        @param handler: handler to read with
+        @type handler: derivate of BaseHandler
+        @return: data structure as returned by read()
+        @rtype: dict
+        """
+        if format == 'h5':
+            return handler.read(lazy=True)
+        return handler.read()
+
+
     def verify(self):
         """Verify that data in given files is the same.
 
@@ -212,13 +306,35 @@ class Converter(object):
             raise ConversionError('Cannot verify UCI data format, %s!' % self.fname_in)
         if self.format_out == 'uci':
             raise ConversionError('Cannot verify UCI data format, %s!' % self.fname_out)
-        data_in = self.handler_in.read()
-        data_out = self.handler_out.read()
+        try:
+            return self._verify()
+        finally:
+            self.handler_in.close()
+            self.handler_out.close()
+
+
+    def _verify(self):
+        """Verify that data in given files is the same, keeping HDF5 files
+        open that are read lazily.
+
+        @return: true if verification succeeds
+        @rtype: boolean
+        @raises: ConversionError
+        """
+        data_in = self._read_for_verify(self.format_in, self.handler_in)
+        data_out = self._read_for_verify(self.format_out, self.handler_out)
         
         for i in range(len(data_in['ordering'])):
             name_in = data_in['ordering'][i]
             name_out = data_out['ordering'][i]
-            if not self._compare(data_in['data'][name_in], data_out['data'][name_out]):
+            # HDF5 is read lazily, so only one variable is in memory at a time
+            A = data_in['data'][name_in]
+            B = data_out['data'][name_out]
+            if isinstance(A, (DatasetProxy, SparseProxy)):
+                A = A.load()
+            if isinstance(B, (DatasetProxy, SparseProxy)):
+                B = B.load()
+            if not self._compare(A, B):
                 raise ConversionError(
                     'Verification failed! Data of %s != %s ("%s" not matching "%s")' % (self.fname_in, self.fname_out, name_in, name_out)
             )
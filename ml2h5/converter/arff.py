@@ -32,6 +32,12 @@
 
 import re, sys, numpy
 
+_ATTRIBUTE_RE = re.compile(r'[a-zA-Z_][a-zA-Z0-9_/+-.*\(\)]*|\{[^\}]+\}|\'[^\']+\'|\"[^\"]+\"')
+
+_NUMERIC_RE = re.compile(r'[+-]?[0-9]*(?:\.[0-9]*(?:[eE]-?[0-9]+)?)?')
+
+# size of the buffer data is written to files through
+WRITE_BUFFER_SIZE = 1024*1024
 
 class ArffFile(object):
     """An ARFF File object describes a data set consisting of a number
@@ -45,7 +51,8 @@ class ArffFile(object):
     Not all features of ARFF files are supported yet. The most notable
     exceptions are:
 
-        - no sparse data
+        - sparse data only through load_header/iter_data and
+          write_data/save, as dicts of attribute index to value
         - no support for date and relational attributes
 
     Also, parsing of strings might still be a bit brittle.
@@ -103,11 +110,85 @@ class ArffFile(object):
             # a few attributes are designated strings by "'"
             if item[0] == "'" and item[-1] == "'":
                 return item[1:-1]
-        except TypeError:
+        except (TypeError, IndexError):
             pass
 
         return item
 
+    @staticmethod
+    def load_header(fp):
+        """Load the header of an ARFF File from an open file.
+
+        Reading stops after the @data line, so the data can be read
+        incrementally by iter_data."""
+        a = ArffFile()
+        a.state = 'comment'
+        a.lineno = 1
+        for l in fp:
+            a.__parseline(l.rstrip('\r\n'))
+            a.lineno += 1
+            if a.state == 'data':
+                break
+        if a.state == 'comment': # no header at all
+            a.comment = '\n'.join(a.comment)
+        return a
+
+    def iter_data(self, fp):
+        """Iterate over the data points of an open file, as lists of
+        strings, or for sparse data points {index value, ...} as dicts of
+        attribute index to string. fp has to be positioned behind the
+        header, e.g. by load_header. Data points parse would skip are
+        skipped, as are sparse ones with indices out of range."""
+        num = len(self.attributes)
+        nominal = [(i, set(self.attribute_data[n]))
+                   for i, n in enumerate(self.attributes)
+                   if self.attribute_types[n] == 'nominal']
+        for l in fp:
+            self.lineno += 1
+            l = l.rstrip('\r\n')
+            if len(l) == 0 or l[0] == '%':
+                continue
+            if l.lstrip()[:1] == '{':
+                l = self._split_sparse(l)
+                if [i for i in l if not 0 <= i < num]:
+                    self.__print_warning("contains index out of range")
+                    continue
+                checks = [(i, values) for i, values in nominal if i in l]
+            else:
+                l = self._split_data(l)
+                if len(l) != num:
+                    self.__print_warning("contains wrong number of values")
+                    continue
+                checks = nominal
+            for i, values in checks:
+                if l[i] not in values and l[i] != '?':
+                    self.__print_warning('incorrect value %s for nomial attribute %s' % (l[i], self.attributes[i]))
+                    break
+            else:
+                yield l
+
+    def _split_data(self, line):
+        """Split a data line into values."""
+        l = [s.strip() for s in line.split(',')]
+        if len(l) == 1:
+            l = [s.strip() for s in line.split()]
+        if l and not l[-1]: # remove trailing empty item
+            l.pop()
+        return l
+
+    def _split_sparse(self, line):
+        """Split a sparse data line into a dict of index to value."""
+        l = {}
+        for item in line.strip()[1:-1].split(','):
+            item = item.strip()
+            if item:
+                iv = item.split(None, 1)
+                if len(iv) != 2:
+                    raise ValueError('line %d: sparse value %s without index or value'
+                                     % (self.lineno, item))
+                l[int(iv[0])] = iv[1].strip()
+        return l
+
     @staticmethod
     def parse(s):
         """Parse an ARFF File already loaded into a string."""
@@ -119,14 +200,31 @@ class ArffFile(object):
             a.lineno += 1
         return a
 
-    def save(self, filename):
-        """Save an arff structure to a file."""
-        o = open(filename, 'w')
-        o.write(self.write())
+    def save(self, filename, blocks=None, columns=False):
+        """Save an arff structure to a file.
+
+        If given, the data points are taken block by block from blocks
+        instead of from self.data. If columns is True, each block is a
+        list of one sequence of values per attribute, formatted by
+        write_columns."""
+        if blocks is None:
+            blocks = [self.data]
+        if columns:
+            write_block = self.write_columns
+        else:
+            write_block = self.write_data
+        o = open(filename, 'w', buffering=WRITE_BUFFER_SIZE)
+        o.write(self.write_header())
+        for block in blocks:
+            o.write(write_block(block))
         o.close()
 
     def write(self):
         """Write an arff structure to a string."""
+        return self.write_header() + self.write_data(self.data)
+
+    def write_header(self):
+        """Write the header of an arff structure to a string."""
         o = []
         o.append('% ' + re.sub("\n", "\n% ", self.comment))
         o.append("@relation " + self.esc(self.relation))
@@ -145,26 +243,70 @@ class ArffFile(object):
             else:
                 raise Exception("Type " + at + " not supported for writing!")
         o.append("\n@data")
-        for d in self.data:
-            line = []
-            for e, a in zip(d, self.attributes):
-                at = self.attribute_types[a]
-                if at == 'numeric':
-                    if type(e) in [numpy.int32,numpy.int64]:
-                        line.append(str(int(e)))
-                    else:        
-                        line.append(str(float(e)))
-                elif at == 'string':
-                    line.append(self.esc(e))
-                elif at == 'date':
-                    line.append(self.esc(e))
-                elif at == 'nominal':
-                    line.append(e)
-                else:
-                    raise Exception("Type " + at + " not supported for writing!")
-            o.append(','.join(map(str, line)))
         return "\n".join(o) + "\n"
 
+    def write_data(self, data):
+        """Write data points to a string. Sparse data points are given as
+        dicts of attribute index to value."""
+        o = []
+        for d in data:
+            if isinstance(d, dict):
+                line = ['%d %s' % (i, self._format_value(e, self.attributes[i]))
+                        for i, e in d.items()]
+                o.append('{' + ','.join(line) + "}\n")
+            else:
+                line = [self._format_value(e, a)
+                        for e, a in zip(d, self.attributes)]
+                o.append(','.join(line) + "\n")
+        return "".join(o)
+
+    def write_columns(self, columns):
+        """Write data points given as one sequence of values per attribute
+        to a string. Each column is formatted at once like
+        _format_value would format its values."""
+        if not columns or not len(columns[0]):
+            return ''
+        formatted = [self._format_column(c, a).tolist()
+                     for c, a in zip(columns, self.attributes)]
+        return "\n".join(map(','.join, zip(*formatted))) + "\n"
+
+    def _format_column(self, c, a):
+        """Format all values c of attribute a."""
+        at = self.attribute_types[a]
+        if at == 'numeric':
+            if isinstance(c, numpy.ndarray) and c.dtype in [numpy.int32, numpy.int64]:
+                return c.astype(str)
+            else:
+                return numpy.asarray(c, dtype=numpy.double).astype(str)
+        elif at == 'string' or at == 'date':
+            c = numpy.asarray(c).astype(str)
+            quote = numpy.char.isspace(c.astype('U1')) | (c == '')
+            if quote.any():
+                c = c.astype(object)
+                c[quote] = ["'" + s + "'" for s in c[quote]]
+            return c
+        elif at == 'nominal':
+            return numpy.asarray(c).astype(str)
+        else:
+            raise Exception("Type " + at + " not supported for writing!")
+
+    def _format_value(self, e, a):
+        """Format value e of attribute a."""
+        at = self.attribute_types[a]
+        if at == 'numeric':
+            if type(e) in [numpy.int32,numpy.int64]:
+                return str(int(e))
+            else:        
+                return str(float(e))
+        elif at == 'string' or at == 'date':
+            if e == '': # would be no value at all, e.g. in sparse data
+                return "''"
+            return self.esc(e)
+        elif at == 'nominal':
+            return str(e)
+        else:
+            raise Exception("Type " + at + " not supported for writing!")
+
     def esc(self, s):
         "Escape a string if it contains spaces"
         try:
@@ -208,8 +350,7 @@ class ArffFile(object):
         self.relation = l[1]
 
     def __parse_attribute(self, l):
-        p = re.compile(r'[a-zA-Z_][a-zA-Z0-9_/+-.*\(\)]*|\{[^\}]+\}|\'[^\']+\'|\"[^\"]+\"')
-        l = [s.strip() for s in p.findall(l)]
+        l = [s.strip() for s in _ATTRIBUTE_RE.findall(l)]
         name = l[1]
         atype = l[2]
         atypel = atype.lower()
@@ -228,11 +369,7 @@ class ArffFile(object):
             self.__print_warning("unsupported type " + atype + " for attribute " + name + ".")
 
     def __parse_data(self, line):
-        l = [s.strip() for s in line.split(',')]
-        if len(l) == 1:
-            l = [s.strip() for s in line.split()]
-        if not l[-1].strip(): # remove trailing empty item
-            l.pop()
+        l = self._split_data(line)
         if len(l) != len(self.attributes):
             self.__print_warning("contains wrong number of values")
             return
@@ -243,7 +380,7 @@ class ArffFile(object):
             if at == 'numeric':
                 if v == '?' or v == '':
                     datum.append(numpy.nan)
-                elif re.match(r'[+-]?[0-9]*(?:\.[0-9]*(?:[eE]-?[0-9]+)?)?', v):
+                elif _NUMERIC_RE.match(v):
                     try:    
                         datum.append(int(v))
                     except ValueError:
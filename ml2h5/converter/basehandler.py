@@ -1,9 +1,217 @@
 import os, h5py, numpy
 from scipy.sparse import csc_matrix
+import scipy.sparse
 
 import ml2h5.task
+import ml2h5.converter
 from ml2h5 import VERSION_MLDATA
-from ml2h5.converter import ALLOWED_SEPERATORS
+from ml2h5.converter import ALLOWED_SEPERATORS, COMPRESSION_PRESETS, \
+    CHUNK_BYTES, WRITE_BLOCK_BYTES, CATEGORIES_MAX, FIXED_STRING_MAX
+
+
+# number of values read at once when scanning a dataset
+SCAN_SIZE = 1024*1024
+
+# number of examples per block when iterating over rows
+ROW_BLOCK_SIZE = 10000
+
+
+def _decode(d):
+    """Get strings out of compound vlen datasets, leave other data as is.
+
+    @param d: data read from HDF5
+    @type d: numpy.ndarray
+    @return: decoded data
+    @rtype: numpy.ndarray
+    """
+    try:
+        return d['vlen']
+    except (KeyError, ValueError, IndexError, TypeError):
+        return d
+
+
+class DatasetProxy(object):
+    """Lazy stand-in for a dense dataset of an opened HDF5 file.
+
+    Only the slices indexed are read from file; load() reads everything,
+    as BaseHandler.read does in eager mode. String data stored as codes
+    into categories or with fixed width is decoded to str. Codes may also
+    be given in memory, as for nominal attributes read from ARFF.
+
+    @ivar dset: dataset to read from
+    @type dset: h5py.Dataset or numpy.ndarray
+    @ivar categories: categories the dataset holds codes of, or None
+    @type categories: numpy.ndarray
+    @ivar shape: shape of dataset
+    @type shape: tuple
+    @ivar dtype: data type of dataset (vlen str for all string data)
+    @type dtype: numpy.dtype
+    """
+
+    def __init__(self, dset, categories=None):
+        """
+        @param dset: dataset to read from
+        @type dset: h5py.Dataset
+        @param categories: categories the dataset holds codes of
+        @type categories: numpy.ndarray
+        """
+        self.dset = dset
+        self.categories = categories
+        self.shape = dset.shape
+        if categories is not None or dset.dtype.kind == 'S':
+            self.dtype = h5py.special_dtype(vlen=str)
+        else:
+            self.dtype = dset.dtype
+
+    def _decode(self, d):
+        """Decode data read from the dataset.
+
+        @param d: data read from dataset
+        @type d: numpy.ndarray or scalar
+        @return: decoded data
+        @rtype: numpy.ndarray or scalar
+        """
+        if self.categories is not None:
+            return self.categories[d]
+        elif self.dset.dtype.kind != 'S':
+            return _decode(d)
+        elif isinstance(d, bytes):
+            return d.decode('utf-8')
+        decoded = numpy.empty(d.shape, dtype=self.dtype)
+        decoded.flat[:] = [v.decode('utf-8') for v in d.ravel().tolist()]
+        return decoded
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._decode(self.dset[key])
+
+    def __array__(self, dtype=None):
+        d = self.load()
+        if dtype is not None:
+            d = d.astype(dtype)
+        return d
+
+    def load(self):
+        """Read the whole dataset.
+
+        @return: all data in Fortran order
+        @rtype: numpy.ndarray
+        """
+        return self._decode(numpy.array(self.dset, order='F'))
+
+
+class SparseProxy(object):
+    """Lazy stand-in for a CSC matrix stored as data/_indices/_indptr.
+
+    Indexing examples (columns) only reads their part of data and indices
+    as given by indptr.
+
+    @ivar data: dataset of non-zero values
+    @type data: h5py.Dataset
+    @ivar indices: dataset of row indices
+    @type indices: h5py.Dataset
+    @ivar indptr: dataset of column pointers
+    @type indptr: h5py.Dataset
+    """
+
+    def __init__(self, data, indices, indptr):
+        """
+        @param data: dataset of non-zero values
+        @type data: h5py.Dataset
+        @param indices: dataset of row indices
+        @type indices: h5py.Dataset
+        @param indptr: dataset of column pointers
+        @type indptr: h5py.Dataset
+        """
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.dtype = data.dtype
+        self.nnz = data.shape[0]
+        self._shape = None
+
+    @property
+    def shape(self):
+        """Shape as inferred by csc_matrix, found by scanning the indices."""
+        if self._shape is None:
+            rows = 0
+            for start in range(0, self.nnz, SCAN_SIZE):
+                rows = max(rows, self.indices[start:start+SCAN_SIZE].max() + 1)
+            self._shape = (int(rows), self.indptr.shape[0] - 1)
+        return self._shape
+
+    def get_columns(self, start, stop, num_rows=None):
+        """Read examples (columns) start to stop.
+
+        Unless the shape is known already, giving the number of rows needed
+        avoids scanning all indices for it; the matrix then has as many
+        rows as needed or as its indices require.
+
+        @param start: first column
+        @type start: integer
+        @param stop: column after the last one
+        @type stop: integer
+        @param num_rows: number of rows needed at least
+        @type num_rows: integer
+        @return: matrix of the given columns
+        @rtype: scipy.sparse.csc_matrix
+        """
+        indptr = self.indptr[start:stop+1]
+        first, last = indptr[0], indptr[-1]
+        indices = self.indices[first:last]
+        if num_rows is None or self._shape is not None:
+            num_rows = self.shape[0]
+        elif len(indices):
+            num_rows = max(num_rows, int(indices.max()) + 1)
+        return csc_matrix((self.data[first:last], indices,
+            indptr - first), shape=(num_rows, len(indptr) - 1))
+
+    def __getitem__(self, key):
+        rows = slice(None)
+        if type(key) == tuple:
+            rows, key = key
+        if type(key) == slice and key.step in (None, 1):
+            start, stop, step = key.indices(self.shape[1])
+            A = self.get_columns(start, max(start, stop))
+        elif type(key) == slice:
+            A = self.load()[:, key]
+        else:
+            if key < 0:
+                key += self.shape[1]
+            A = self.get_columns(key, key + 1)
+        return A[rows, :]
+
+    def load(self):
+        """Read the whole matrix.
+
+        @return: matrix
+        @rtype: scipy.sparse.csc_matrix
+        """
+        return csc_matrix((self.data[...], self.indices[...], self.indptr[...]))
+
+
+def get_proxy(group, name):
+    """Get lazy stand-in for a variable of an opened HDF5 file.
+
+    Sparse variables have datasets <name>_indices and <name>_indptr next to
+    them, string variables stored as codes have <name>_categories.
+
+    @param group: HDF5 group holding the variable
+    @type group: h5py.Group
+    @param name: name of the variable
+    @type name: string
+    @return: stand-in for the variable
+    @rtype: DatasetProxy/SparseProxy
+    """
+    if name + '_indices' in group and name + '_indptr' in group:
+        return SparseProxy(group[name], group[name + '_indices'],
+            group[name + '_indptr'])
+    elif name + '_categories' in group:
+        categories = DatasetProxy(group[name + '_categories']).load()
+        return DatasetProxy(group[name], categories)
+    return DatasetProxy(group[name])
 
 
 class BaseHandler(object):
@@ -19,6 +227,8 @@ class BaseHandler(object):
     @type fname: string
     @ivar seperator: seperator to seperate variables in examples
     @type seperator: string
+    @ivar h5: HDF5 file kept open for data read lazily, see close()
+    @type h5: h5py.File
     """
     str_type = h5py.new_vlen(numpy.str)
 
@@ -34,6 +244,7 @@ class BaseHandler(object):
         self.compression = compression
         self.set_seperator(seperator)
         self.merge = merge
+        self.h5 = None
 
 
     def set_seperator(self, seperator):
@@ -48,6 +259,16 @@ class BaseHandler(object):
             raise AttributeError(_("Seperator '%s' not allowed!" % seperator))
 
 
+    def close(self):
+        """Close the HDF5 file kept open by read(lazy=True).
+
+        Proxies of the data read lazily cannot be read from afterwards.
+        """
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+
+
     def warn(self, msg):
         """Print a warning message.
 
@@ -63,50 +284,159 @@ class BaseHandler(object):
         @param path: path of the attribute in the h5 file
         @type path: string 
         @param val: data of the attribute
-        @type val: csc_matrix/ndarray  
+        @type val: csc_matrix/ndarray/DatasetProxy/SparseProxy
         @rtype: list of (string,ndarray) tuples 
         """
         A=val
         out=[]
         dt = h5py.special_dtype(vlen=str)
-        if type(A)==csc_matrix: # sparse
+        if isinstance(A, DatasetProxy) and A.categories is not None:
+            out.append((path+'_categories', self._encode_fixed(A.categories)))
+            out.append((path, numpy.asarray(A.dset)))
+        elif isinstance(A, DatasetProxy) and A.dtype.kind != 'O':
+            out.append((path, A))
+        elif isinstance(A, SparseProxy):
+            out.append((path+'_indices', DatasetProxy(A.indices)))
+            out.append((path+'_indptr', DatasetProxy(A.indptr)))
+            out.append((path, DatasetProxy(A.data)))
+        elif type(A)==csc_matrix: # sparse
             out.append((path+'_indices', A.indices))
             out.append((path+'_indptr', A.indptr))
             out.append((path, A.data))
         elif type(A)==list and len(A)>0 and type(A[0])==str:
-            out.append((path, numpy.array(A, dtype=dt)))
+            out.extend(self._encode_strings(path, numpy.array(A, dtype=dt)))
         else: # dense
-            out.append((path, numpy.array(A)))
+            A = numpy.array(A)
+            if A.dtype.kind in 'US' or \
+                    (A.dtype.kind == 'O' and A.size and isinstance(A.flat[0], str)):
+                out.extend(self._encode_strings(path, A))
+            else:
+                out.append((path, A))
         return out
 
-    def get_data_as_list(self,data):
-        """ this needs to `transpose' the data """
+    def _encode_strings(self, path, A):
+        """Get layout to store string data in.
+
+        Data with few distinct values becomes integer codes at path and
+        categories at path_categories, other data up to FIXED_STRING_MAX
+        bytes long fixed width UTF-8; longer strings stay variable length.
+
+        @param path: path of the attribute in the h5 file
+        @type path: string
+        @param A: string data of the attribute
+        @type A: numpy.ndarray
+        @rtype: list of (string,ndarray) tuples
+        """
+        if A.dtype.kind == 'S':
+            A = numpy.char.decode(A, 'utf-8')
+        else:
+            A = A.astype(str)
+        if not A.size:
+            return [(path, A.astype(self.str_type))]
 
-        dl=[]
+        categories, codes = numpy.unique(A, return_inverse=True)
+        if len(categories) <= CATEGORIES_MAX and 2 * len(categories) <= A.size:
+            if len(categories) <= 256:
+                codes = codes.astype(numpy.uint8)
+            else:
+                codes = codes.astype(numpy.uint16)
+            return [(path + '_categories', self._encode_fixed(categories)),
+                (path, codes.reshape(A.shape))]
+        return [(path, self._encode_fixed(A))]
 
-        group=self.get_data_group(data)
+    def _encode_fixed(self, A):
+        """Encode strings with fixed width if not longer than FIXED_STRING_MAX.
 
-        lengths=dict()
-        for o in data['ordering']:
-            x=data[group][o]
-            #if numpy.issubdtype(x.dtype, numpy.int):
-            #    data[group][o]=x.astype(numpy.float64)
-            try:
-                lengths[o]=data[group][o].shape[1]
-            except (AttributeError, IndexError):
-                lengths[o]=len(data[group][o])
-        l=set(lengths.values())
-        assert(len(l)==1)
-        l=l.pop()
-
-        for i in range(l):
-            line=[]
-            for o in data['ordering']:
-                try:
-                    line.extend(data[group][o][:,i])
-                except:
-                    line.append(data[group][o][i])
-            dl.append(line)
+        @param A: strings to encode
+        @type A: numpy.ndarray
+        @return: fixed width UTF-8 or variable length strings
+        @rtype: numpy.ndarray
+        """
+        A = A.astype(str)
+        try:
+            encoded = A.astype(numpy.bytes_)
+        except UnicodeEncodeError: # not ASCII
+            encoded = numpy.char.encode(A, 'utf-8')
+        if encoded.dtype.itemsize <= FIXED_STRING_MAX:
+            return encoded
+        return A.astype(self.str_type)
+
+    def _load_proxies(self, data):
+        """Get given data with DatasetProxy/SparseProxy values loaded.
+
+        For writers that need plain arrays; nominal codes are expanded here.
+
+        @param data: data structure as returned by read()
+        @type data: dict
+        @return: data structure with arrays and matrices only
+        @rtype: dict
+        """
+        group = self.get_data_group(data)
+        loaded = dict(data)
+        loaded[group] = {}
+        for name, val in data[group].items():
+            if isinstance(val, (DatasetProxy, SparseProxy)):
+                val = val.load()
+            loaded[group][name] = val
+        return loaded
+
+    def iter_data_columns(self, data, block_size=ROW_BLOCK_SIZE):
+        """Iterate over blocks of examples, one sequence per attribute.
+
+        Each block is sliced from the column-major data at once, matrices
+        being split into one column per attribute.
+
+        @param data: data structure as returned by read()
+        @type data: dict
+        @param block_size: number of examples per block
+        @type block_size: integer
+        @return: blocks of columns, a column being the values of one attribute
+        @rtype: generator of list of numpy.ndarray
+        """
+        group = self.get_data_group(data)
+        values = [data[group][o] for o in data['ordering']]
+
+        lengths = set()
+        for x in values:
+            if len(getattr(x, 'shape', ())) == 2:
+                lengths.add(x.shape[1])
+            else:
+                lengths.add(len(x))
+        assert(len(lengths)==1)
+        num = lengths.pop()
+
+        for start in range(0, num, block_size):
+            stop = min(start + block_size, num)
+            columns = []
+            for x in values:
+                if len(getattr(x, 'shape', ())) == 2:
+                    columns.extend(x[:, start:stop])
+                else:
+                    columns.append(x[start:stop])
+            yield columns
+
+
+    def iter_data_rows(self, data, block_size=ROW_BLOCK_SIZE):
+        """Iterate over blocks of examples, i.e. the `transposed' data.
+
+        Only one block of rows exists as Python objects at any time.
+
+        @param data: data structure as returned by read()
+        @type data: dict
+        @param block_size: number of examples per block
+        @type block_size: integer
+        @return: blocks of rows, a row being a tuple of values
+        @rtype: generator of list of tuple
+        """
+        for columns in self.iter_data_columns(data, block_size):
+            yield list(zip(*columns))
+
+
+    def get_data_as_list(self,data):
+        """ this needs to `transpose' the data """
+        dl = []
+        for rows in self.iter_data_rows(data):
+            dl.extend(list(row) for row in rows)
         return dl
 
     def get_name(self):
@@ -130,8 +460,10 @@ class BaseHandler(object):
         else:
             return 'data_descr'
 
-    def get_datatype(self, values):
-        """Get data type of given values.
+    def _get_datatype_python(self, values):
+        """Get data type of given values, checking value by value.
+
+        Fallback for get_datatype if values cannot be checked as an array.
 
         @param values: list of values to check
         @type values: list
@@ -141,7 +473,8 @@ class BaseHandler(object):
         dtype = None
         for v in values:
             if isinstance(v, int):
-                dtype = numpy.int32
+                if not dtype: # a previous float might set it to double
+                    dtype = numpy.int32
             elif isinstance(v, float):
                 dtype = numpy.double
             else: # maybe int/double in string
@@ -159,11 +492,68 @@ class BaseHandler(object):
         return dtype
 
 
-    def read(self):
+    def get_datatype(self, values):
+        """Get data type of given values.
+
+        The values are checked as a whole: plain digit strings by one check
+        on the joined values, other numbers by the dtype numpy infers for
+        them and other strings by converting the whole array to double and
+        then to int. Like int() and float() on each value, this
+        yields int if all values are ints, double if some are floats or NaN
+        and string otherwise.
+
+        @param values: list of values to check
+        @type values: list
+        @return: data type to use for conversion
+        @rtype: numpy.int32/numpy.double/self.str_type
+        """
+        if not len(values):
+            return None
+
+        # plain digits only: one check on the joined values
+        try:
+            if all(values) and ''.join(values).isdecimal():
+                return numpy.int32
+        except TypeError: # not all strings
+            pass
+
+        try:
+            arr = numpy.asarray(values)
+        except ValueError: # ragged
+            return self._get_datatype_python(values)
+
+        if arr.dtype.kind in ('b', 'i', 'u'):
+            return numpy.int32
+        elif arr.dtype.kind == 'f':
+            return numpy.double
+        elif arr.dtype.kind in ('U', 'S'):
+            # every int is a valid double, so strings are ruled out first
+            try:
+                arr.astype(numpy.double)
+            except ValueError:
+                return self.str_type
+            try:
+                arr.astype(numpy.int64)
+                return numpy.int32
+            except OverflowError: # python ints are unbounded
+                return self._get_datatype_python(values)
+            except ValueError:
+                return numpy.double
+
+        return self._get_datatype_python(values)
+
+
+    def read(self, lazy=False):
         """Get data and description in-memory 
 
         Retrieve contents from file.
 
+        In lazy mode the file is kept open and the data values are
+        DatasetProxy/SparseProxy objects, which only read what is indexed.
+        The file stays open until close() or the next lazy read.
+
+        @param lazy: if data shall be read lazily
+        @type lazy: boolean
         @return: example names, ordering and the examples
         @rtype: dict of: list of names, list of ordering and dict of examples
         """
@@ -173,6 +563,9 @@ class BaseHandler(object):
             return
 
         h5 = h5py.File(self.fname, 'r')
+        if lazy:
+            self.close()
+            self.h5 = h5
 
         contents = {
             'name': h5.attrs['name'],
@@ -201,43 +594,214 @@ class BaseHandler(object):
             contents['types'] = h5['/%s_descr/types' % group ][...]
 
         for name in contents['ordering']:
-            vname='/%s/%s' % (group, name)
-            sp_indices=vname+'_indices'
-            sp_indptr=vname+'_indptr'
-
-            if sp_indices in h5['/%s' % group] and sp_indptr in h5['/%s' % group]:
-                contents[group][name] = csc_matrix((h5[vname], h5[sp_indices], h5[sp_indptr])
-            )
+            d = get_proxy(h5['/%s' % group], name)
+            if lazy:
+                contents[group][name] = d
             else:
-                d = numpy.array(h5[vname],order='F')
+                contents[group][name] = d.load()
 
-                try:
-                    d=d['vlen']
-                except:
-                    pass
-                contents[group][name] = d
-        h5.close()
+        if not lazy:
+            h5.close()
         return contents
 
-    def read_data_as_array(self):
-        """Read data from file, and return an array
-        
-        @return: an array with all data
-        @rtype: numpy ndarray
+    def _read_rows(self, d, rows, examples):
+        """Read given rows of given examples from a (lazily read) dataset.
+
+        The span of examples is read in blocks, using hyperslabs on dense
+        datasets and indptr ranges on sparse ones.
+
+        @param d: dataset to read from
+        @type d: DatasetProxy/SparseProxy
+        @param rows: sorted unique row indices, None for a 1-d dataset
+        @type rows: list of integer
+        @param examples: sorted unique example indices
+        @type examples: numpy.ndarray
+        @return: array with one row per given row and one column per example
+        @rtype: numpy.ndarray
+        """
+        num_rows = 1 if rows is None else len(rows)
+        out = numpy.empty((num_rows, len(examples)), dtype=d.dtype)
+        if not len(examples):
+            return out
+
+        step = max(1, SCAN_SIZE // num_rows)
+        for start in range(examples[0], examples[-1] + 1, step):
+            first, last = numpy.searchsorted(examples, [start, start + step])
+            if first == last:
+                continue
+            end = examples[last - 1] + 1
+            sel = examples[first:last] - start
+            if isinstance(d, SparseProxy):
+                block = d.get_columns(start, end, rows[-1] + 1)[rows, :][:, sel].toarray()
+            elif rows is None:
+                block = d[start:end][sel]
+            else:
+                block = d[rows, start:end][:, sel]
+            out[:, first:last] = block
+        return out
+
+
+    def read_subset(self, attributes=None, examples=None):
+        """Read only the given attributes of the given examples.
+
+        Attributes are numbered over the datasets in ordering, as in
+        read_data_as_array. Neither the whole file nor whole datasets are
+        read, only blocks of the rows needed.
+
+        @param attributes: indices of attributes to read, all if None
+        @type attributes: list of integer
+        @param examples: indices of examples to read, all if None
+        @type examples: list of integer
+        @return: array with one row per example and one column per attribute
+        @rtype: numpy.ndarray
+        """
+        contents = self.read(lazy=True)
+        try:
+            return self._read_subset(contents, attributes, examples)
+        finally:
+            self.close()
+
+
+    def _read_subset(self, contents, attributes, examples):
+        """Read only the given attributes of the given examples from data
+        read lazily, see read_subset.
         """
-        contents = self.read()
-        #group = self.get_data_group(data)
         data = contents['data']
         ordering = contents['ordering']
-        if len(data[ordering[0]].shape)>1:
-            num_examples = data[ordering[0]].shape[1]
+
+        # first attribute and number of attributes of each dataset
+        layout = []
+        offset = 0
+        for i, name in enumerate(ordering):
+            d = data[name]
+            if isinstance(d, SparseProxy) and i == len(ordering) - 1:
+                num = None # last one, no need to scan indices for its size
+            elif isinstance(d, SparseProxy) or len(d.shape) == 2:
+                num = d.shape[0]
+            else:
+                num = 1
+            layout.append((name, offset, num))
+            if num is not None:
+                offset += num
+
+        d = data[ordering[0]]
+        if isinstance(d, SparseProxy) or len(d.shape) == 2:
+            num_examples = d.shape[1]
+        else:
+            num_examples = d.shape[0]
+
+        if attributes is None:
+            attributes = range(offset if layout[-1][2] is not None else
+                offset + data[ordering[-1]].shape[0])
+        if examples is None:
+            examples = numpy.arange(num_examples)
+        examples, inverse = numpy.unique(numpy.asarray(examples, dtype=int),
+            return_inverse=True)
+
+        # group attributes by dataset
+        wanted = {}
+        for j, a in enumerate(attributes):
+            for name, first, num in layout:
+                if first <= a and (num is None or a < first + num):
+                    wanted.setdefault(name, []).append((a - first, j))
+                    break
+            else:
+                raise IndexError('Attribute %d out of range' % a)
+
+        dtypes = [data[name].dtype for name in wanted]
+        if [t for t in dtypes if t.kind == 'O']:
+            dtype = self.str_type
         else:
-            num_examples = len(data[ordering[0]])
-        data_array = numpy.zeros((0, num_examples))
-        for cur_feat in ordering:
-            data_array = numpy.vstack([data_array, data[cur_feat]])
-        return data_array.T
-        
+            dtype = numpy.result_type(*dtypes)
+        out = numpy.empty((len(inverse), len(attributes)), dtype=dtype)
+
+        for name, items in wanted.items():
+            d = data[name]
+            if isinstance(d, DatasetProxy) and len(d.shape) == 1:
+                rows = None
+                pos = [0 for a, j in items]
+            else:
+                rows, pos = numpy.unique([a for a, j in items], return_inverse=True)
+                rows = rows.tolist()
+            block = self._read_rows(d, rows, examples)
+            out[:, [j for a, j in items]] = block[pos][:, inverse].T
+        return out
+
+
+    def read_data_as_array(self, sparse=False, memmap=None):
+        """Read data from file, and return an array
+
+        The result is preallocated from the shapes of the datasets and
+        filled block by block; sparse datasets are only densified one block
+        of examples at a time. With sparse=True a sparse matrix is built
+        instead, with memmap the array is written to a .npy file.
+
+        @param sparse: if a sparse matrix shall be returned
+        @type sparse: boolean
+        @param memmap: name of .npy file to map the array to
+        @type memmap: string
+        @return: an array with all data, one row per example
+        @rtype: numpy ndarray, numpy memmap or scipy.sparse.csr_matrix
+        """
+        contents = self.read(lazy=True)
+        try:
+            return self._read_data_as_array(contents, sparse, memmap)
+        finally:
+            self.close()
+
+
+    def _read_data_as_array(self, contents, sparse, memmap):
+        """Read data read lazily into an array, see read_data_as_array.
+        """
+        data = [contents['data'][name] for name in contents['ordering']]
+        num_examples = data[0].shape[-1]
+        num_attrs = []
+        for d in data:
+            if isinstance(d, SparseProxy) or len(d.shape) == 2:
+                num_attrs.append(d.shape[0])
+            else:
+                num_attrs.append(1)
+
+        if [d for d in data if d.dtype.kind == 'O']:
+            dtype = numpy.dtype(object)
+        else:
+            dtype = numpy.result_type(numpy.double, *[d.dtype for d in data])
+
+        if sparse:
+            if dtype.kind == 'O':
+                raise ml2h5.converter.ConversionError(
+                    'String data cannot be read as sparse matrix')
+            parts = []
+            for d in data:
+                if isinstance(d, SparseProxy):
+                    parts.append(d.load())
+                else:
+                    parts.append(csc_matrix(numpy.atleast_2d(d.load())))
+            return scipy.sparse.vstack(parts).T.tocsr().astype(dtype)
+
+        shape = (num_examples, sum(num_attrs))
+        if memmap:
+            if dtype.kind == 'O':
+                raise ml2h5.converter.ConversionError(
+                    'String data cannot be mapped to file')
+            data_array = numpy.lib.format.open_memmap(memmap, mode='w+',
+                dtype=dtype, shape=shape)
+        else:
+            data_array = numpy.empty(shape, dtype=dtype)
+
+        offset = 0
+        for d, num in zip(data, num_attrs):
+            step = max(1, SCAN_SIZE // num)
+            for start in range(0, num_examples, step):
+                stop = min(start + step, num_examples)
+                if isinstance(d, SparseProxy):
+                    block = d.get_columns(start, stop).toarray()
+                else:
+                    block = d[..., start:stop]
+                data_array[start:stop, offset:offset+num] = numpy.atleast_2d(block).T
+            offset += num
+        return data_array
+
 
     def _get_merged(self, data):
         """Merge given data where appropriate.
@@ -305,6 +869,9 @@ class BaseHandler(object):
                 merged[path] = val
         data[group] = {}        
         for k in merged:
+            if isinstance(merged[k], DatasetProxy): # e.g. nominal codes
+                data[group][k] = merged[k]
+                continue
             if len(merged[k])==1:
                 merged[k] = merged[k][0]    
             data[group][k] = numpy.array(merged[k])
@@ -312,6 +879,194 @@ class BaseHandler(object):
         return data
 
 
+    def _write_attrs(self, h5, data):
+        """Write file attributes of given data to opened HDF5 file.
+
+        @param h5: HDF5 file opened for writing
+        @type h5: h5py.File
+        @param data: data structure containing at least name and comment
+        @type data: dict
+        """
+        h5.attrs['name'] = data['name']
+        h5.attrs['mldata'] = VERSION_MLDATA
+        h5.attrs['comment'] = data['comment']
+
+
+    def _write_descr(self, h5, data):
+        """Write description group (names, ordering, types) of given data.
+
+        @param h5: HDF5 file opened for writing
+        @type h5: h5py.File
+        @param data: data structure containing names, ordering and maybe types
+        @type data: dict
+        """
+        group = h5.create_group('/%s' % self.get_descr_group(data))
+        names = numpy.array(data.get('names', [])).astype(self.str_type)
+        if names.size > 0: # simple 'if names' throws exception if array
+            group.create_dataset('names', data=names, **self._get_filters())
+        ordering = numpy.array(data['ordering']).astype(self.str_type)
+        if ordering.size > 0:
+            group.create_dataset('ordering', data=ordering, **self._get_filters())
+        if 'types' in data:
+            types = numpy.array(data['types']).astype(self.str_type)
+            group.create_dataset('types', data=types, **self._get_filters())
+
+
+    def _get_merged_layout(self, ordering, dtypes):
+        """Get layout of merged data without having the data in memory.
+
+        Runs of int and double columns are grouped like _get_merged does,
+        other columns are kept on their own.
+
+        @param ordering: names of columns
+        @type ordering: list of strings
+        @param dtypes: data types of columns
+        @type dtypes: list
+        @return: path of each merged dataset and indices of its columns
+        @rtype: list of (string, list of integer) tuples
+        """
+        layout = []
+        idx = 0
+        merging = None
+        for i, name in enumerate(ordering):
+            t = dtypes[i]
+            if t in (numpy.int32, numpy.int64):
+                kind = 'int'
+            elif t == numpy.double:
+                kind = 'double'
+            else:
+                kind = None
+
+            if kind and kind == merging:
+                layout[-1][1].append(i)
+            elif kind:
+                layout.append((kind + str(idx), [i]))
+                idx += 1
+            else:
+                layout.append((name.replace('/', '+'), [i]))
+            merging = kind
+        return layout
+
+
+    def _append_dataset(self, group, path, val):
+        """Append given values to a resizable, chunked 1-d dataset.
+
+        The dataset is created on first use, so data can be written block by
+        block without knowing its final length.
+
+        @param group: HDF5 group to hold the dataset
+        @type group: h5py.Group
+        @param path: name of the dataset within the group
+        @type path: string
+        @param val: values to append
+        @type val: numpy.ndarray
+        """
+        if path in group:
+            dset = group[path]
+            start = dset.shape[0]
+            dset.resize((start + len(val),))
+            dset[start:] = val
+        else:
+            group.create_dataset(path, data=val, maxshape=(None,),
+                chunks=True, **self._get_filters())
+
+
+    def _get_filters(self):
+        """Get HDF5 filter arguments according to compression.
+
+        compression is either a key of COMPRESSION_PRESETS or passed on to
+        h5py as is, e.g. 'gzip' or None.
+
+        @return: keyword arguments for h5py's create_dataset
+        @rtype: dict
+        """
+        if self.compression in COMPRESSION_PRESETS:
+            return dict(COMPRESSION_PRESETS[self.compression])
+        return {'compression': self.compression}
+
+
+    def _get_chunks(self, shape, dtype):
+        """Get chunk shape for a dataset of given shape and type.
+
+        Chunks hold about CHUNK_BYTES. Matrices (attributes x examples) get
+        about square chunks, so reading the row of an attribute as well as
+        the column of an example only touches a few chunks.
+
+        @param shape: shape of dataset
+        @type shape: tuple
+        @param dtype: data type of dataset
+        @type dtype: numpy.dtype
+        @return: chunk shape, None for empty datasets
+        @rtype: tuple
+        """
+        if not numpy.prod(shape):
+            return None
+        num = max(1, CHUNK_BYTES // max(1, dtype.itemsize))
+        if len(shape) == 1:
+            return (min(shape[0], num),)
+        elif len(shape) != 2:
+            return True
+        rows = min(shape[0], int(numpy.sqrt(num)))
+        cols = min(shape[1], max(1, num // rows))
+        rows = min(shape[0], max(1, num // cols))
+        return (rows, cols)
+
+
+    def _write_dataset(self, group, path, val):
+        """Write given values to a new dataset.
+
+        Numeric datasets larger than WRITE_BLOCK_BYTES are written block by
+        block of examples, which reads DatasetProxy values only block-wise.
+        Those and compressed datasets are chunked as given by _get_chunks,
+        others are stored contiguously.
+
+        @param group: HDF5 group to hold the dataset
+        @type group: h5py.Group
+        @param path: name of the dataset within the group
+        @type path: string
+        @param val: values to write
+        @type val: numpy.ndarray or DatasetProxy
+        @return: written dataset
+        @rtype: h5py.Dataset
+        """
+        filters = self._get_filters()
+        dtype = val.dtype
+        size = int(numpy.prod(val.shape)) * dtype.itemsize
+        incremental = dtype.kind in 'biuf' and size > WRITE_BLOCK_BYTES
+
+        if not incremental and filters['compression'] is None:
+            return group.create_dataset(path, data=numpy.asarray(val),
+                dtype=dtype)
+
+        chunks = self._get_chunks(val.shape, dtype)
+        if not incremental:
+            return group.create_dataset(path, data=numpy.asarray(val),
+                dtype=dtype, chunks=chunks, **filters)
+
+        dset = group.create_dataset(path, val.shape, dtype=dtype,
+            chunks=chunks, **filters)
+        step = max(1, val.shape[-1] * WRITE_BLOCK_BYTES // size)
+        for start in range(0, val.shape[-1], step):
+            dset[..., start:start+step] = val[..., start:start+step]
+        return dset
+
+
+    def get_storage_size(self):
+        """Get size of the data in this HDF5 file, raw and as stored.
+
+        @return: number of bytes of data and number of bytes in file
+        @rtype: tuple of integer
+        """
+        raw = stored = 0
+        h5 = h5py.File(self.fname, 'r')
+        group = 'task' if 'task' in h5 else 'data'
+        for dset in h5[group].values():
+            raw += int(numpy.prod(dset.shape)) * dset.dtype.itemsize
+            stored += dset.id.get_storage_size()
+        h5.close()
+        return raw, stored
+
+
     def write(self, data):
         """Write given data to HDF5 file.
 
@@ -320,29 +1075,17 @@ class BaseHandler(object):
         """
         # we want the exception handled elsewhere
         h5 = h5py.File(self.fname, 'w')
-        h5.attrs['name'] = data['name']
-        h5.attrs['mldata'] = VERSION_MLDATA
-        h5.attrs['comment'] = data['comment']
+        self._write_attrs(h5, data)
 
         data_group = self.get_data_group(data)
-        descr_group = self.get_descr_group(data)
 
         try:
             group = h5.create_group('/%s' % data_group)
             for path, val in data[data_group].items():
                 for path, val in self._convert_to_ndarray(path,val):
-                    group.create_dataset(path, data=val, compression=self.compression)
-
-            group = h5.create_group('/%s' % descr_group)
-            names = numpy.array(data['names']).astype(self.str_type)
-            if names.size > 0: # simple 'if names' throws exception if array
-                group.create_dataset('names', data=names, compression=self.compression)
-            ordering = numpy.array(data['ordering']).astype(self.str_type)
-            if ordering.size > 0:
-                group.create_dataset('ordering', data=ordering, compression=self.compression)
-            if 'types' in data:
-                types = numpy.array(data['types']).astype(self.str_type)
-                group.create_dataset('types', data=types, compression=self.compression)
+                    self._write_dataset(group, path, val)
+
+            self._write_descr(h5, data)
         except: # just do some clean-up
             h5.close()
             os.remove(self.fname)
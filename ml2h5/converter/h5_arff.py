@@ -1,10 +1,13 @@
-import h5py, numpy, copy
+import h5py, numpy, copy, itertools
 import ml2h5.converter
 from ml2h5.converter import arff
-from ml2h5.converter.basehandler import BaseHandler
+from ml2h5.converter.basehandler import BaseHandler, DatasetProxy, ROW_BLOCK_SIZE
 from scipy.sparse import csc_matrix
 
 
+# number of data points converted to columns at once
+BLOCK_SIZE = 10000
+
 class H5_ARFF(BaseHandler):
     """Handle ARFF files.
 
@@ -34,51 +37,378 @@ class H5_ARFF(BaseHandler):
         return numpy.array(types)
 
 
-    def read(self):
-        data = {}
-        names = []
-        ordering = []
-        af = arff.ArffFile.load(self.fname)
-        for name in af.attributes:
-            names.append(name)
-            data[name] = []
-
-        for item in af.data:
-            for i in range(len(data)):
-                data[names[i]].append(item[i])
-        # conversion to proper data types
-        for name, values in data.items():
-            if af.attribute_types[name] == 'date':
+    def _convert_numeric(self, values):
+        """Convert a block of values of a numeric attribute.
+
+        Missing values ('?' or empty) become NaN, blocks of integers stay
+        integer.
+
+        @param values: values as read from file
+        @type values: tuple of strings
+        @return: converted values
+        @rtype: numpy.ndarray
+        """
+        A = numpy.array(values)
+        missing = (A == '?') | (A == '')
+        if missing.any():
+            return numpy.where(missing, 'nan', A).astype(numpy.double)
+        try:
+            return A.astype(numpy.int64)
+        except (ValueError, OverflowError):
+            return A.astype(numpy.double)
+
+
+    def _convert_other(self, af, atype, values):
+        """Convert a block of values of a non-numeric attribute.
+
+        @param af: opened ARFF file
+        @type af: arff.ArffFile
+        @param atype: ARFF type of attribute
+        @type atype: string
+        @param values: values as read from file
+        @type values: tuple of strings
+        @return: converted values
+        @rtype: list
+        """
+        if atype == 'nominal':
+            return [numpy.nan if v == '?' else v for v in values]
+        return [af._rm_ticks(v) for v in values]
+
+
+    def _get_column(self, atype, blocks):
+        """Get data of an attribute from its converted blocks.
+
+        @param atype: ARFF type of attribute
+        @type atype: string
+        @param blocks: blocks as returned by _convert_numeric or values
+            as returned by _convert_other
+        @type blocks: list
+        @return: data of attribute
+        @rtype: numpy.ndarray
+        """
+        if atype == 'numeric':
+            if blocks:
+                values = numpy.concatenate(blocks)
+            else:
+                values = numpy.array([])
+            if values.dtype.kind == 'i':
+                t = numpy.int32
+            else:
+                t = numpy.double
+        else:
+            values = blocks
+            if atype == 'date':
                 t = self.str_type
             else:
                 t = self.get_datatype(values)
-            data[name] = numpy.array(values).astype(t)
+        return numpy.array(values).astype(t)
+
+
+    def _get_lookups(self, af):
+        """Get value to code dicts of nominal attributes.
+
+        Nominal attributes with numeric values are left out, they are read
+        as numbers. Missing values ('?') get the code after the last value.
+
+        @param af: opened ARFF file
+        @type af: arff.ArffFile
+        @return: value to code dict by index of attribute
+        @rtype: dict
+        """
+        lookups = {}
+        for i, name in enumerate(af.attributes):
+            values = af.attribute_data[name]
+            if af.attribute_types[name] != 'nominal' or \
+                    self.get_datatype(values) != self.str_type:
+                continue
+            lookup = dict((v, code) for code, v in enumerate(values))
+            lookup['?'] = len(values)
+            lookups[i] = lookup
+        return lookups
+
+
+    def _get_codes(self, lookup, values):
+        """Convert a block of nominal values to integer codes.
+
+        @param lookup: value to code dict as returned by _get_lookups
+        @type lookup: dict
+        @param values: values as read from file
+        @type values: tuple of strings
+        @return: codes
+        @rtype: numpy.ndarray
+        """
+        if len(lookup) <= 256:
+            t = numpy.uint8
+        elif len(lookup) <= 65536:
+            t = numpy.uint16
+        else:
+            t = numpy.uint32
+        return numpy.array([lookup[v] for v in values], dtype=t)
+
+
+    def _get_nominal(self, af, name, blocks):
+        """Get data of a nominal attribute from its blocks of codes.
+
+        Missing values become 'nan', as they would when read as strings.
+
+        @param af: opened ARFF file
+        @type af: arff.ArffFile
+        @param name: name of attribute
+        @type name: string
+        @param blocks: blocks as returned by _get_codes
+        @type blocks: list of numpy.ndarray
+        @return: codes and the categories they index
+        @rtype: DatasetProxy
+        """
+        values = af.attribute_data[name]
+        if blocks:
+            codes = numpy.concatenate(blocks)
+        else:
+            codes = numpy.array([], dtype=numpy.uint8)
+        categories = list(values)
+        if (codes == len(values)).any():
+            categories.append('nan')
+        return DatasetProxy(codes, numpy.array(categories, dtype=object))
+
+
+    def _get_defaults(self, af):
+        """Get values of attributes left out in sparse data points.
+
+        @param af: opened ARFF file
+        @type af: arff.ArffFile
+        @return: default value of each attribute
+        @rtype: list of strings
+        """
+        defaults = []
+        for name in af.attributes:
+            if af.attribute_types[name] == 'numeric':
+                defaults.append('0')
+            elif af.attribute_types[name] == 'nominal':
+                defaults.append(af.attribute_data[name][0])
+            else:
+                defaults.append('')
+        return defaults
+
+
+    def _read_dense(self, af, block, rows):
+        """Read data points into one column per attribute.
+
+        @param af: opened ARFF file
+        @type af: arff.ArffFile
+        @param block: first block of data points
+        @type block: list
+        @param rows: remaining data points
+        @type rows: generator
+        @return: data and ordering
+        @rtype: tuple of dict and list
+        """
+        names = af.attributes
+        types = [af.attribute_types[name] for name in names]
+        defaults = self._get_defaults(af)
+        lookups = self._get_lookups(af)
+        columns = [[] for name in names]
+
+        # convert blocks of data points column by column
+        while block:
+            block = [[row.get(i, d) for i, d in enumerate(defaults)]
+                     if isinstance(row, dict) else row for row in block]
+            for i, values in enumerate(zip(*block)):
+                if types[i] == 'numeric':
+                    columns[i].append(self._convert_numeric(values))
+                elif i in lookups:
+                    columns[i].append(self._get_codes(lookups[i], values))
+                else:
+                    columns[i].extend(self._convert_other(af, types[i], values))
+            block = list(itertools.islice(rows, BLOCK_SIZE))
+
+        data = {}
+        for i, name in enumerate(names):
+            if i in lookups:
+                data[name] = self._get_nominal(af, name, columns[i])
+            else:
+                data[name] = self._get_column(types[i], columns[i])
+        return data, copy.copy(names)
+
+
+    def _read_sparse(self, af, block, rows):
+        """Read sparse data points into CSC matrices.
+
+        Each run of numeric attributes becomes one sparse matrix, named
+        double0, double1, ... as in merged data. Other attributes get one
+        column each.
+
+        @param af: opened ARFF file
+        @type af: arff.ArffFile
+        @param block: first block of data points
+        @type block: list
+        @param rows: remaining data points
+        @type rows: generator
+        @return: data and ordering
+        @rtype: tuple of dict and list
+        """
+        names = af.attributes
+        types = [af.attribute_types[name] for name in names]
+        defaults = self._get_defaults(af)
+        lookups = self._get_lookups(af)
+
+        # map attributes to runs of numeric attributes
+        ordering = []
+        runs = []
+        run_of = [None] * len(names)
+        local_of = [0] * len(names)
+        for i, name in enumerate(names):
+            if types[i] == 'numeric':
+                if i > 0 and run_of[i-1] is not None:
+                    local_of[i] = local_of[i-1] + 1
+                else:
+                    runs.append('double%d' % len(runs))
+                    ordering.append(runs[-1])
+                run_of[i] = len(runs) - 1
+            else:
+                ordering.append(name)
+        others = [i for i in range(len(names)) if run_of[i] is None]
+
+        values = [[] for r in runs]
+        indices = [[] for r in runs]
+        indptr = [[numpy.zeros(1, dtype=numpy.int64)] for r in runs]
+        nnz = [0 for r in runs]
+        columns = dict((i, []) for i in others)
+        num = 0
+        while block:
+            block_values = [[] for r in runs]
+            block_indices = [[] for r in runs]
+            block_indptr = [[] for r in runs]
+            for row in block:
+                if not isinstance(row, dict):
+                    row = dict(enumerate(row))
+                for i in sorted(row):
+                    r = run_of[i]
+                    if r is not None:
+                        block_values[r].append(row[i])
+                        block_indices[r].append(local_of[i])
+                for r in range(len(runs)):
+                    block_indptr[r].append(len(block_indices[r]))
+                for i in others:
+                    columns[i].append(row.get(i, defaults[i]))
+            for r in range(len(runs)):
+                if block_values[r]:
+                    values[r].append(self._convert_numeric(block_values[r]))
+                indices[r].append(numpy.array(block_indices[r], dtype=numpy.int32))
+                indptr[r].append(numpy.array(block_indptr[r], dtype=numpy.int64) + nnz[r])
+                nnz[r] += len(block_indices[r])
+            num += len(block)
+            block = list(itertools.islice(rows, BLOCK_SIZE))
+
+        data = {}
+        for r, name in enumerate(runs):
+            size = len([i for i in run_of if i == r])
+            data[name] = csc_matrix((
+                self._get_column('numeric', values[r]).astype(numpy.double),
+                numpy.concatenate(indices[r]), numpy.concatenate(indptr[r])),
+                shape=(size, num))
+            data[name].eliminate_zeros() # given by dense data points
+        for i in others:
+            if i in lookups:
+                data[names[i]] = self._get_nominal(af, names[i],
+                    [self._get_codes(lookups[i], columns[i])])
+            else:
+                data[names[i]] = self._get_column(types[i],
+                    self._convert_other(af, types[i], columns[i]))
+        return data, ordering
+
+
+    def read(self):
+        fp = open(self.fname)
+        af = arff.ArffFile.load_header(fp)
+        if not af.relation:
+            fp.close()
+            raise ml2h5.converter.ConversionError('Not an ARFF file: ' + self.fname)
+
+        try:
+            rows = af.iter_data(fp)
+            block = list(itertools.islice(rows, BLOCK_SIZE))
+            sparse = block and isinstance(block[0], dict)
+            if sparse:
+                data, ordering = self._read_sparse(af, block, rows)
+            else:
+                data, ordering = self._read_dense(af, block, rows)
+        except ValueError as e:
+            raise ml2h5.converter.ConversionError('%s: %s' % (self.fname, e))
+        finally:
+            fp.close()
+
         ddict= {
             'name': af.relation,
             'comment': af.comment,
             'types': self._get_types(af),
-            'names':names,
-            'ordering':copy.copy(names),
+            'names': list(af.attributes),
+            'ordering': ordering,
             'data':data,
         }
         
 
-        if self.merge == True:
+        if self.merge == True and not sparse:
             ddict = self._get_merged(ddict)
         return ddict
-    def check_sparse(self, data):
-        for k in list(data.keys()):
-            d=data[k]
-        if type(d)==csc_matrix:
-            raise ml2h5.converter.ConversionError("Sparse matrices are not supported in ARFF files")
+
+
+    def _iter_sparse_rows(self, data, block_size=ROW_BLOCK_SIZE):
+        """Iterate over blocks of examples as sparse data points.
+
+        Zeros of numeric data are left out, values of other data are
+        always given.
+
+        @param data: data structure as returned by read()
+        @type data: dict
+        @param block_size: number of examples per block
+        @type block_size: integer
+        @return: blocks of data points, dicts of attribute index to value
+        @rtype: generator of list of dict
+        """
+        group = self.get_data_group(data)
+        values = [data[group][o] for o in data['ordering']]
+        x = values[0]
+        num = x.shape[-1] if hasattr(x, 'shape') else len(x)
+
+        for start in range(0, num, block_size):
+            stop = min(start + block_size, num)
+            rows = [{} for j in range(start, stop)]
+            offset = 0
+            for x in values:
+                if type(x) == csc_matrix:
+                    B = x[:, start:stop]
+                    B.sort_indices()
+                    indptr = B.indptr.tolist()
+                    indices = (B.indices + offset).tolist()
+                    for j, row in enumerate(rows):
+                        for k in range(indptr[j], indptr[j+1]):
+                            row[indices[k]] = B.data[k]
+                    offset += x.shape[0]
+                    continue
+
+                if hasattr(x, 'shape'):
+                    block = x[..., start:stop]
+                else:
+                    block = numpy.array(x[start:stop])
+                if len(block.shape) == 1:
+                    block = block.reshape(1, -1)
+                for i, vals in enumerate(block):
+                    if vals.dtype.kind in 'biuf':
+                        js = numpy.nonzero(vals)[0]
+                    else:
+                        js = range(len(vals))
+                    for j in js:
+                        rows[j][offset + i] = vals[j]
+                offset += len(block)
+            yield rows
+
 
     def write(self, data):
         group=self.get_data_group(data)
         d=data[group]
-        self.check_sparse(d)
+        sparse = [o for o in data['ordering'] if type(d[o]) == csc_matrix]
 
         af = arff.ArffFile()
-        af.data = self.get_data_as_list(data)
         if 'names' in data and len(data['names']):
             af.attributes = data['names']
         else:
@@ -134,4 +464,7 @@ class H5_ARFF(BaseHandler):
             else:
                 af.attribute_data[af.attributes[i]] = t[1].split(',')
 
-        af.save(self.fname)
+        if sparse:
+            af.save(self.fname, self._iter_sparse_rows(data))
+        else:
+            af.save(self.fname, self.iter_data_columns(data), columns=True)
@@ -1,22 +1,64 @@
-import numpy, h5py, os, copy, numpy
+import numpy, h5py, os, copy, numpy, itertools, multiprocessing
+try:
+    from multiprocessing import shared_memory
+except ImportError: # python < 3.8
+    shared_memory = None
 from scipy.sparse import csc_matrix
 from ml2h5.converter.basehandler import BaseHandler
 import ml2h5.converter
 
 COMMENT = '# '
 SEPERATOR = ','
+# number of examples to infer column types from when streaming
+SAMPLE_SIZE = 1000
+# number of examples converted at once when streaming
+BLOCK_SIZE = 10000
+
+def _convert_columns(args):
+    """Convert a group of columns in a worker process.
+
+    Numeric columns are written to the shared memory segment at the offset
+    of their column index, so only their names have to be pickled back.
+
+    @param args: filename, name of shared memory, number of examples, index of first column and columns
+    @type args: tuple
+    @return: name of each column and its values if not numeric
+    @rtype: list of tuples
+    """
+    fname, shm_name, num, start, columns = args
+    handler = H5_CSV(fname)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    result = []
+    for i, items in enumerate(columns):
+        name, values = handler._convert_column(start + i, items)
+        if values.dtype in (numpy.int32, numpy.double):
+            out = numpy.ndarray((num,), dtype=values.dtype, buffer=shm.buf,
+                offset=(start + i) * num * 8)
+            out[:] = values
+            del out
+            values = None
+        result.append((name, values))
+    shm.close()
+    return result
+
 
 class H5_CSV(BaseHandler):
     """Handle CSV files.
 
     @ivar attribute_names_first: first line contains attributes
     @type attribute_names_first: boolean
+    @ivar block_size: number of examples converted at once when streaming
+    @type block_size: integer
+    @ivar processes: number of processes to convert columns with, None for serial conversion
+    @type processes: integer
     """
 
     def __init__(self, *args, **kwargs):
         super(H5_CSV, self).__init__(*args, **kwargs)
         self.attribute_names_first = False
         self.seperator = SEPERATOR # maybe more flexible in the future
+        self.block_size = BLOCK_SIZE
+        self.processes = None
 
 
     def _find_nan(self, value):
@@ -36,6 +78,66 @@ class H5_CSV(BaseHandler):
             return str(value)
 
 
+    def _convert_column(self, i, items):
+        """Convert values of column i to their data type.
+
+        @param i: index of column
+        @type i: integer
+        @param items: values of column
+        @type items: list of strings
+        @return: name of column and converted values
+        @rtype: tuple of string and numpy.ndarray
+        """
+        t = self.get_datatype(items)
+        if t == numpy.int32:
+            name = 'int' + str(i)
+        elif t == numpy.double:
+            name = 'double' + str(i)
+        else:
+            name = 'str' + str(i)
+        return name, numpy.array(items).astype(t)
+
+
+    def _convert_columns_parallel(self, A):
+        """Convert columns of A in a pool of self.processes processes.
+
+        Numeric columns are returned through one shared memory segment
+        with room for a double per value; string columns are pickled.
+
+        @param A: values, one column per row
+        @type A: numpy.matrix
+        @return: name and converted values of each column
+        @rtype: list of tuples of string and numpy.ndarray
+        """
+        num_cols, num = A.shape
+        shm = shared_memory.SharedMemory(create=True, size=A.size * 8)
+        try:
+            step = max(1, num_cols // (self.processes * 4))
+            args = [(self.fname, shm.name, num, start, A[start:start+step].tolist())
+                for start in range(0, num_cols, step)]
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                results = pool.map(_convert_columns, args)
+            finally:
+                pool.close()
+                pool.join()
+
+            columns = []
+            i = 0
+            for result in results:
+                for name, values in result:
+                    if values is None:
+                        t = numpy.int32 if name.startswith('int') else numpy.double
+                        values = numpy.ndarray((num,), dtype=t, buffer=shm.buf,
+                            offset=i * num * 8).copy()
+                    columns.append((name, values))
+                    i += 1
+        finally:
+            shm.close()
+            shm.unlink()
+        return columns
+
+
     def read(self):
         """
         """
@@ -59,16 +161,14 @@ class H5_CSV(BaseHandler):
         infile.close()
         A = numpy.matrix(parsed).T
 
-        for i in range(A.shape[0]):
-            items = A[i].tolist()[0]
-            t = self.get_datatype(items)
-            if t == numpy.int32:
-                name = 'int' + str(i)
-            elif t == numpy.double:
-                name = 'double' + str(i)
-            else:
-                name = 'str' + str(i)
-            data[name] = numpy.array(items).astype(t)
+        if self.processes and self.processes > 1 and shared_memory and A.size:
+            columns = self._convert_columns_parallel(A)
+        else:
+            columns = [self._convert_column(i, A[i].tolist()[0])
+                for i in range(A.shape[0])]
+
+        for name, values in columns:
+            data[name] = values
             ordering.append(name)
 
         if not names:
@@ -85,35 +185,226 @@ class H5_CSV(BaseHandler):
             ddict = self._get_merged(ddict)
         return ddict
 
+    def _iter_blocks(self):
+        """Iterate over blocks of parsed examples.
+
+        The first block holds the attribute names if attribute_names_first
+        is set, all others at most self.block_size examples.
+
+        @return: lists of examples, each a list of values
+        @rtype: generator
+        """
+        infile = open(self.fname, 'r')
+        try:
+            lines = (line for line in infile if line != '\n' and line != '\n\r')
+            if self.attribute_names_first:
+                for line in lines:
+                    yield [line.strip().split(self.seperator)]
+                    break
+            while True:
+                block = [list(map(self._find_nan, line.strip().split(self.seperator)))
+                    for line in itertools.islice(lines, self.block_size)]
+                if not block:
+                    break
+                yield block
+        finally:
+            infile.close()
+
+
+    def _get_columns(self, block, num):
+        """Transpose given block of examples into columns.
+
+        @param block: examples, each a list of values
+        @type block: list of lists
+        @param num: expected number of columns
+        @type num: integer
+        @return: columns
+        @rtype: list of tuples
+        """
+        for example in block:
+            if len(example) != num:
+                raise ml2h5.converter.ConversionError(
+                    'Inconsistent number of values in CSV file, expected %d' % num)
+        return list(zip(*block))
+
+
+    def _rescan_columns(self, group, columns, num):
+        """Rewrite the first num values of given columns as strings.
+
+        Numbers already written cannot be turned back into their original
+        text, so they are read again from the CSV file, once for all
+        columns.
+
+        @param group: group of temporary column datasets
+        @type group: h5py.Group
+        @param columns: indices of columns to rewrite
+        @type columns: list of integer
+        @param num: number of examples already written
+        @type num: integer
+        """
+        for column in columns:
+            del group[str(column)]
+        blocks = self._iter_blocks()
+        if self.attribute_names_first:
+            next(blocks)
+        done = 0
+        for block in blocks:
+            block = block[:num - done]
+            for column in columns:
+                values = [example[column] for example in block]
+                self._append_dataset(group, str(column),
+                    numpy.array(values).astype(self.str_type))
+            done += len(block)
+            if done >= num:
+                break
+        blocks.close()
+
+
+    def _append_column(self, group, column, values, dtypes, num):
+        """Append values to column, promoting its type if necessary.
+
+        Types are promoted from int to double to string like
+        BaseHandler.get_datatype would decide on the whole column. A column
+        promoted to string after values were written has to be rewritten
+        by _rescan_columns before its new values are appended, so these are
+        returned instead.
+
+        @param group: group of temporary column datasets
+        @type group: h5py.Group
+        @param column: index of column
+        @type column: integer
+        @param values: values to append
+        @type values: tuple
+        @param dtypes: current types of all columns
+        @type dtypes: list
+        @param num: number of examples already written
+        @type num: integer
+        @return: values still to append after rescanning, or None
+        @rtype: numpy.ndarray
+        """
+        path = str(column)
+        promotion = [numpy.int32, numpy.double, self.str_type]
+        values = numpy.array(values)
+        rescan = False
+        while True:
+            try:
+                converted = values.astype(dtypes[column])
+                # casting NaN (all values missing) or fractions to int does
+                # not fail, but must promote like a failed conversion
+                if converted.dtype.kind == 'i' and values.dtype.kind == 'f' and \
+                        not numpy.array_equal(converted, values):
+                    raise ValueError('non-integral values')
+                break
+            except ValueError:
+                dtypes[column] = promotion[promotion.index(dtypes[column]) + 1]
+                if not num:
+                    continue
+                if dtypes[column] == numpy.double:
+                    old = group[path][...]
+                    del group[path]
+                    self._append_dataset(group, path, old.astype(numpy.double))
+                else:
+                    rescan = True
+        if rescan:
+            return converted
+        self._append_dataset(group, path, converted)
+
+
+    def stream_to_h5(self, fname):
+        """Convert CSV file to HDF5 block by block.
+
+        Column types are inferred from the first SAMPLE_SIZE examples and
+        promoted lazily if a later block disagrees. Columns are collected
+        in chunked datasets of a temporary HDF5 file and finally copied,
+        merged if self.merge is set, into the layout BaseHandler.write
+        produces for data returned by read().
+
+        @param fname: name of HDF5 file to write
+        @type fname: string
+        """
+        fname_tmp = fname + '.tmp'
+        tmp = h5py.File(fname_tmp, 'w')
+        h5 = None
+        try:
+            group = tmp.create_group('columns')
+            names = []
+            dtypes = None
+            num = 0
+            blocks = self._iter_blocks()
+            if self.attribute_names_first:
+                names = next(blocks, [[]])[0]
+            for block in blocks:
+                if dtypes is None:
+                    sample = self._get_columns(block[:SAMPLE_SIZE], len(block[0]))
+                    dtypes = [self.get_datatype(values) for values in sample]
+                pending = {}
+                for i, values in enumerate(self._get_columns(block, len(dtypes))):
+                    rest = self._append_column(group, i, values, dtypes, num)
+                    if rest is not None:
+                        pending[i] = rest
+                if pending:
+                    self._rescan_columns(group, sorted(pending), num)
+                    for i, rest in pending.items():
+                        self._append_dataset(group, str(i), rest)
+                num += len(block)
+
+            ordering = []
+            for i, t in enumerate(dtypes or []):
+                if t == numpy.int32:
+                    ordering.append('int' + str(i))
+                elif t == numpy.double:
+                    ordering.append('double' + str(i))
+                else:
+                    ordering.append('str' + str(i))
+            if not names:
+                names = copy.copy(ordering)
+
+            if self.merge == True:
+                layout = self._get_merged_layout(ordering, dtypes)
+            else:
+                layout = [(o, [i]) for i, o in enumerate(ordering)]
+
+            h5 = h5py.File(fname, 'w')
+            self._write_attrs(h5, {'name': self.get_name(), 'comment': 'CSV'})
+            out = h5.create_group('/data')
+            for path, columns in layout:
+                t = dtypes[columns[0]]
+                if len(columns) == 1:
+                    shape = (num,)
+                else:
+                    shape = (len(columns), num)
+                dset = out.create_dataset(path, shape, dtype=t,
+                    chunks=self._get_chunks(shape, numpy.dtype(t)),
+                    **self._get_filters())
+                for start in range(0, num, self.block_size):
+                    end = min(start + self.block_size, num)
+                    values = [group[str(i)][start:end] for i in columns]
+                    if len(columns) == 1:
+                        dset[start:end] = values[0]
+                    else:
+                        dset[:, start:end] = numpy.array(values).astype(t)
+            self._write_descr(h5, {'names': names,
+                'ordering': [path for path, columns in layout]})
+        except: # just do some clean-up
+            if h5:
+                h5.close()
+                os.remove(fname)
+            raise
+        else:
+            h5.close()
+        finally:
+            tmp.close()
+            os.remove(fname_tmp)
+
+
     def write(self, data):
-        lengths=dict()
         for o in data['ordering']:
-            try:
-                lengths[o]=data['data'][o].shape[1]
-            except (AttributeError, IndexError):
-                lengths[o]=len(data['data'][o])
-        l=set(lengths.values())
-        assert(len(l)==1)
-        l=l.pop()
+            if type(data['data'][o])==csc_matrix:
+                raise ml2h5.converter.ConversionError("Sparse matrices are not supported in CSV files")
 
         csv = open(self.fname, 'w')
-        for i in range(l):
-            line=[]
-            for o in data['ordering']:
-                d=data['data'][o]
-                if type(d)==csc_matrix:
-                    raise ml2h5.converter.ConversionError("Sparse matrices are not supported in CSV files")
-                try:
-                    line.extend(list(map(str, d[:,i])))
-                except:
-                    try:
-                        if len(d[i]):
-                            line.append(str(d[i]))
-                        else:
-                            line.append('')
-                    except TypeError:
-                        line.append(str(d[i]))
-            csv.write(self.seperator.join(line) + "\n")
+        for rows in self.iter_data_rows(data):
+            csv.write(''.join([self.seperator.join(map(str, row)) + "\n" for row in rows]))
         csv.close()
 
         return True
@@ -1,8 +1,40 @@
-import numpy, h5py, os, copy
+import numpy, h5py, os, copy, itertools, multiprocessing
 from scipy.sparse import csc_matrix
 from ml2h5.converter.basehandler import BaseHandler
 import ml2h5.converter
 
+# number of examples parsed at once
+BLOCK_SIZE = 100000
+# number of values formatted at once when writing
+WRITE_BLOCK_VALUES = 1000000
+
+
+def _parse_shard(args):
+    """Parse a newline aligned byte range of a LibSVM file.
+
+    Module level function, so it can be run by a multiprocessing worker.
+
+    @param args: filename, first and last byte, parser and block size
+    @type args: tuple
+    @return: if multilabel and concatenated pieces as returned by H5_LibSVM._parse_lines
+    @rtype: tuple
+    """
+    fname, start, end, parser, block_size = args
+    handler = H5_LibSVM(fname)
+    handler.parser = parser
+    handler.block_size = block_size
+
+    fp = open(fname, 'rb')
+    fp.seek(start)
+    lines = fp.read(end - start).decode().splitlines(True)
+    fp.close()
+
+    blocks = []
+    for i in range(0, len(lines), block_size):
+        blocks.append(handler._parse_lines(lines[i:i+block_size]))
+    del lines
+    return handler.is_multilabel, handler._concatenate(blocks)
+
 
 class H5_LibSVM(BaseHandler):
     """Handle LibSVM files."""
@@ -12,89 +44,408 @@ class H5_LibSVM(BaseHandler):
 
         @ivar is_multilabel: if data is of type multilabel
         @type is_multilabel: boolean
+        @ivar block_size: number of examples parsed at once
+        @type block_size: integer
+        @ivar parser: parser backend, 'numpy' (vectorized) or 'python'
+        @type parser: string
+        @ivar processes: number of worker processes to parse with, None for serial parsing
+        @type processes: integer
+        @ivar memory_budget: maximum size in bytes of data converted to a dense matrix
+        @type memory_budget: integer
         """
         super(H5_LibSVM, self).__init__(*args, **kwargs)
         self.is_multilabel = False
+        self.block_size = BLOCK_SIZE
+        self.parser = 'numpy'
+        self.processes = None
+        self.memory_budget = ml2h5.converter.MEMORY_BUDGET
 
     def convert_sparse(self, spmatrix):
-        assert(type(spmatrix==csc_matrix))
+        """Convert given sparse matrix to a dense one where appropriate.
+
+        The matrix is densified if at least half of its entries are non-zero
+        and the dense matrix fits into self.memory_budget bytes. The dense
+        matrix is filled column block by column block into a preallocated
+        Fortran-ordered array, so no intermediate dense matrix is created.
+
+        @param spmatrix: sparse matrix to convert
+        @type spmatrix: scipy.sparse.csc_matrix
+        @return: sparse or dense matrix
+        @rtype: scipy.sparse.csc_matrix/numpy.ndarray
+        """
+        assert(type(spmatrix)==csc_matrix)
 
         A=spmatrix
-        if A.nnz/numpy.double(A.shape[0]*A.shape[1]) < 0.5: # sparse
-            return spmatrix
+        rows, cols = A.shape
+        if A.nnz < 0.5 * rows * cols: # sparse
+            return A
+        if rows * cols * A.dtype.itemsize > self.memory_budget:
+            return A
 
-        return numpy.array(A.todense())
+        A.sum_duplicates()
+        dense = numpy.zeros(A.shape, dtype=A.dtype, order='F')
+        for start in range(0, cols, self.block_size):
+            end = min(start + self.block_size, cols)
+            first, last = A.indptr[start], A.indptr[end]
+            col = numpy.repeat(numpy.arange(start, end), numpy.diff(A.indptr[start:end+1]))
+            dense[A.indices[first:last], col] = A.data[first:last]
+        return dense
 
     def get_comment(self):
         return 'LibSVM'
 
-    def read(self):
-        """Retrieves a SciPy Compressed Sparse Column matrix and labels from file.
-        @return: compressed sparse column matrix + labels
-        @rtype: list of scipy.sparse.csc_matrix and label tuple/2-d tuple (multilabel)
-        """
-        indices_var = []
-        indptr_var = [0]
-        ptr_var = 0
-        data_var = []
+    def _parse_lines_python(self, lines):
+        """Parse given LibSVM lines into the pieces of a CSC matrix.
 
-        indices_lab = []
-        indptr_lab = [0]
-        ptr_lab = 0
-        data_lab = []
+        Pure Python parser, used as fallback for inputs the vectorized
+        parser cannot handle.
 
-        label = []
+        @param lines: lines of a LibSVM file
+        @type lines: list of strings
+        @return: labels, number of labels per example, data, indices and number of non-zeros per example
+        @rtype: tuple of numpy.ndarray
+        """
+        labels = []
+        label_counts = []
+        indices = []
+        data = []
+        counts = []
 
-        for line in file(self.fname):
+        for line in lines:
             items = line.split()
             lab=items[0]
             dat=items[1:]
 
             lab=[int(float(i)) for i in lab.split(',')]
-
             if len(lab)>1:
                 self.is_multilabel = True
-
-            if self.is_multilabel:
-                for idx in lab:
-                    indices_lab.append(idx)
-                    data_lab.append(1.)
-                    ptr_lab += 1
-                indptr_lab.append(ptr_lab)
-            else: # only single label -> value is actual value
-                label.append(lab[0])
+            labels.extend(lab)
+            label_counts.append(len(lab))
 
             for d in dat:
                 v=d.split(':')
-                indices_var.append(int(v[0]) - 1)
-                data_var.append(numpy.double(v[1]))
-                ptr_var += 1
-            indptr_var.append(ptr_var)
-
-        if self.is_multilabel:
-            data_lab=numpy.array(data_lab)
-            indices_lab=numpy.array(indices_lab)
-            indptr_lab=numpy.array(indptr_lab)
-            label = csc_matrix( (data_lab, indices_lab, indptr_lab)  )
-            label.sort_indices()
+                indices.append(int(v[0]) - 1)
+                data.append(numpy.double(v[1]))
+            counts.append(len(dat))
+
+        return (numpy.array(labels, dtype=numpy.int64),
+            numpy.array(label_counts, dtype=numpy.int64),
+            numpy.array(data, dtype=numpy.double),
+            numpy.array(indices, dtype=numpy.int32),
+            numpy.array(counts, dtype=numpy.int64))
+
+
+    def _parse_lines_numpy(self, lines):
+        """Parse given LibSVM lines into the pieces of a CSC matrix.
+
+        The whole block is tokenized at once: after turning ':' into
+        whitespace, every line consists of its label followed by
+        index/value pairs, so labels, indices and values can be picked from
+        one numpy.fromstring result by the number of pairs per line.
+        Multilabel rows and malformed input are left to
+        _parse_lines_python.
+
+        @param lines: lines of a LibSVM file
+        @type lines: list of strings
+        @return: labels, number of labels per example, data, indices and number of non-zeros per example
+        @rtype: tuple of numpy.ndarray
+        """
+        block = ''.join(lines)
+        if ',' in block:
+            return self._parse_lines_python(lines)
+
+        counts = numpy.array([line.count(':') for line in lines], dtype=numpy.int64)
+        # each line must be its label and one index:value item per ':',
+        # otherwise errors of different lines could balance out
+        items = numpy.array([len(line.split()) for line in lines], dtype=numpy.int64)
+        if (items != 1 + counts).any():
+            return self._parse_lines_python(lines)
+        tokens = numpy.fromstring(block.replace(':', ' '), dtype=numpy.double, sep=' ')
+        if len(tokens) != len(lines) + 2 * counts.sum():
+            return self._parse_lines_python(lines)
+
+        # position of each label within tokens
+        starts = numpy.zeros(len(lines), dtype=numpy.int64)
+        numpy.cumsum(1 + 2 * counts[:-1], out=starts[1:])
+        is_label = numpy.zeros(len(tokens), dtype=bool)
+        is_label[starts] = True
+
+        labels = tokens[starts]
+        pairs = tokens[~is_label]
+        indices = pairs[0::2]
+        if not numpy.isfinite(labels).all() or (indices != numpy.floor(indices)).any():
+            return self._parse_lines_python(lines)
+
+        return (labels.astype(numpy.int64),
+            numpy.ones(len(lines), dtype=numpy.int64),
+            pairs[1::2].copy(),
+            (indices - 1).astype(numpy.int32),
+            counts)
+
+
+    def _parse_lines(self, lines):
+        """Parse given LibSVM lines with the configured parser.
+
+        @param lines: lines of a LibSVM file
+        @type lines: list of strings
+        @return: labels, number of labels per example, data, indices and number of non-zeros per example
+        @rtype: tuple of numpy.ndarray
+        """
+        if self.parser == 'numpy':
+            return self._parse_lines_numpy(lines)
+        elif self.parser == 'python':
+            return self._parse_lines_python(lines)
         else:
-            label = numpy.array(label)
+            raise ml2h5.converter.ConversionError('Unknown LibSVM parser %s' % self.parser)
+
+
+    def _iter_blocks(self, fp):
+        """Iterate over blocks of self.block_size lines of given file.
+
+        @param fp: opened LibSVM file
+        @type fp: file
+        @return: lists of lines
+        @rtype: generator
+        """
+        while True:
+            lines = list(itertools.islice(fp, self.block_size))
+            if not lines:
+                break
+            yield lines
+
+
+    def _get_label(self, labels, label_counts):
+        """Get label from labels as parsed by _parse_lines.
+
+        @param labels: labels of all examples
+        @type labels: numpy.ndarray
+        @param label_counts: number of labels per example
+        @type label_counts: numpy.ndarray
+        @return: label vector or label matrix (multilabel)
+        @rtype: numpy.ndarray/scipy.sparse.csc_matrix
+        """
+        if not self.is_multilabel:
+            return labels
+
+        indptr = numpy.zeros(len(label_counts) + 1, dtype=numpy.int64)
+        numpy.cumsum(label_counts, out=indptr[1:])
+        label = csc_matrix((numpy.ones(len(labels)), labels, indptr))
+        label.sort_indices()
+        return label
+
+
+    def _concatenate(self, blocks):
+        """Concatenate pieces of several blocks as returned by _parse_lines.
+
+        @param blocks: parsed blocks
+        @type blocks: list of tuples
+        @return: labels, number of labels per example, data, indices and number of non-zeros per example
+        @rtype: list of numpy.ndarray
+        """
+        if not blocks:
+            return [numpy.array([]) for i in range(5)]
+        return [numpy.concatenate(pieces) for pieces in zip(*blocks)]
+
 
-        data = csc_matrix( (numpy.array(data_var), numpy.array(indices_var),
-            numpy.array(indptr_var)) )
+    def _get_shards(self, num):
+        """Split file into num newline aligned byte ranges.
+
+        @param num: number of shards
+        @type num: integer
+        @return: start and end byte of each shard
+        @rtype: list of tuples of integer
+        """
+        size = os.path.getsize(self.fname)
+        offsets = [0]
+        fp = open(self.fname, 'rb')
+        for i in range(1, num):
+            fp.seek(max(i * size // num, offsets[-1]))
+            fp.readline()
+            offsets.append(min(fp.tell(), size))
+        fp.close()
+        offsets.append(size)
+        return [(offsets[i], offsets[i+1]) for i in range(num)
+            if offsets[i] < offsets[i+1]]
+
+
+    def _parse_file(self):
+        """Parse the whole file, in self.processes worker processes if set.
+
+        Shards are parsed independently; as indptr is built from the number
+        of non-zeros per example after stitching, no further row offset
+        fix-up is needed.
+
+        @return: labels, number of labels per example, data, indices and number of non-zeros per example
+        @rtype: list of numpy.ndarray
+        """
+        if not self.processes or self.processes < 2:
+            blocks = []
+            fp = open(self.fname, 'r')
+            for lines in self._iter_blocks(fp):
+                blocks.append(self._parse_lines(lines))
+            fp.close()
+            return self._concatenate(blocks)
+
+        args = [(self.fname, start, end, self.parser, self.block_size)
+            for start, end in self._get_shards(self.processes)]
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            shards = pool.map(_parse_shard, args)
+        finally:
+            pool.close()
+            pool.join()
+
+        for is_multilabel, pieces in shards:
+            if is_multilabel:
+                self.is_multilabel = True
+        return self._concatenate([pieces for is_multilabel, pieces in shards])
+
+
+    def read(self):
+        """Retrieves a SciPy Compressed Sparse Column matrix and labels from file.
+        @return: compressed sparse column matrix + labels
+        @rtype: list of scipy.sparse.csc_matrix and label tuple/2-d tuple (multilabel)
+        """
+        labels, label_counts, data_var, indices_var, counts_var = self._parse_file()
+        label = self._get_label(labels, label_counts)
+
+        indptr_var = numpy.zeros(len(counts_var) + 1, dtype=numpy.int64)
+        numpy.cumsum(counts_var, out=indptr_var[1:])
+        data = csc_matrix((data_var, indices_var, indptr_var))
 
         data = self.convert_sparse(data)
 
         return {
             'name': self.get_name(),
-            'comment': 'LibSVM',
+            'comment': self.get_comment(),
             'ordering': ['label', 'data'],
             'names': [],
             'data': { 'label' : label, 'data' : data}
         }
 
 
+    def stream_to_h5(self, fname):
+        """Convert LibSVM file to HDF5 block by block.
+
+        Each block of self.block_size examples is parsed and its CSC pieces
+        are appended to chunked datasets, so peak memory is bounded by the
+        block size instead of the file size. The layout is the one written by
+        BaseHandler.write for sparse data, but data is never densified.
+
+        @param fname: name of HDF5 file to write
+        @type fname: string
+        """
+        h5 = h5py.File(fname, 'w')
+        try:
+            self._write_attrs(h5, {'name': self.get_name(), 'comment': self.get_comment()})
+            group = h5.create_group('/data')
+            num = 0
+            nnz = 0
+
+            fp = open(self.fname, 'r')
+            for lines in self._iter_blocks(fp):
+                was_multilabel = self.is_multilabel
+                labels, label_counts, dat, ind, cnt = self._parse_lines(lines)
+
+                if self.is_multilabel and not was_multilabel and num:
+                    # previous labels were single labels, turn them into CSC
+                    prev = group['label'][...]
+                    del group['label']
+                    self._append_dataset(group, 'label_indices', prev)
+                    self._append_dataset(group, 'label_indptr', numpy.arange(num + 1))
+                    self._append_dataset(group, 'label', numpy.ones(num))
+
+                label = self._get_label(labels, label_counts)
+                if self.is_multilabel:
+                    offset = 0
+                    if 'label_indptr' in group:
+                        offset = group['label_indptr'][-1]
+                    else:
+                        self._append_dataset(group, 'label_indptr', label.indptr[:1])
+                    self._append_dataset(group, 'label_indices', label.indices)
+                    self._append_dataset(group, 'label_indptr', label.indptr[1:] + offset)
+                    self._append_dataset(group, 'label', label.data)
+                else:
+                    self._append_dataset(group, 'label', label)
+
+                indptr = numpy.cumsum(cnt) + nnz
+                if not num:
+                    indptr = numpy.concatenate(([0], indptr))
+                self._append_dataset(group, 'data_indices', ind)
+                self._append_dataset(group, 'data_indptr', indptr)
+                self._append_dataset(group, 'data', dat)
+
+                num += len(cnt)
+                nnz += len(dat)
+            fp.close()
+
+            self._write_descr(h5, {'names': [], 'ordering': ['label', 'data']})
+        except: # just do some clean-up
+            h5.close()
+            os.remove(fname)
+            raise
+        else:
+            h5.close()
+
+
+    def _format_labels(self, label, start, end):
+        """Format labels of examples start to end.
+
+        @param label: label vector or label matrix (multilabel)
+        @type label: numpy.ndarray/scipy.sparse.csc_matrix
+        @param start: first example
+        @type start: integer
+        @param end: example after the last one
+        @type end: integer
+        @return: formatted labels
+        @rtype: list of strings
+        """
+        if not self.is_multilabel:
+            return list(map(str, label[start:end]))
+
+        indptr=label.indptr
+        indices=label.indices
+        return [','.join(map(str, indices[indptr[i]:indptr[i+1]]))
+            for i in range(start, end)]
+
+
+    def _format_block(self, label, d, start, end):
+        """Format examples start to end as LibSVM lines.
+
+        A single format string is built for the whole block and applied to
+        all values at once, so the per-value work happens in C.
+
+        @param label: label vector or label matrix (multilabel)
+        @type label: numpy.ndarray/scipy.sparse.csc_matrix
+        @param d: data with one example per column
+        @type d: scipy.sparse.csc_matrix/numpy.ndarray
+        @param start: first example
+        @type start: integer
+        @param end: example after the last one
+        @type end: integer
+        @return: formatted lines
+        @rtype: string
+        """
+        labels = [lab.replace('%', '%%') for lab in self._format_labels(label, start, end)]
+
+        if type(d)==csc_matrix:
+            first, last = d.indptr[start], d.indptr[end]
+            counts = numpy.diff(d.indptr[start:end+1])
+            fmt = [lab + ' %d:%.15g' * c + '\n' for lab, c in zip(labels, counts)]
+            values = numpy.empty(2 * (last - first), dtype=object)
+            values[0::2] = d.indices[first:last] + 1
+            values[1::2] = d.data[first:last]
+        else: # dense
+            entries = ''.join([' %d:%%s' % (j+1) for j in range(len(d))])
+            fmt = [lab + entries + '\n' for lab in labels]
+            # numpy scalars keep str() of the elements as before
+            values = d[:, start:end].ravel(order='F')
+
+        return ''.join(fmt) % tuple(values)
+
+
     def write(self, data):
+        data=self._load_proxies(data)
         ordering=('label','data')
         if not set(data['data'].keys()).issubset(set(ordering)):
             raise ml2h5.converter.ConversionError('libsvm format needs data or label')
@@ -121,37 +472,17 @@ class H5_LibSVM(BaseHandler):
         assert(len(l)==1)
         l=l.pop()
 
-        for i in range(l):
-            out = []
-            for o in ordering:
-                d=data['data'][o]
-                if o == 'label':
-                    if self.is_multilabel:
-                        labels = []
-                        indptr=d.indptr
-                        indices=d.indices
-                        dat=d.data
-                        for j in range(indptr[i],indptr[i+1]):
-                            labels.append(str(indices[j]))
-
-                        out.append(','.join(labels))
-                    else:
-                        out.append(str(d[i]))
-                else: #data
-                    if type(d)==csc_matrix:
-                        indptr=d.indptr
-                        indices=d.indices
-                        dat=d.data
-                        for j in range(indptr[i],indptr[i+1]):
-                            if dat[j]==int:
-                                out.append('%d:%d' % (indices[j]+1,dat[j]))
-                            else:
-                                out.append('%d:%.15g' % (indices[j]+1,dat[j]))
-                    else: # dense
-                        for j in range(len(d)):
-                            out.append(str(j+1) + ':' + str(d[j,i]))
-            libsvm.write(" ".join(out) + "\n")
+        label=data['data']['label']
+        d=data['data']['data']
+        if type(d)==csc_matrix:
+            per_example = d.nnz // max(l, 1) + 1
+        else:
+            per_example = len(d) + 1
+        step = max(1, WRITE_BLOCK_VALUES // per_example)
 
+        for start in range(0, l, step):
+            end = min(start + step, l)
+            libsvm.write(self._format_block(label, d, start, end))
         libsvm.close()
 
         return True
@@ -1,6 +1,9 @@
-import h5py, numpy
-from scipy.io import savemat, loadmat
-from ml2h5.converter.basehandler import BaseHandler
+import os, time, h5py, numpy
+from scipy.io import savemat, loadmat, whosmat
+from scipy.sparse import csc_matrix
+from ml2h5.converter.basehandler import BaseHandler, DatasetProxy, SparseProxy
+from ml2h5.converter import WRITE_BLOCK_BYTES
+import ml2h5.converter
 
 import sys
 if sys.version < '3':
@@ -10,20 +13,153 @@ else:
     def u(x):
         return str(x)
 
+# MATLAB 5 files cannot hold variables of 2 GB or more
+V5_MAX_BYTES = 2**31 - 1
+# MATLAB 7.3 files are HDF5 files behind a user block starting with a header
+MAT73_USERBLOCK_SIZE = 512
+MAT73_HEADER = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: %s HDF5 schema 1.00 .'
+# MATLAB classes of numpy types
+MAT73_CLASSES = {
+    'float64': 'double', 'float32': 'single', 'bool': 'logical',
+    'int8': 'int8', 'int16': 'int16', 'int32': 'int32', 'int64': 'int64',
+    'uint8': 'uint8', 'uint16': 'uint16', 'uint32': 'uint32', 'uint64': 'uint64',
+}
+
+
+def is_mat73(fname):
+    """Check if given file is a MATLAB 7.3 (HDF5 based) file.
+
+    @param fname: name of file to check
+    @type fname: string
+    @return: if file is a MATLAB 7.3 file
+    @rtype: boolean
+    """
+    try:
+        f = open(fname, 'rb')
+        header = f.read(10)
+        f.close()
+    except IOError:
+        return False
+    return header == b'MATLAB 7.3' and h5py.is_hdf5(fname)
+
 
 class H5_MAT(BaseHandler):
-    """Handle Matlab files."""
+    """Handle Matlab files.
+
+    MATLAB 5 files are read and written with scipy.io. MATLAB 7.3 files,
+    being HDF5 files, are read and written with h5py directly, variable by
+    variable; they are written if version is '7.3' or a variable is too
+    large for MATLAB 5. MATLAB itself only reads gzip compressed data.
+
+    Only the variables listed in mldata_descr_ordering are read, or those
+    given by variables.
+
+    @ivar version: version of MATLAB files to write, '5' or '7.3'
+    @type version: string
+    @ivar variables: names of variables to read, None for the default
+    @type variables: list of strings
+    """
 
     def __init__(self, *args, **kwargs):
         super(H5_MAT, self).__init__(*args, **kwargs)
+        self.version = '5'
+        self.variables = None
+
+
+    def _get_ordering(self, names):
+        """Get ordering of variables by the index in their names, if any.
+
+        @param names: names of variables
+        @type names: list of strings
+        @return: sorted names
+        @rtype: list of strings
+        """
+        def strip_type(x):
+            for prefix in ('double', 'int', 'str'):
+                if x.startswith(prefix) and x[len(prefix):].isdigit():
+                    return (0, int(x[len(prefix):]), x)
+            return (1, 0, x)
+        return sorted(names, key=strip_type)
+
+
+    def _decode_cell(self, A):
+        """Decode a cell array of strings as read by loadmat.
+
+        All cells holding one string each are joined in one pass, only cells
+        of empty or non-string values are converted one by one.
+
+        @param A: cell array, elements being arrays
+        @type A: numpy.ndarray
+        @return: strings
+        @rtype: list of strings
+        """
+        elements = A.ravel().tolist()
+        if elements:
+            strings = numpy.concatenate([e.ravel() for e in elements])
+            if len(strings) == len(elements) and strings.dtype.kind == 'U':
+                return strings.tolist()
+        cell = []
+        for i in elements:
+            if len(i) and len(i[0]):
+                cell.append(str(i[0]))
+            else:
+                cell.append('')
+        return cell
+
+
+    def _select_variables(self, names, ordering):
+        """Select variables to read and their ordering.
+
+        These are the variables requested by variables, else those in
+        mldata_descr_ordering, else all. Requested variables are ordered as
+        in mldata_descr_ordering, those not in it following.
+
+        @param names: names of variables in file
+        @type names: list of strings
+        @param ordering: ordering stored in file, or None
+        @type ordering: list of strings
+        @return: names of variables to read and their ordering
+        @rtype: tuple of list of strings
+        """
+        if self.variables is not None:
+            for name in self.variables:
+                if name not in names:
+                    raise ml2h5.converter.ConversionError('variable %s not found' % name)
+            if ordering is None:
+                ordering = list(self.variables)
+            else:
+                # stored order for the variables it lists, the others after
+                ordering = [o for o in ordering if o in self.variables] + \
+                    [v for v in self.variables if v not in ordering]
+            return ordering, ordering
+        elif ordering is not None:
+            return [o for o in ordering if o in names], ordering
+
+        names = [n for n in names if n != 'mldata_descr_ordering']
+        return names, self._get_ordering(names)
 
 
     def read(self):
-        matf = loadmat(self.fname,
-                squeeze_me=False,
-                chars_as_strings=True,
-                mat_dtype=True,
-                struct_as_record=True)
+        if is_mat73(self.fname):
+            return self._read_mat73()
+
+        kwargs = {
+            'squeeze_me': False,
+            'chars_as_strings': True,
+            'mat_dtype': True,
+            'struct_as_record': True,
+        }
+        names = [v[0] for v in whosmat(self.fname)]
+        ordering = None
+        if 'mldata_descr_ordering' in names:
+            ordering = loadmat(self.fname, variable_names=['mldata_descr_ordering'],
+                **kwargs)['mldata_descr_ordering']
+            ordering = self._decode_cell(ordering)
+        names, ordering = self._select_variables(names, ordering)
+        if names:
+            matf = loadmat(self.fname, variable_names=names, **kwargs)
+        else:
+            matf = {}
 
         for k in ('__header__', '__globals__', '__version__'):
             if k in matf:
@@ -31,34 +167,136 @@ class H5_MAT(BaseHandler):
 
         for k in list(matf.keys()):
             if matf[k].dtype == numpy.object: # asume cell of strings
-                cell = []
-                for i in matf[k][0]:
-                    if len(i[0]):
-                        cell.append(str(i[0]))
-                    else:
-                        cell.append('')
-                matf[k]=cell
+                matf[k] = self._decode_cell(matf[k])
             elif matf[k].shape[0] == 1: # row vectors are expanded
                 matf[k]=matf[k][0]
 
-        data = matf
-        if 'mldata_descr_ordering' in matf:
-            ordering = matf['mldata_descr_ordering']
-            del(matf['mldata_descr_ordering'])
-            
-        else:        
-            ordering = list(matf.keys())
-
-            def strip_type(x):
-                if x.startswith('double'):
-                    return int(x[6:])
-                elif x.startswith('int'):
-                    return int(x[3:])
-                elif x.startswith('str'):
-                    return int(x[3:])
+        return {
+            'name': self.get_name(),
+            'comment': 'matlab',
+            'names': [],
+            'ordering': ordering,
+            'data': matf,
+        }
+
+
+    def _read_mat73_char(self, dset):
+        """Read a char array of a MATLAB 7.3 file.
+
+        @param dset: dataset of UTF-16 code units, MATLAB rows being columns
+        @type dset: h5py.Dataset
+        @return: string, or array of strings for several rows
+        @rtype: string or numpy.ndarray
+        """
+        if dset.attrs.get('MATLAB_empty', 0):
+            return ''
+        A = dset[...]
+        if len(A.shape) < 2:
+            A = A.reshape(-1, 1)
+        rows = [numpy.ascontiguousarray(A[:, i], dtype=numpy.uint16).tobytes().decode('utf-16-le')
+                for i in range(A.shape[1])]
+        if len(rows) == 1:
+            return rows[0]
+        return numpy.array(rows)
+
+
+    def _read_mat73_cell(self, h5, dset):
+        """Read a cell array of strings of a MATLAB 7.3 file.
+
+        Cells referring to the same char array are decoded only once.
+
+        @param h5: opened MATLAB 7.3 file
+        @type h5: h5py.File
+        @param dset: dataset of references to char arrays
+        @type dset: h5py.Dataset
+        @return: strings
+        @rtype: list of strings
+        """
+        # object references are addresses, so equal ones refer to the same array
+        addresses = numpy.empty(dset.shape, dtype=numpy.uint64)
+        dset.id.read(h5py.h5s.ALL, h5py.h5s.ALL, addresses, mtype=h5py.h5t.STD_REF_OBJ)
+        first, inverse = numpy.unique(addresses.T.ravel(),
+            return_index=True, return_inverse=True)[1:]
+        refs = dset[...].T.ravel()
+        decoded = [self._read_mat73_char(h5[refs[i]]) for i in first]
+        return [decoded[i] for i in inverse]
+
+
+    def _read_mat73_var(self, h5, obj):
+        """Read a variable of a MATLAB 7.3 file.
+
+        Dense arrays are transposed views of the data read, as MATLAB stores
+        them in column-major order.
+
+        @param h5: opened MATLAB 7.3 file
+        @type h5: h5py.File
+        @param obj: dataset or group (sparse matrix) of the variable
+        @type obj: h5py.Dataset or h5py.Group
+        @return: data of the variable, None if not supported
+        @rtype: numpy.ndarray, csc_matrix or list of strings
+        """
+        mclass = obj.attrs.get('MATLAB_class', b'')
+        if isinstance(mclass, bytes):
+            mclass = mclass.decode('ascii')
+
+        if isinstance(obj, h5py.Group):
+            if 'MATLAB_sparse' not in obj.attrs:
+                return None # structs are not supported
+            jc = obj['jc'][...]
+            if 'data' in obj:
+                values = obj['data'][...]
+                ir = obj['ir'][...]
+            else: # all zero
+                values = numpy.zeros(0)
+                ir = numpy.zeros(0, dtype=numpy.int64)
+            if mclass == 'logical':
+                values = values.astype(bool)
+            return csc_matrix((values, ir, jc),
+                shape=(int(obj.attrs['MATLAB_sparse']), len(jc) - 1))
+
+        if mclass == 'cell':
+            return self._read_mat73_cell(h5, obj)
+        elif mclass == 'char':
+            return self._read_mat73_char(obj)
+        elif mclass not in MAT73_CLASSES.values():
+            return None
+
+        if obj.attrs.get('MATLAB_empty', 0):
+            A = numpy.zeros(tuple(obj[...]), dtype=numpy.double)
+        else:
+            A = obj[...].T
+        if mclass == 'logical':
+            A = A.astype(bool)
+        if len(A.shape) == 2 and A.shape[0] == 1: # row vectors are expanded
+            A = A[0]
+        return A
+
+
+    def _read_mat73(self):
+        """Read a MATLAB 7.3 file.
+
+        @return: data structure as returned by read()
+        @rtype: dict
+        """
+        h5 = h5py.File(self.fname, 'r')
+        data = {}
+        try:
+            # references and subsystem
+            names = [n for n in h5.keys() if not n.startswith('#')]
+            ordering = None
+            if 'mldata_descr_ordering' in names:
+                ordering = self._read_mat73_var(h5, h5['mldata_descr_ordering'])
+            names, ordering = self._select_variables(names, ordering)
+            for name in names:
+                val = self._read_mat73_var(h5, h5[name])
+                if val is None:
+                    self.warn('unsupported variable %s' % name)
                 else:
-                    return x
-            ordering.sort(cmp=lambda x,y: cmp(strip_type(x),strip_type(y)))
+                    data[name] = val
+        finally:
+            h5.close()
+
+        ordering = [o for o in ordering if o in data]
         return {
             'name': self.get_name(),
             'comment': 'matlab',
@@ -68,14 +306,35 @@ class H5_MAT(BaseHandler):
         }
 
 
+    def _get_nbytes(self, val):
+        """Get number of bytes a variable takes in memory.
+
+        @param val: variable
+        @return: number of bytes
+        @rtype: integer
+        """
+        if isinstance(val, (csc_matrix, SparseProxy)):
+            return val.nnz * (val.dtype.itemsize + 8)
+        if hasattr(val, 'shape') and hasattr(val, 'dtype'):
+            return int(numpy.prod(val.shape)) * val.dtype.itemsize
+        return 0
+
+
     def write(self, data):
         group=self.get_data_group(data)
+        if self.version == '7.3' or \
+                max([self._get_nbytes(v) for v in data[group].values()] + [0]) > V5_MAX_BYTES:
+            return self._write_mat73(data)
+
+        data=self._load_proxies(data)
         d=data[group]
         for k in list(d.keys()):
-            if type(d[k])==list and len(d[k])>0 and type(d[k][0])==str:
-                cell = array([ numpy.array(u(i)) for i in d[k] ], dtype=numpy.object)
+            if type(d[k])==list and len(d[k])>0 and isinstance(d[k][0], str):
+                cell = numpy.empty((1,len(d[k])), dtype=numpy.object)
+                for i in range(len(d[k])):
+                    cell[0,i]=numpy.array(u(d[k][i]), dtype='U')
                 d[k] = cell
-            elif type(d[k])==numpy.ndarray and len(d[k])>0 and type(d[k][0])==str:
+            elif type(d[k])==numpy.ndarray and len(d[k])>0 and isinstance(d[k][0], str):
                 cell = numpy.empty((1,len(d[k])), dtype=numpy.object)
                 for i in range(len(d[k])):
                     cell[0,i]=numpy.array(u(d[k][i]), dtype='U')
@@ -92,3 +351,225 @@ class H5_MAT(BaseHandler):
                 oned_as='row',
                 format='5',
                 long_field_names=True)
+
+
+    def _set_mat73_class(self, obj, mclass):
+        """Set the MATLAB class of a dataset or group.
+
+        @param obj: dataset or group
+        @type obj: h5py.Dataset or h5py.Group
+        @param mclass: MATLAB class
+        @type mclass: string
+        """
+        obj.attrs['MATLAB_class'] = numpy.string_(mclass)
+
+
+    def _write_mat73_empty(self, group, name, mclass, shape):
+        """Write an empty array, which MATLAB stores as its dimensions.
+
+        @param group: HDF5 group to hold the dataset
+        @type group: h5py.Group
+        @param name: name of the dataset
+        @type name: string
+        @param mclass: MATLAB class
+        @type mclass: string
+        @param shape: MATLAB dimensions
+        @type shape: tuple
+        @return: written dataset
+        @rtype: h5py.Dataset
+        """
+        dset = group.create_dataset(name, data=numpy.array(shape, dtype=numpy.uint64))
+        self._set_mat73_class(dset, mclass)
+        dset.attrs['MATLAB_empty'] = numpy.uint8(1)
+        return dset
+
+
+    def _write_mat73_char(self, group, name, s):
+        """Write a string as a MATLAB char row vector.
+
+        @param group: HDF5 group to hold the dataset
+        @type group: h5py.Group
+        @param name: name of the dataset
+        @type name: string
+        @param s: string to write
+        @type s: string
+        @return: written dataset
+        @rtype: h5py.Dataset
+        """
+        if not len(s):
+            return self._write_mat73_empty(group, name, 'char', (0, 0))
+        codes = numpy.frombuffer(s.encode('utf-16-le'), dtype=numpy.uint16)
+        dset = group.create_dataset(name, data=codes.reshape(-1, 1))
+        self._set_mat73_class(dset, 'char')
+        dset.attrs['MATLAB_int_decode'] = numpy.int32(2)
+        return dset
+
+
+    def _write_mat73_cell(self, h5, name, strings, codes=None):
+        """Write strings as a MATLAB cell row vector.
+
+        Every distinct string is stored once in the group #refs#, all cells
+        holding it refer to the same char array.
+
+        @param h5: opened MATLAB 7.3 file
+        @type h5: h5py.File
+        @param name: name of the variable
+        @type name: string
+        @param strings: strings, or categories if codes are given
+        @type strings: sequence of strings
+        @param codes: codes into categories
+        @type codes: numpy.ndarray
+        """
+        if codes is None:
+            strings, codes = numpy.unique(numpy.array(strings, dtype=str).ravel(),
+                return_inverse=True)
+        refs_group = h5.require_group('#refs#')
+        refs = numpy.empty(len(strings), dtype=object)
+        for i, s in enumerate(strings):
+            dset = self._write_mat73_char(refs_group, '%d' % len(refs_group), u(s))
+            refs[i] = dset.ref
+
+        cell = h5.create_dataset(name, (len(codes), 1),
+            dtype=h5py.special_dtype(ref=h5py.Reference))
+        if len(codes):
+            cell[...] = refs[numpy.asarray(codes).ravel()].reshape(-1, 1)
+        self._set_mat73_class(cell, 'cell')
+
+
+    def _copy_mat73(self, group, name, src, dtype):
+        """Copy a vector block by block into a new dataset.
+
+        @param group: HDF5 group to hold the dataset
+        @type group: h5py.Group
+        @param name: name of the dataset
+        @type name: string
+        @param src: values to copy
+        @type src: numpy.ndarray or h5py.Dataset
+        @param dtype: data type of the dataset
+        @type dtype: numpy.dtype
+        """
+        dtype = numpy.dtype(dtype)
+        dset = group.create_dataset(name, src.shape, dtype=dtype,
+            chunks=self._get_chunks(src.shape, dtype), **self._get_filters())
+        step = max(1, WRITE_BLOCK_BYTES // dtype.itemsize)
+        for start in range(0, src.shape[0], step):
+            dset[start:start+step] = numpy.asarray(src[start:start+step], dtype=dtype)
+
+
+    def _write_mat73_sparse(self, h5, name, A):
+        """Write a sparse matrix, which MATLAB stores in CSC layout already.
+
+        @param h5: opened MATLAB 7.3 file
+        @type h5: h5py.File
+        @param name: name of the variable
+        @type name: string
+        @param A: sparse matrix
+        @type A: csc_matrix or SparseProxy
+        """
+        if type(A) == csc_matrix and not A.has_sorted_indices:
+            A = A.sorted_indices()
+        group = h5.create_group(name)
+        if A.dtype == bool:
+            self._set_mat73_class(group, 'logical')
+            dtype = numpy.uint8
+        else:
+            self._set_mat73_class(group, 'double')
+            dtype = numpy.double
+        group.attrs['MATLAB_sparse'] = numpy.uint64(A.shape[0])
+        if A.nnz:
+            self._copy_mat73(group, 'data', A.data, dtype)
+            self._copy_mat73(group, 'ir', A.indices, numpy.uint64)
+        self._copy_mat73(group, 'jc', A.indptr, numpy.uint64)
+
+
+    def _write_mat73_dense(self, h5, name, A):
+        """Write a numeric array block by block of examples (columns).
+
+        MATLAB stores arrays in column-major order, so the dataset holds the
+        transposed array, vectors being row vectors. Blocks of arrays in
+        Fortran order, as read from HDF5, are written without copying.
+
+        @param h5: opened MATLAB 7.3 file
+        @type h5: h5py.File
+        @param name: name of the variable
+        @type name: string
+        @param A: numeric array
+        @type A: numpy.ndarray or DatasetProxy
+        """
+        dtype = numpy.dtype(A.dtype)
+        mclass = MAT73_CLASSES.get(dtype.name)
+        if mclass is None:
+            A = numpy.asarray(A, dtype=numpy.double)
+            dtype = A.dtype
+            mclass = 'double'
+        if dtype == bool:
+            dtype = numpy.dtype(numpy.uint8)
+
+        if len(A.shape) == 0:
+            A = numpy.asarray(A).reshape(1, 1)
+        if len(A.shape) == 1:
+            mshape = (1, A.shape[0])
+        else:
+            mshape = A.shape
+        if not numpy.prod(mshape):
+            self._write_mat73_empty(h5, name, mclass, mshape)
+            return
+
+        shape = (mshape[1], mshape[0])
+        dset = h5.create_dataset(name, shape, dtype=dtype,
+            chunks=self._get_chunks(shape, dtype), **self._get_filters())
+        self._set_mat73_class(dset, mclass)
+        step = max(1, WRITE_BLOCK_BYTES // (mshape[0] * dtype.itemsize))
+        for start in range(0, shape[0], step):
+            block = numpy.asarray(A[..., start:start+step]).astype(dtype, copy=False)
+            dset[start:start+step] = block.T.reshape(-1, mshape[0])
+
+
+    def _write_mat73_var(self, h5, name, val):
+        """Write a variable to a MATLAB 7.3 file.
+
+        @param h5: opened MATLAB 7.3 file
+        @type h5: h5py.File
+        @param name: name of the variable
+        @type name: string
+        @param val: data of the variable
+        """
+        if isinstance(val, (csc_matrix, SparseProxy)):
+            self._write_mat73_sparse(h5, name, val)
+        elif isinstance(val, DatasetProxy) and val.categories is not None:
+            self._write_mat73_cell(h5, name, val.categories, val.dset[...])
+        elif isinstance(val, str):
+            self._write_mat73_char(h5, name, val)
+        elif isinstance(val, (DatasetProxy, numpy.ndarray)) and val.dtype.kind in 'biuf':
+            self._write_mat73_dense(h5, name, val)
+        else: # assume strings
+            val = numpy.asarray(val)
+            if val.shape == ():
+                self._write_mat73_char(h5, name, u(val))
+            else:
+                self._write_mat73_cell(h5, name, val)
+
+
+    def _write_mat73(self, data):
+        """Write a MATLAB 7.3 file.
+
+        @param data: data to write
+        @type data: dict
+        """
+        group = self.get_data_group(data)
+        h5 = h5py.File(self.fname, 'w', userblock_size=MAT73_USERBLOCK_SIZE)
+        try:
+            for name, val in data[group].items():
+                self._write_mat73_var(h5, name, val)
+            self._write_mat73_cell(h5, 'mldata_descr_ordering', data['ordering'])
+        except: # just do some clean-up
+            h5.close()
+            os.remove(self.fname)
+            raise
+        h5.close()
+
+        header = MAT73_HEADER % time.strftime('%a %b %d %H:%M:%S %Y')
+        header = header.ljust(116).encode('ascii') + b'\x00' * 8 + b'\x00\x02IM'
+        f = open(self.fname, 'r+b')
+        f.write(header)
+        f.close()
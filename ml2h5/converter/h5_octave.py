@@ -1,8 +1,11 @@
-import h5py, numpy
+import h5py, numpy, warnings
 from ml2h5.converter.basehandler import BaseHandler
 from scipy.sparse import csc_matrix
 import ml2h5.converter
 
+# number of values formatted at once when writing
+WRITE_BLOCK_VALUES = 1000000
+
 class H5_OCTAVE(BaseHandler):
     """Handle Octave files."""
 
@@ -50,7 +53,7 @@ class H5_OCTAVE(BaseHandler):
         elif meta['dtype']=='int32 matrix':
             data=self._read_matrix(octf,1,1,mtype='int')
         elif meta['dtype']=='sparse matrix':
-            data=self._read_sparse_matrix(octf,meta['columns'],meta['rows'])
+            data=self._read_sparse_matrix(octf,meta['columns'],meta['rows'],meta.get('nnz'))
         elif meta['dtype']=='cell':
             data=self._read_cellarray(octf,meta['columns'],meta['rows'])
         elif meta['dtype']=='string':
@@ -97,6 +100,8 @@ class H5_OCTAVE(BaseHandler):
                 meta['columns']=int(sp[1])
             if sp[0]=='# elements':
                 meta['elements']=int(sp[1])
+            if sp[0]=='# nnz':
+                meta['nnz']=int(sp[1])
             if sp[0]=='# length':
                 meta['length']=int(sp[1])
             if sp[0]=='# ndims':
@@ -134,65 +139,100 @@ class H5_OCTAVE(BaseHandler):
                     data.append(self._read_sq_string(octf,meta['length'],meta['elements']))
         return data
 
-    def _read_sparse_matrix(self,octf,col,row):
+    def _read_sparse_matrix(self,octf,col,row,nnz=None):
         """Returns the next sparse matrix in the octave file
 
         @param octf: octave file
         @type octf: opened File
+        @param nnz: number of non-zero elements, i.e. lines of data
+        @type nnz: integer
         @return data: csc_matrix
         """
-
-        tmp_data=numpy.array(self._read_matrix(octf,0,0)).T
+        if nnz is None:
+            # no '# nnz' line, so read up to the next attribute
+            tmp_data=self._parse_block(self._read_block(octf))
+            if len(tmp_data)%3:
+                raise ml2h5.converter.ConversionError('unexpected number of sparse matrix values')
+            nnz=len(tmp_data)//3
+        else:
+            tmp_data=self._parse_block(self._read_block(octf, nnz), nnz*3)
+        tmp_data=tmp_data.reshape(nnz, 3).T
         data=csc_matrix((tmp_data[2],tmp_data[0:2]-1),shape=(row,col))
         data.sort_indices()
 
         return data
 
+    def _read_block(self,octf,lines=None):
+        """Returns the lines of data of the next attribute in the octave file
+
+        @param octf: octave file
+        @type octf: opened File
+        @param lines: number of lines to read, up to the next metadata if None
+        @type lines: integer
+        @return data: data lines
+        @rtype: string
+        """
+        if lines is not None:
+            return ''.join([octf.readline() for i in range(lines)])
+
+        data=[]
+        lpos=octf.tell()
+        line=octf.readline()
+        while line and not line.startswith('#'):
+            data.append(line)
+            lpos=octf.tell()
+            line=octf.readline()
+        octf.seek(lpos)
+        return ''.join(data)
+
+    def _parse_block(self,block,num=None,mtype='float'):
+        """Returns the values of a block of data lines
+
+        @param block: whitespace separated values
+        @type block: string
+        @param num: expected number of values, any if None
+        @type num: integer
+        @param mtype: type of values, 'float' or 'int'
+        @type mtype: string
+        @return data: values
+        @rtype: numpy.ndarray
+        """
+        if mtype=='int':
+            dtype=numpy.int_
+        else:
+            dtype=numpy.double
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                out=numpy.fromstring(block, dtype=dtype, sep=' ')
+            except (ValueError, DeprecationWarning):
+                raise ml2h5.converter.ConversionError('unexpected data type')
+        if num is not None and len(out)!=num:
+            raise ml2h5.converter.ConversionError('unexpected data type')
+        return out
+
     def _read_matrix(self,octf,col,row,mtype='float'):
         """Returns the data of a matrix atribute in the octave file
 
+        The whole matrix is parsed at once, the number of data lines
+        being known from the dimensions.
+
         @param octf: octave file
         @type octf: opened File
         @return data: matrix
         """
-        data=[]
-        line=octf.readline()
-        lpos=octf.tell()
         if mtype=='int':
-            if line.startswith(' '):
-                line=line[1:]
-            sp=line[:-1].split(' ')
+            sp=octf.readline().split()
             row=int(sp[0])
             col=int(sp[1])
-            line=octf.readline()
-
-        while line and not line.startswith('#'):
-            if line.startswith(' '):
-                line=line[1:]
-            sp=line[:-1].split(' ')
-
-            if mtype=='int':
-                conv_sp=[]
-                try:
-                    for i in sp:
-                        conv_sp.append(int(i))
-                except ValueError:
-                    raise ConversionError('unexpected data type')    
-            if mtype=='float':
-                conv_sp=[]
-                try:
-                    for i in sp:
-                        conv_sp.append(float(i))
-                except ValueError:
-                    raise ConversionError('unexpected data type')    
-
-            data.append(conv_sp)
-            lpos=octf.tell()
-            line = octf.readline()
-        octf.seek(lpos)
-        out =  numpy.array(data)
-        # unknown matrix shape ?
-        if not (row==0 and col==0):
+            # one element per line
+            block=self._read_block(octf, row*col)
+        else:
+            block=self._read_block(octf, row)
+        out=self._parse_block(block, row*col, mtype)
+        if mtype=='int': # elements in column-major order
+            out=out.reshape((row,col), order='F')
+        else:
             out.shape=(row,col)
         if out.shape[0]==1:
             out.shape=(out.shape[1],)
@@ -227,53 +267,58 @@ class H5_OCTAVE(BaseHandler):
     def _oct_header(self):
         return '# Created by mldata.org for Octave 3.0.1\n'
 
-    def _num_matrix(self,m):
-        if type(m)!= numpy.ndarray:
-            if type(m)==list:
-                try:
-                    m=numpy.array(m)
-                except:
-                    return None
-            else:
-                return None
-        if len(m.shape) == 1:
-            out=[]
-            for i in m:
-                try:
-                    if int(i)!=i:
-                        raise ValueError
-                    out.append(int(i))
-                except:
-                    try:
-                        out.append(float(i))
-                    except:
-                        return None
-        elif len(m.shape) == 2:
-            out=[]
-            for i in m:
-                row=[]
-                for j in i:
-                    try:
-                        if int(j)!=j:
-                            raise ValueError
-                        row.append(int(j))
-                    except:
-                        try:
-                            row.append(float(j))
-                        except:
-                            return None
-                out.append(row)
-        else:
-            return None
-        return out
+    def _is_numeric(self,m):
+        """Check if m can be written as a numeric matrix
 
+        @param m: attribute data
+        @return: if m is an array of numbers
+        @rtype: boolean
+        """
+        if type(m)==list:
+            m=numpy.array(m)
+        if type(m)!=numpy.ndarray or len(m.shape) not in (1, 2):
+            return False
+        if m.dtype.kind in 'biuf':
+            return True
+        if m.dtype.kind=='O':
+            try:
+                m.astype(numpy.double)
+                return True
+            except (ValueError, TypeError):
+                return False
+        return False
+
+    def _format_numbers(self,m):
+        """Format all numbers of an array at once
+
+        Integral values are written as integers, other values with as
+        many digits as needed to read them back exactly.
+
+        @param m: numbers
+        @type m: numpy.ndarray
+        @return: formatted numbers
+        @rtype: numpy.ndarray of str
+        """
+        if m.dtype.kind in 'iub':
+            return m.astype(numpy.int64).astype(str)
+        m=m.astype(numpy.double)
+        out=m.astype(str)
+        with numpy.errstate(invalid='ignore'):
+            integral=numpy.abs(m) < 1e15
+            integral[integral]=m[integral]==numpy.floor(m[integral])
+        # -0.0 would become 0
+        integral&=~((m==0) & numpy.signbit(m))
+        out[integral]=m[integral].astype(numpy.int64).astype(str)
+        out[numpy.isnan(m)]='NaN'
+        out[m==numpy.inf]='Inf'
+        out[m==-numpy.inf]='-Inf'
+        return out
 
     def _print_meta(self,of,attr,name):
         """Return a string of metainformation
 
         @return meta: string of attr informations
         """
-        attr_num=self._num_matrix(attr)
         of.write('# name: ' + str(name) + '\n')
         if type(attr) == numpy.ndarray:
             if attr.shape ==():
@@ -282,37 +327,27 @@ class H5_OCTAVE(BaseHandler):
             elif attr.shape ==(1,1) or attr.shape==(1,):
                 of.write('# type: scalar\n')
             elif len(attr.shape)==1:
-                if attr_num==None:
+                if not self._is_numeric(attr):
                     of.write('# type: cell\n')
                     of.write('# rows: 1\n')
                     of.write('# columns: ' + str(len(attr)) + '\n')
                 else:    
                     if attr.dtype in ['int32', 'int64']:
                         of.write('# type: int32 matrix\n')   
-                        of.write('# ndims 2\n')
+                        of.write('# ndims: 2\n')
                     else:    
                         of.write('# type: matrix\n')
                         of.write('# rows: 1\n')
-                        try:
-                            of.write('# columns: ' + str(attr.shape[0]) + '\n')
-                        except IndexError:
-                            of.write('# columns: 1\n')
+                        of.write('# columns: ' + str(attr.shape[0]) + '\n')
 
             else:
                 if attr.dtype in ['int32', 'int64']:
                     of.write('# type: int32 matrix\n')   
-                    of.write('# ndims 2\n')
+                    of.write('# ndims: 2\n')
                 else:   
                     of.write('# type: matrix\n')
-                    try:
-                        of.write('# rows: ' + str(attr.shape[0]) + '\n')
-                    except IndexError:
-                        of.write('# rows: 1\n')
-
-                    try:
-                        of.write('# columns: ' + str(attr.shape[1]) + '\n')
-                    except IndexError:
-                        of.write('# columns: 1\n')
+                    of.write('# rows: ' + str(attr.shape[0]) + '\n')
+                    of.write('# columns: ' + str(attr.shape[1]) + '\n')
 
         elif type(attr)== csc_matrix:
             of.write('# type: sparse matrix\n')
@@ -328,15 +363,64 @@ class H5_OCTAVE(BaseHandler):
             of.write('# elements: 1\n')
         return True
 
+    def _print_matrix(self, of, attr):
+        """Write the data of a numeric matrix, a block of rows at a time
+
+        Int32 matrices are written one element per line after their
+        dimensions, in column-major order as Octave does, other matrices
+        one row per line.
+        """
+        if attr.dtype in ['int32', 'int64']:
+            if len(attr.shape)==1:
+                attr=attr.reshape(1, attr.shape[0])
+            of.write(' ' + str(attr.shape[0]) + ' ' + str(attr.shape[1]) + '\n')
+            step=max(1, WRITE_BLOCK_VALUES // max(attr.shape[0], 1))
+            for start in range(0, attr.shape[1], step):
+                values=attr[:, start:start+step].ravel(order='F')
+                if not len(values):
+                    continue
+                block=self._format_numbers(values).tolist()
+                of.write(' ' + '\n '.join(block) + '\n')
+        elif len(attr.shape)==1:
+            of.write(' ' + ' '.join(self._format_numbers(attr).tolist()) + '\n')
+        else:
+            step=max(1, WRITE_BLOCK_VALUES // max(attr.shape[1], 1))
+            for start in range(0, attr.shape[0], step):
+                block=self._format_numbers(attr[start:start+step]).tolist()
+                of.write(''.join([' ' + ' '.join(row) + '\n' for row in block]))
+
+    def _print_sparse_matrix(self, of, attr):
+        """Write the data of a sparse matrix as one-based
+        `row column value' triplets, a block of columns at a time"""
+        indptr=attr.indptr
+        step=max(1, attr.shape[1] * WRITE_BLOCK_VALUES // max(attr.nnz, 1))
+        for start in range(0, attr.shape[1], step):
+            stop=min(start+step, attr.shape[1])
+            lo, hi=indptr[start], indptr[stop]
+            rows=(attr.indices[lo:hi] + 1).astype(str).tolist()
+            cols=numpy.repeat(numpy.arange(start+1, stop+1), numpy.diff(indptr[start:stop+1]))
+            cols=cols.astype(str).tolist()
+            values=self._format_numbers(attr.data[lo:hi]).tolist()
+            of.write(''.join([' '.join(t) + '\n' for t in zip(rows, cols, values)]))
+
+    def _print_cellarray(self, of, attr):
+        """Write the elements of a cell array of strings"""
+        for i in attr:
+            i=str(i)
+            of.write('# name: <cell-element>\n')
+            of.write('# type: sq_string\n')
+            of.write('# elements: 1\n')
+            of.write('# length: ' + str(len(i)) + '\n')
+            of.write(i + '\n\n')
+
     def _print_data(self, of, attr):
         """Return a string of data
 
         @return data: string of attr content
         """
-        if attr==None:
+        if attr is None:
             return False
         
-        attr_num=self._num_matrix(attr)
         # matrix or scalar or cell array
         if type(attr) == numpy.ndarray:
             # sq_string
@@ -344,74 +428,24 @@ class H5_OCTAVE(BaseHandler):
                 of.write('# length: ' + str(len(str(attr))) + '\n')
                 of.write(str(attr) + '\n\n')
             # scalar
-            elif attr.shape==(1,1):
-                of.write(str(attr_num[0][0]) + '\n')
-            elif attr.shape==(1,):
-                of.write(str(attr_num[0]) + '\n')
+            elif attr.shape==(1,1) or attr.shape==(1,):
+                of.write(self._format_numbers(attr.ravel())[0] + '\n')
             # matrix
             elif len(attr.shape)==2:
-                # int32 matrix     
-                if attr.dtype in ['int32','int64']: 
-                    of.write(' ' + str(attr.shape[0]) + ' ' + str(attr.shape[1]) + '\n')    
-                    for i in attr:
-                        for j in i:
-                            of.write(' ' + str(j) + '\n')
-                # float matrix            
-                else:            
-                    for i in attr_num:
-                        for j in i:
-                            of.write(' ' + str(j))
-                        of.write('\n')
+                self._print_matrix(of, attr)
             # matrix (vector) or cell array
             elif len(attr.shape)==1:
-                # matrix
-                if attr_num!=None:
-                    # int32 matrix     
-                    if attr.dtype in ['int32', 'int64']: 
-                        of.write(' 1 ' + str(attr.shape[0]) + '\n')    
-                        for i in attr:
-                            of.write(' ' + str(i) + '\n')
-                    # float matrix            
-                    else:            
-                        for i in attr_num:
-                            of.write(' ' + str(i))
-                        of.write('\n')
+                if self._is_numeric(attr):
+                    self._print_matrix(of, attr)
                 else:
-                    # cell array
-                    for i in attr:
-                        of.write('# name: <cell-element>\n')
-                        of.write('# type: sq_string\n')
-                        of.write('# elements: 1\n')
-                        of.write('# length: ' + str(len(i)) + '\n')
-                        of.write(str(i) + '\n\n')
+                    self._print_cellarray(of, attr)
 
         # sparse matrix
         elif type(attr) == csc_matrix:
-            dat=self._num_matrix(attr.data)
-            indptr=attr.indptr
-            indices=attr.indices
-
-            for i in range(attr.shape[1]):
-                out=[]
-                for j in range(indptr[i],indptr[i+1]):
-                    if dat[j]==int:
-                        out.append("%d %d %d\n" % (indices[j]+1, i+1, dat[j]))
-                    else:
-                        out.append("%d %d %.15g\n" % (indices[j]+1, i+1, dat[j]))
-                of.write(''.join(out))
-
-            # more clean but slower code
-            #indices=attr.nonzero()
-            #for i in range(len(attr.data)):
-            #    of.write(str(indices[0][i]+1) + ' '  + str(indices[1][i]+1) + ' ' + str(dat[i]) + '\n')
+            self._print_sparse_matrix(of, attr)
         # cell array
         elif type(attr) == list:
-            for i in attr:
-                of.write('# name: <cell-element>\n')
-                of.write('# type: sq_string\n')
-                of.write('# elements: 1\n')
-                of.write('# length: ' + str(len(i)) + '\n')
-                of.write(str(i) + '\n\n')
+            self._print_cellarray(of, attr)
         # single string
         else:
             of.write('# length: ' + str(len(attr)) + '\n')
@@ -420,6 +454,7 @@ class H5_OCTAVE(BaseHandler):
 
 
     def write(self, data):
+        data=self._load_proxies(data)
         group=self.get_data_group(data)
         of = open(self.fname,'w')
         of.writelines(self._oct_header())
@@ -1,48 +1,257 @@
-import h5py, numpy
-import rpy2.robjects as robjects
-import rpy2.robjects.numpy2ri
-import rpy2.rlike.container as rlc
-from ml2h5.converter.basehandler import BaseHandler
+import gzip, numpy
+from ml2h5.converter import rdata
+from ml2h5.converter.basehandler import BaseHandler, DatasetProxy, SparseProxy
+import ml2h5.converter
+
+# number of values per block when writing columns
+WRITE_BLOCK_VALUES = 1000000
 
 
 class H5_RData(BaseHandler):
-    """Handle RData files."""
+    """Handle RData files.
+
+    Data frames, factors and vectors are read and written with the
+    serialization of module rdata, so no R runtime is needed. Data is
+    written as one data frame named after the data set, task files as one
+    object per field.
+    """
 
     def __init__(self, *args, **kwargs):
         super(H5_RData, self).__init__(*args, **kwargs)
 
 
+    def _get_factor(self, obj):
+        """Get nominal values of an R factor as codes into its levels.
+
+        NA values become 'nan', as they would when read as strings.
+
+        @param obj: factor
+        @type obj: rdata.RObject
+        @return: codes and the categories they index
+        @rtype: DatasetProxy
+        """
+        levels = list(obj.get_attribute('levels', []))
+        codes = obj.value - 1
+        na = obj.value == rdata.NA_INTEGER
+        if na.any():
+            codes[na] = len(levels)
+            levels.append('nan')
+        if len(levels) <= 256:
+            t = numpy.uint8
+        elif len(levels) <= 65536:
+            t = numpy.uint16
+        else:
+            t = numpy.uint32
+        return DatasetProxy(codes.astype(t), numpy.array(levels, dtype=object))
+
+
+    def _get_column(self, obj):
+        """Get values and ARFF-like type of an R vector.
+
+        Integer and logical vectors with NA become double with NaN.
+
+        @param obj: vector
+        @type obj: rdata.RObject
+        @return: values and type, None if not supported
+        @rtype: tuple
+        """
+        if obj.type == rdata.INTSXP and obj.inherits('factor'):
+            levels = obj.get_attribute('levels', [])
+            return self._get_factor(obj), 'nominal:' + ','.join(levels)
+        elif obj.type in (rdata.INTSXP, rdata.LGLSXP):
+            na = obj.value == rdata.NA_INTEGER
+            if na.any():
+                values = obj.value.astype(numpy.double)
+                values[na] = numpy.nan
+                return values, 'numeric'
+            return obj.value.astype(numpy.int32), 'numeric'
+        elif obj.type == rdata.REALSXP:
+            return obj.value, 'numeric'
+        elif obj.type == rdata.STRSXP:
+            values = numpy.array(obj.value, dtype=object)
+            values[values == None] = 'nan'
+            return values, 'string'
+        return None, None
+
+
     def read(self):
-        raise Exception("Not supported...")
+        data = {}
+        names = []
+        types = []
+        ordering = []
+        objects = rdata.load(self.fname)
+
+        for name, obj in objects:
+            if name is None: # RDS file
+                name = self.get_name()
+            if obj.type == rdata.VECSXP and obj.inherits('data.frame'):
+                columns = list(zip(obj.get_attribute('names'), obj.value))
+            else:
+                columns = [(name, obj)]
+            for cname, col in columns:
+                dim = col.get_attribute('dim')
+                if dim is not None and len(dim) == 2 and col.type in (rdata.INTSXP, rdata.REALSXP):
+                    # column-major matrix, i.e. attributes x examples
+                    values, t = self._get_column(col)
+                    data[cname] = values.reshape(dim[1], dim[0])
+                    names.extend(['%s%d' % (cname, i) for i in range(dim[1])])
+                    types.extend([t] * dim[1])
+                else:
+                    values, t = self._get_column(col)
+                    if values is None:
+                        self.warn('unsupported R object %s' % cname)
+                        continue
+                    data[cname] = values
+                    names.append(cname)
+                    types.append(t)
+                ordering.append(cname)
+
+        if not ordering:
+            raise ml2h5.converter.ConversionError('no data found in %s' % self.fname)
+        if len(objects) == 1 and objects[0][0] is not None:
+            dname = objects[0][0]
+        else:
+            dname = self.get_name()
+
+        ddict = {
+            'name': dname,
+            'comment': 'RData',
+            'names': names,
+            'types': types,
+            'ordering': ordering,
+            'data': data,
+        }
+        if self.merge:
+            ddict = self._get_merged(ddict)
+        return ddict
+
+
+    def _write_column(self, writer, values, nominal=False, attributes=None):
+        """Write one vector, block by block.
+
+        @param writer: serializer to write with
+        @type writer: rdata.Writer
+        @param values: values of the column
+        @type values: numpy.ndarray, DatasetProxy or list
+        @param nominal: if the values shall be written as factor
+        @type nominal: boolean
+        @param attributes: attributes of vectors other than factors
+        @type attributes: list of tuple
+        """
+        if isinstance(values, DatasetProxy) and values.categories is not None:
+            codes = values.dset
+            levels = values.categories
+        elif nominal:
+            levels, codes = numpy.unique(numpy.asarray(values, dtype=str),
+                return_inverse=True)
+        else:
+            levels = None
+
+        if levels is not None:
+            attributes = [
+                ('levels', rdata.RObject(rdata.STRSXP, list(levels))),
+                ('class', rdata.RObject(rdata.STRSXP, ['factor'])),
+            ]
+            writer.write_header(rdata.INTSXP, len(codes), attributes, True)
+            for start in range(0, len(codes), WRITE_BLOCK_VALUES):
+                block = numpy.asarray(codes[start:start+WRITE_BLOCK_VALUES])
+                writer.write_numbers(rdata.INTSXP, block.astype(numpy.int32) + 1)
+            writer.write_attributes(attributes)
+            return
+
+        dtype = getattr(values, 'dtype', None)
+        if dtype is None or dtype.kind not in 'biuf':
+            values = numpy.asarray(values)
+            dtype = values.dtype
+        if dtype.kind == 'b':
+            type = rdata.LGLSXP
+        elif dtype.kind in 'iu' and dtype.itemsize <= 4 and dtype != numpy.uint32:
+            type = rdata.INTSXP
+        elif dtype.kind in 'biuf':
+            type = rdata.REALSXP
+        else:
+            type = rdata.STRSXP
+
+        writer.write_header(type, len(values), attributes)
+        for start in range(0, len(values), WRITE_BLOCK_VALUES):
+            block = numpy.asarray(values[start:start+WRITE_BLOCK_VALUES])
+            if type == rdata.STRSXP:
+                writer.write_strings(block.tolist())
+            else:
+                writer.write_numbers(type, block)
+        if attributes:
+            writer.write_attributes(attributes)
+
+
+    def _get_columns(self, data):
+        """Get names and values of the columns of the data frame to write.
+
+        Rows of matrices become columns of their own.
+
+        @param data: data structure as returned by read()
+        @type data: dict
+        @return: names, values and whether they are nominal
+        @rtype: list of tuple
+        """
+        names = list(data.get('names', []))
+        types = data.get('types')
+        if types is None:
+            types = []
+        columns = []
+        for o in data['ordering']:
+            val = data['data'][o]
+            if isinstance(val, SparseProxy) or hasattr(val, 'tocsc'):
+                raise ml2h5.converter.ConversionError('RData does not support sparse data')
+            if len(getattr(val, 'shape', ())) > 1:
+                rows = [val[k] for k in range(val.shape[0])]
+            else:
+                rows = [val]
+            for k, row in enumerate(rows):
+                i = len(columns)
+                if i < len(names):
+                    name = names[i]
+                elif len(rows) > 1:
+                    name = '%s%d' % (o, k)
+                else:
+                    name = o
+                nominal = i < len(types) and str(types[i]).startswith('nominal')
+                columns.append((name, row, nominal))
+        return columns
 
 
     def write(self, data):
         group=self.get_data_group(data)
-        dest=robjects.globalenv
-        if group == 'data':
-            datavals = data['data']
-            ordering = data['ordering']
-            attrlist = []
-            nameind = 0
-            names = data['names']
-            types = data['types']
-            for cur_feat in ordering:
-                if len(datavals[cur_feat].shape) > 1:
-                    for k in range(datavals[cur_feat].shape[0]):
-                        if str(types[nameind]).startswith('nominal'):
-                            attrlist.append((names[nameind], robjects.FactorVector(robjects.StrVector(datavals[cur_feat][k]))))
-                        else:
-                            attrlist.append((names[nameind], datavals[cur_feat][k]))
-                        nameind += 1
-                else:
-                    if str(types[nameind]).startswith('nominal'):
-                        attrlist.append((names[nameind], robjects.FactorVector(robjects.StrVector(datavals[cur_feat]))))
+        fp = gzip.open(self.fname, 'wb')
+        try:
+            fp.write(b'RDX2\n')
+            writer = rdata.Writer(fp)
+            if group == 'data':
+                columns = self._get_columns(data)
+                num = len(columns[0][1]) if columns else 0
+                attributes = [
+                    ('names', rdata.RObject(rdata.STRSXP, [c[0] for c in columns])),
+                    ('row.names', rdata.RObject(rdata.INTSXP,
+                        numpy.array([rdata.NA_INTEGER, -num]))),
+                    ('class', rdata.RObject(rdata.STRSXP, ['data.frame'])),
+                ]
+                writer.write_int(rdata.LISTSXP | rdata.HAS_TAG)
+                writer.write_symbol(data['name'])
+                writer.write_header(rdata.VECSXP, len(columns), attributes, True)
+                for name, values, nominal in columns:
+                    self._write_column(writer, values, nominal)
+                writer.write_attributes(attributes)
+                writer.write_int(rdata.NILVALUE_SXP)
+            elif group == 'task':
+                d=data[group]
+                for k in list(d.keys()):
+                    writer.write_int(rdata.LISTSXP | rdata.HAS_TAG)
+                    writer.write_symbol(k)
+                    A = numpy.asarray(d[k])
+                    if len(A.shape) == 2: # R matrices are column-major
+                        dim = rdata.RObject(rdata.INTSXP, numpy.array(A.shape))
+                        self._write_column(writer, A.ravel(order='F'), attributes=[('dim', dim)])
                     else:
-                        attrlist.append((names[nameind], datavals[cur_feat]))
-                    nameind += 1
-            dest[data['name']] = robjects.DataFrame(rlc.OrdDict(attrlist))
-        elif group == 'task':
-            d=data[group]
-            for k in list(d.keys()):
-                dest[k] = d[k]
-        robjects.r.save(*list(robjects.r.ls(dest)), file=self.fname)
+                        self._write_column(writer, A.ravel())
+                writer.write_int(rdata.NILVALUE_SXP)
+        finally:
+            fp.close()
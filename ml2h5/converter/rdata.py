@@ -0,0 +1,536 @@
+"""Read and write R's binary serialization format (XDR), as used by RData
+(save) and RDS (saveRDS) files.
+
+Supported are the objects data sets are made of: logical, integer, double
+and character vectors, lists (e.g. data frames) and their attributes (e.g.
+names, or levels and class of factors). Numeric vectors are converted
+between XDR and NumPy arrays as a whole, so no R runtime and no per-element
+Python objects are needed.
+
+Files are written in version 2 of the format, which any R since 2.3.0
+reads, gzip compressed as save() does by default.
+"""
+
+import bz2, gzip, lzma, struct, zlib, numpy
+
+# types of R objects (SEXPTYPE)
+NILSXP = 0
+SYMSXP = 1
+LISTSXP = 2
+CHARSXP = 9
+LGLSXP = 10
+INTSXP = 13
+REALSXP = 14
+STRSXP = 16
+VECSXP = 19
+# pseudo types of the serialization format
+ALTREP_SXP = 238
+ATTRLISTSXP = 239
+BASEENV_SXP = 241
+EMPTYENV_SXP = 242
+MISSINGARG_SXP = 251
+UNBOUNDVALUE_SXP = 252
+GLOBALENV_SXP = 253
+NILVALUE_SXP = 254
+REFSXP = 255
+
+# flags of serialized items
+IS_OBJECT = 1 << 8
+HAS_ATTR = 1 << 9
+HAS_TAG = 1 << 10
+# encoding of strings, in the levels of CHARSXPs
+LATIN1_MASK = 1 << 2
+UTF8_MASK = 1 << 3
+ASCII_MASK = 1 << 6
+
+NA_INTEGER = -2**31
+NA_STRING = None
+
+# numeric vectors are read and written in blocks of this many values
+BLOCK_VALUES = 1024*1024
+
+_CHARSXP_ASCII = struct.pack('>i', CHARSXP | (ASCII_MASK << 12))
+_CHARSXP_UTF8 = struct.pack('>i', CHARSXP | (UTF8_MASK << 12))
+_CHARSXP_NA = struct.pack('>ii', CHARSXP, -1)
+_DTYPES = {LGLSXP: '>i4', INTSXP: '>i4', REALSXP: '>f8'}
+
+
+class RObject(object):
+    """An R object read from or to be written to a serialization stream.
+
+    @ivar type: SEXPTYPE, e.g. REALSXP
+    @type type: integer
+    @ivar value: values of a vector, elements of a list or None
+    @type value: numpy.ndarray or list
+    @ivar attributes: attributes by name, e.g. 'names' or 'class'
+    @type attributes: dict of RObject
+    @ivar is_object: if the object has a class attribute
+    @type is_object: boolean
+    """
+
+    def __init__(self, type, value=None, attributes=None, is_object=False):
+        self.type = type
+        self.value = value
+        if attributes is None:
+            attributes = {}
+        self.attributes = attributes
+        self.is_object = is_object or 'class' in attributes
+
+    def get_attribute(self, name, default=None):
+        """Get the values of an attribute.
+
+        @param name: name of attribute
+        @type name: string
+        @param default: value if there is no such attribute
+        @return: values of attribute
+        @rtype: numpy.ndarray or list
+        """
+        if name in self.attributes:
+            return self.attributes[name].value
+        return default
+
+    def inherits(self, cls):
+        """Check if the object's class attribute contains cls.
+
+        @param cls: name of class, e.g. 'factor'
+        @type cls: string
+        @return: if object is of that class
+        @rtype: boolean
+        """
+        return cls in self.get_attribute('class', [])
+
+    def __len__(self):
+        if self.value is None:
+            return 0
+        return len(self.value)
+
+
+def open_file(fname):
+    """Open a file for reading, decompressing it as R would.
+
+    @param fname: name of file
+    @type fname: string
+    @return: opened file
+    @rtype: file object
+    """
+    f = open(fname, 'rb')
+    magic = f.read(6)
+    f.close()
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(fname, 'rb')
+    elif magic[:3] == b'BZh':
+        return bz2.open(fname, 'rb')
+    elif magic == b'\xfd7zXZ\x00':
+        return lzma.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def peek(buf, size=5):
+    """Get the first bytes of a file's contents from its beginning,
+    decompressing them as open_file() would.
+
+    @param buf: first bytes of the file
+    @type buf: bytes
+    @param size: number of bytes of contents to get at most
+    @type size: integer
+    @return: first bytes of contents, fewer if buf is too short or corrupt
+    @rtype: bytes
+    """
+    if buf[:2] == b'\x1f\x8b':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif buf[:3] == b'BZh':
+        decompressor = bz2.BZ2Decompressor()
+    elif buf[:6] == b'\xfd7zXZ\x00':
+        decompressor = lzma.LZMADecompressor()
+    else:
+        return buf[:size]
+    try:
+        return decompressor.decompress(buf, size)[:size]
+    except (zlib.error, OSError, EOFError, lzma.LZMAError):
+        return b''
+
+
+def load(fname):
+    """Load all objects from an RData or RDS file.
+
+    @param fname: name of file
+    @type fname: string
+    @return: objects with their names, None for the object of an RDS file
+    @rtype: list of tuple
+    """
+    fp = open_file(fname)
+    try:
+        magic = fp.read(5)
+        if magic in (b'RDX2\n', b'RDX3\n'):
+            reader = Reader(fp)
+            pairlist = reader.read_item()
+            return list(zip(pairlist.attributes['tags'], pairlist.value))
+        elif magic[:2] == b'X\n':
+            reader = Reader(fp, magic[2:])
+            return [(None, reader.read_item())]
+        raise ValueError('not a binary RData or RDS file: %s' % fname)
+    finally:
+        fp.close()
+
+
+class Reader(object):
+    """Deserialize R objects from a binary (XDR) stream.
+
+    @ivar fp: stream positioned after the format marker 'X\\n'
+    @type fp: file object
+    @ivar version: version of the serialization format
+    @type version: integer
+    @ivar refs: referable objects (symbols) read so far
+    @type refs: list
+    """
+
+    def __init__(self, fp, pending=b''):
+        """
+        @param fp: stream to read from, positioned after 'RDX2\\n' or 'RDXn\\n'
+        @type fp: file object
+        @param pending: bytes already read from the stream after 'X\\n'
+        @type pending: bytes
+        """
+        self.fp = fp
+        self.refs = []
+        self._pending = pending
+        if not self._pending and self.fp.read(2) != b'X\n':
+            raise ValueError('only the binary XDR format is supported')
+        self.version = self.read_int()
+        self.read_int() # version of R written with
+        self.read_int() # version of R needed to read
+        if self.version == 3:
+            self.read(self.read_int()) # native encoding
+
+    def read(self, n):
+        """Read n bytes.
+
+        @param n: number of bytes
+        @type n: integer
+        @return: bytes read
+        @rtype: bytes
+        """
+        if self._pending:
+            data = self._pending[:n]
+            self._pending = self._pending[n:]
+            data += self.fp.read(n - len(data))
+        else:
+            data = self.fp.read(n)
+        if len(data) != n:
+            raise ValueError('unexpected end of file')
+        return data
+
+    def read_int(self):
+        return struct.unpack('>i', self.read(4))[0]
+
+    def read_length(self):
+        """Read the length of a vector, which may be a long vector."""
+        n = self.read_int()
+        if n == -1:
+            upper, lower = struct.unpack('>II', self.read(8))
+            n = (upper << 32) + lower
+        return n
+
+    def read_string(self, flags):
+        """Read a CHARSXP.
+
+        @param flags: flags of the CHARSXP
+        @type flags: integer
+        @return: string, None for NA
+        @rtype: string
+        """
+        n = self.read_int()
+        if n == -1:
+            return NA_STRING
+        b = self.read(n)
+        if (flags >> 12) & LATIN1_MASK:
+            return b.decode('latin-1')
+        try:
+            return b.decode('utf-8')
+        except UnicodeDecodeError: # unknown native encoding
+            return b.decode('latin-1')
+
+    def read_numbers(self, type, n):
+        """Read a numeric vector as a whole.
+
+        @param type: LGLSXP, INTSXP or REALSXP
+        @type type: integer
+        @param n: number of values
+        @type n: integer
+        @return: values, NA integers being NA_INTEGER
+        @rtype: numpy.ndarray
+        """
+        dtype = numpy.dtype(_DTYPES[type])
+        values = numpy.empty(n, dtype=dtype.newbyteorder('='))
+        for start in range(0, n, BLOCK_VALUES):
+            stop = min(n, start + BLOCK_VALUES)
+            values[start:stop] = numpy.frombuffer(
+                self.read((stop - start) * dtype.itemsize), dtype=dtype)
+        return values
+
+    def read_strings(self, n):
+        """Read a character vector.
+
+        @param n: number of strings
+        @type n: integer
+        @return: strings, None for NA
+        @rtype: list of strings
+        """
+        values = []
+        read = self.read
+        for i in range(n):
+            flags, length = struct.unpack('>ii', read(8))
+            if length == -1:
+                values.append(NA_STRING)
+                continue
+            b = read(length)
+            if (flags >> 12) & LATIN1_MASK:
+                values.append(b.decode('latin-1'))
+            else:
+                try:
+                    values.append(b.decode('utf-8'))
+                except UnicodeDecodeError:
+                    values.append(b.decode('latin-1'))
+        return values
+
+    def read_attributes(self):
+        """Read an attribute pairlist.
+
+        @return: attributes by name
+        @rtype: dict of RObject
+        """
+        pairlist = self.read_item()
+        return dict(zip(pairlist.attributes.get('tags', []), pairlist.value or []))
+
+    def read_pairlist(self, flags):
+        """Read a pairlist iteratively.
+
+        Its elements are the value of the returned object, their tags the
+        attribute 'tags'.
+        """
+        values = []
+        tags = []
+        attributes = {}
+        while True:
+            type = flags & 0xff
+            if type == NILVALUE_SXP:
+                break
+            if type not in (LISTSXP, ATTRLISTSXP):
+                raise ValueError('unsupported R type %d in pairlist' % type)
+            if flags & HAS_ATTR:
+                attributes = self.read_attributes()
+            tag = None
+            if flags & HAS_TAG:
+                tag = self.read_item().value
+            values.append(self.read_item())
+            tags.append(tag)
+            flags = self.read_int()
+        attributes['tags'] = tags
+        return RObject(LISTSXP, values, attributes)
+
+    def read_altrep(self):
+        """Read a compact or wrapped vector of R 3.5 or later."""
+        info = self.read_item()
+        state = self.read_item()
+        attributes = self.read_attributes()
+        cls = info.value[0].value
+        if cls in ('compact_intseq', 'compact_realseq'):
+            n, start, step = state.value[:3]
+            values = start + step * numpy.arange(int(n))
+            if cls == 'compact_intseq':
+                return RObject(INTSXP, values.astype(numpy.int32), attributes)
+            return RObject(REALSXP, values.astype(numpy.double), attributes)
+        elif cls.startswith('wrap_'):
+            obj = state.value[0]
+        elif cls == 'deferred_string':
+            arg = state.value[0]
+            if arg.type == INTSXP:
+                strings = [NA_STRING if v == NA_INTEGER else '%d' % v for v in arg.value]
+            else:
+                strings = ['%.15g' % v for v in arg.value]
+            obj = RObject(STRSXP, strings)
+        else:
+            raise ValueError('unsupported compact R object %s' % cls)
+        obj.attributes.update(attributes)
+        return obj
+
+    def read_item(self, flags=None):
+        """Read the next object.
+
+        @param flags: flags of the object if already read
+        @type flags: integer
+        @return: object
+        @rtype: RObject
+        """
+        if flags is None:
+            flags = self.read_int()
+        type = flags & 0xff
+
+        if type in (NILVALUE_SXP, GLOBALENV_SXP, EMPTYENV_SXP, BASEENV_SXP,
+                MISSINGARG_SXP, UNBOUNDVALUE_SXP):
+            return RObject(NILSXP)
+        elif type == REFSXP:
+            index = flags >> 8
+            if not index:
+                index = self.read_int()
+            return self.refs[index - 1]
+        elif type == SYMSXP:
+            obj = RObject(SYMSXP, self.read_item().value)
+            self.refs.append(obj)
+            return obj
+        elif type in (LISTSXP, ATTRLISTSXP):
+            return self.read_pairlist(flags)
+        elif type == ALTREP_SXP:
+            return self.read_altrep()
+        elif type == CHARSXP:
+            return RObject(CHARSXP, self.read_string(flags))
+
+        if type in (LGLSXP, INTSXP, REALSXP):
+            value = self.read_numbers(type, self.read_length())
+        elif type == STRSXP:
+            value = self.read_strings(self.read_length())
+        elif type == VECSXP:
+            value = [self.read_item() for i in range(self.read_length())]
+        else:
+            raise ValueError('unsupported R type %d' % type)
+
+        attributes = {}
+        if flags & HAS_ATTR:
+            attributes = self.read_attributes()
+        return RObject(type, value, attributes, bool(flags & IS_OBJECT))
+
+
+class Writer(object):
+    """Serialize R objects to a binary (XDR) stream.
+
+    Vectors can be written as a whole by write_item or block by block: the
+    header by write_header, the values by write_numbers/write_strings (or
+    write_item for the elements of lists) and the attributes by
+    write_attributes.
+
+    @ivar fp: stream to write to
+    @type fp: file object
+    @ivar refs: indices of symbols written so far
+    @type refs: dict
+    """
+
+    def __init__(self, fp):
+        """
+        @param fp: stream to write to
+        @type fp: file object
+        """
+        self.fp = fp
+        self.refs = {}
+        self.fp.write(b'X\n' + struct.pack('>iii', 2, 0x030500, 0x020300))
+
+    def write_int(self, i):
+        self.fp.write(struct.pack('>i', i))
+
+    def write_header(self, type, length, attributes=None, is_object=False):
+        """Write flags and length of a vector.
+
+        @param type: SEXPTYPE of the vector
+        @type type: integer
+        @param length: number of values
+        @type length: integer
+        @param attributes: attributes to be written after the values
+        @type attributes: list or dict
+        @param is_object: if the object has a class attribute
+        @type is_object: boolean
+        """
+        flags = type
+        if attributes:
+            flags |= HAS_ATTR
+        if is_object:
+            flags |= IS_OBJECT
+        self.write_int(flags)
+        if length > 2**31 - 1:
+            self.fp.write(struct.pack('>iII', -1, length >> 32, length & 0xffffffff))
+        else:
+            self.write_int(length)
+
+    def write_numbers(self, type, values):
+        """Write values of a numeric vector.
+
+        @param type: LGLSXP, INTSXP or REALSXP
+        @type type: integer
+        @param values: values, NA integers being NA_INTEGER
+        @type values: numpy.ndarray
+        """
+        dtype = _DTYPES[type]
+        for start in range(0, len(values), BLOCK_VALUES):
+            block = numpy.asarray(values[start:start+BLOCK_VALUES])
+            self.fp.write(block.astype(dtype).tobytes())
+
+    def write_strings(self, values):
+        """Write values of a character vector.
+
+        @param values: strings, None for NA
+        @type values: sequence of strings
+        """
+        out = []
+        for s in values:
+            if s is NA_STRING:
+                out.append(_CHARSXP_NA)
+                continue
+            s = str(s)
+            b = s.encode('utf-8')
+            if len(b) == len(s):
+                out.append(_CHARSXP_ASCII + struct.pack('>i', len(b)) + b)
+            else:
+                out.append(_CHARSXP_UTF8 + struct.pack('>i', len(b)) + b)
+        self.fp.write(b''.join(out))
+
+    def write_symbol(self, name):
+        """Write a symbol, referring to it if written before."""
+        if name in self.refs:
+            index = self.refs[name]
+            self.write_int((index << 8) | REFSXP)
+            return
+        self.refs[name] = len(self.refs) + 1
+        self.write_int(SYMSXP)
+        self.write_strings([name])
+
+    def write_pairlist(self, items):
+        """Write a pairlist of tagged objects.
+
+        @param items: tags and objects
+        @type items: list of tuple
+        """
+        for tag, obj in items:
+            self.write_int(LISTSXP | HAS_TAG)
+            self.write_symbol(tag)
+            self.write_item(obj)
+        self.write_int(NILVALUE_SXP)
+
+    def write_attributes(self, attributes):
+        """Write attributes given by write_header before.
+
+        @param attributes: attributes by name
+        @type attributes: list of tuple or dict
+        """
+        if hasattr(attributes, 'items'):
+            attributes = list(attributes.items())
+        self.write_pairlist(attributes)
+
+    def write_item(self, obj):
+        """Write an object as a whole.
+
+        @param obj: object to write
+        @type obj: RObject
+        """
+        if obj.type == NILSXP:
+            self.write_int(NILVALUE_SXP)
+            return
+        self.write_header(obj.type, len(obj), obj.attributes, obj.is_object)
+        if obj.type in _DTYPES:
+            self.write_numbers(obj.type, obj.value)
+        elif obj.type == STRSXP:
+            self.write_strings(obj.value)
+        elif obj.type == VECSXP:
+            for element in obj.value:
+                self.write_item(element)
+        else:
+            raise ValueError('unsupported R type %d' % obj.type)
+        if obj.attributes:
+            self.write_attributes(obj.attributes)
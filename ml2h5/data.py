@@ -10,6 +10,7 @@ from scipy.sparse import csc_matrix
 
 import ml2h5
 from ml2h5 import NUM_EXTRACT, LEN_EXTRACT
+import ml2h5.converter.basehandler
 
 def get_num_instattr(fname):
     """Retrieve number of instances and number of attributes from given HDF5 file.
@@ -22,32 +23,27 @@ def get_num_instattr(fname):
     if not h5py.is_hdf5(fname):
         return (-1,-1)
 
+    handler = ml2h5.converter.basehandler.BaseHandler(fname)
     try:
-        h5 = h5py.File(fname, 'r')
+        contents = handler.read(lazy=True)
         num_inst = 0
         num_attr = 0
-        for name in h5['/data_descr/ordering']:
-            vname = '/data/' + name
-            sp_indptr = vname+'_indptr'
-            sp_indices = vname+'_indices'
-
-            if sp_indptr in h5['/data'] and sp_indices in h5['/data']:
-                A = csc_matrix(
-                        (h5[vname], h5[sp_indices], h5[sp_indptr])
-                        )
+        for name in contents['ordering']:
+            A = contents['data'][name]
+            if isinstance(A, ml2h5.converter.basehandler.SparseProxy):
                 num_inst += A.shape[1]
                 num_attr += A.shape[0]
             else:
-                if len(h5[vname].shape) == 2:
-                    num_attr += h5[vname].shape[0]
-                    num_inst = h5[vname].shape[1]
+                if len(A.shape) == 2:
+                    num_attr += A.shape[0]
+                    num_inst = A.shape[1]
                 else:
-                    num_inst = h5[vname].shape[0]
+                    num_inst = A.shape[0]
                     num_attr += 1
-        h5.close()
     except:
         num_inst = -1
         num_attr = -1
+    handler.close()
 
     return (num_inst, num_attr)
 
@@ -113,25 +109,27 @@ def _get_extract_data(h5):
 
                 cur_line+=A.shape[0]
             else:
-                if type(h5[dset][0]) == numpy.ndarray:
-                    last = len(h5[dset][0])
+                # decodes string data stored as codes or with fixed width
+                d = ml2h5.converter.basehandler.get_proxy(h5['/data'], dset[6:])
+                if len(d.shape) == 2:
+                    last = d.shape[1]
                     if last > NUM_EXTRACT: 
                         last = NUM_EXTRACT
                         overlength=True
-                    app_lines=range(len(h5[dset]))
+                    app_lines=range(len(d))
                     if len(app_lines) + cur_line > NUM_EXTRACT: 
                         app_lines = range(NUM_EXTRACT - cur_line )
                         overwidth=True 
                     for i in app_lines:
-                        extract.append(h5[dset][i][:last])
+                        extract.append(d[i,:last])
                     cur_line+=len(app_lines)
                 else:
                     cur_line+=1
-                    last = len(h5[dset])
+                    last = len(d)
                     if last > NUM_EXTRACT: 
                         last = NUM_EXTRACT
                         overlength=True
-                    extract.append(h5[dset][:last])
+                    extract.append(d[:last])
         if overwidth:
             extract.append(['...' for i in extract[0]])    
         extract = numpy.matrix(extract).T
@@ -353,42 +351,29 @@ def _find_dset(fname, output_variables):
     dset = None
 
     ov = output_variables
-    for name in h5['/data_descr/ordering']:
-        path = '/data/' + name
-        path_indptr = path+'_indptr'
-        path_indices = path+'_indices'
-
-        if path_indptr in h5['/data'] and path_indices in h5['/data']:
-            A = csc_matrix(
-                (h5['/data/data'], h5['/data/indices'], h5['/data/indptr'])
-            )
-            if ov == 0:
-                for i in range(A.shape[0]):
-                    if ov == 0:
-                        dset = A[i].todense().tolist()
-                        break # inner loop
-                    else:
-                        ov -= 1
-        else:
-            data = h5[path][...]
-
-            if len(data.shape) == 1: # datasets with shape (x,)
+    try:
+        for name in h5['/data_descr/ordering']:
+            # decodes string data stored as codes or with fixed width
+            A = ml2h5.converter.basehandler.get_proxy(h5['/data'], name)
+            if isinstance(A, ml2h5.converter.basehandler.SparseProxy):
+                num = A.shape[0]
+                if ov < num:
+                    dset = A.load()[ov].toarray().ravel().tolist()
+            elif len(A.shape) == 1: # datasets with shape (x,)
+                num = 1
                 if ov == 0:
-                    dset = data
-                else:
-                    ov -= 1
+                    dset = A.load()
             else: # datasets with shape (x,y)
-                for i in range(len(data)):
-                    if ov == 0:
-                        dset = data[i].tolist()
-                        break # inner loop
-                    else:
-                        ov -= 1
+                num = A.shape[0]
+                if ov < num:
+                    dset = A[ov].tolist()
 
             if dset is not None:
-                break # outer loop
+                break
+            ov -= num
+    finally:
+        h5.close()
 
-    h5.close()
     return dset
 
 def get_attribute_types(fname):
@@ -400,17 +385,19 @@ def get_attribute_types(fname):
     try:
         h5 = h5py.File(fname, 'r')
         have_type = '/data_descr/types' in h5
-        all_types = set(h5['/data_descr/types'])
+        all_types = set(h5['/data_descr/types']) if have_type else set()
         for o in h5['/data_descr/ordering']:
             indptr_name='/data/' + o + '_indptr'
             indices_name='/data/' + o + '_indices'
             if indptr_name in h5 and indices_name in h5:
-                types += 'Sparse Matrix'
+                types.add('Sparse Matrix')
             else:
                 if have_type and o in all_types:
-                    types += h5['/data_descr/types'][o]
+                    types.add(h5['/data_descr/types'][o])
                 else:
-                    t=h5['/data/' + o].dtype
+                    # string data stored as codes or with fixed width has
+                    # the vlen str type of its decoded values
+                    t=ml2h5.converter.basehandler.get_proxy(h5['/data'], o).dtype
                     if t==dt:
                         types.add("String")
                     elif t in (numpy.int64, numpy.int32):
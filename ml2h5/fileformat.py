@@ -1,6 +1,6 @@
-import h5py
+import io
 import os.path
-import gzip
+from ml2h5.converter import rdata
 from ml2h5.converter.basehandler import ALLOWED_SEPERATORS
 from ml2h5.converter import AUTODETECTION_MAXBUFLEN
 
@@ -41,101 +41,134 @@ def _try_suffix(fname):
         return 'octave', True
     elif suffix in ('xml'):
         return 'xml', True
-    elif suffix in ('RData', 'rdata'):
+    elif suffix in ('RData', 'rdata', 'rda', 'rds'):
         return 'rdata', True
     else: # unknown
         return suffix, False
 
 
-def _try_arff(fname):
-    """Try if given file is in arff format
+# signature of HDF5 files, found at offset 0, 512, 1024, 2048, ... behind the
+# user block
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+
+def _read_prefix(fname):
+    """Read the first bytes of given file, to detect its format from.
 
     @param fname: name of file to determine format for
     @type fname: string
+    @return: at most AUTODETECTION_MAXBUFLEN bytes, empty if unreadable
+    @rtype: bytes
     """
     try:
-        import arff
-        arff.ArffFile.load(fname)
-        return True
-    except:
-        return False
+        fp = open(fname, 'rb')
+    except (IOError, OSError):
+        return b''
+    try:
+        return fp.read(AUTODETECTION_MAXBUFLEN)
+    finally:
+        fp.close()
+
+
+def _get_lines(buf):
+    """Get text lines from the first bytes of a file.
+
+    @param buf: first bytes of the file
+    @type buf: bytes
+    @return: file object reading the text
+    @rtype: io.StringIO
+    """
+    return io.StringIO(buf.decode('utf-8', 'replace'), newline=None)
+
+
+def _try_arff(buf):
+    """Try if given file is in arff format, by its header only
 
+    @param buf: first bytes of the file
+    @type buf: bytes
+    """
+    for line in _get_lines(buf):
+        line = line.strip()
+        if line and not line.startswith('%'):
+            return line.split(None, 1)[0].lower() == '@relation'
+    return False
 
-def _try_csv(fname):
+
+def _try_csv(buf):
     """Try if given file is in csv format
 
-    @param fname: name of file to determine format for
-    @type fname: string
+    @param buf: first bytes of the file
+    @type buf: bytes
     """
-    if infer_seperator(fname) == ',':
+    if _infer_seperator(_get_lines(buf)) == ',':
         return True
     else:
         return False
 
 
-def _try_libsvm(fname):
+def _try_libsvm(buf):
     """Try if given file is in libsvm format
 
-    @param fname: name of file to determine format for
-    @type fname: string
+    @param buf: first bytes of the file
+    @type buf: bytes
     """
-    try:
-        fp = open(fname, 'r')
-    except:
-        return False
-
-    line = fp.readline(AUTODETECTION_MAXBUFLEN)
+    line = _get_lines(buf).readline()
     attributes = line.split()
     if len(attributes) > 1:
         # 0th might be label, so look at 1st
         if len(attributes[1].split(':')) == 2:
-            fp.close()
             return True
 
-    fp.close()
     return False
 
 
-def _try_h5(fname):
+def _try_h5(buf):
     """Try if given file is in hdf5 format
 
-    @param fname: name of file to determine format for
-    @type fname: string
+    @param buf: first bytes of the file
+    @type buf: bytes
     """
+    offset = 0
+    while offset + len(HDF5_SIGNATURE) <= len(buf):
+        if buf[offset:offset + len(HDF5_SIGNATURE)] == HDF5_SIGNATURE:
+            return True
+        offset = max(512, offset * 2)
+    return False
 
-    return h5py.is_hdf5(fname)
+def _try_matlab(buf):
+    """Try if given file is in matlab format, MATLAB 7.3 files being HDF5
+    files with a MATLAB header
 
-def _try_matlab(fname):
-    try:
-        return file(fname).read(6) == 'MATLAB'
-    except:
-        return False
+    @param buf: first bytes of the file
+    @type buf: bytes
+    """
+    return buf[:6] == b'MATLAB'
 
-def _try_octave(fname):
-    try:
-        return file(fname).read(13)==('# Created by ')
-    except:
-        return False
+def _try_octave(buf):
+    """Try if given file is in octave text format
 
-def _try_rdata(fname):
-    try:
-        return gzip.GzipFile(fname).read(4)==('RDX2')
-    except:
-        return False
+    @param buf: first bytes of the file
+    @type buf: bytes
+    """
+    return buf[:13] == b'# Created by '
 
-def infer_seperator(fname):
-    """Infer seperator for variables in given file.
+def _try_rdata(buf):
+    """Try if given file is in (binary) RData format
 
-    @param fname: filename to retrieve data from
-    @type fname: string
+    @param buf: first bytes of the file
+    @type buf: bytes
+    """
+    return rdata.peek(buf) in (b'RDX2\n', b'RDX3\n')
+
+
+def _infer_seperator(fp):
+    """Infer seperator for variables from the first lines of a file.
+
+    @param fp: file to read lines from
+    @type fp: file object
     @return: inferred seperator
     @rtype: string
     """
-    try:
-        fp = open(fname, 'r')
-    except:
-        return None
-
     seperator = None
     minimum = 1
 
@@ -155,6 +188,23 @@ def infer_seperator(fname):
         if not line.endswith('\n'):
             break
 
+    return seperator
+
+
+def infer_seperator(fname):
+    """Infer seperator for variables in given file.
+
+    @param fname: filename to retrieve data from
+    @type fname: string
+    @return: inferred seperator
+    @rtype: string
+    """
+    try:
+        fp = open(fname, 'r')
+    except:
+        return None
+
+    seperator = _infer_seperator(fp)
     fp.close()
     return seperator
 
@@ -163,8 +213,10 @@ def get(fname, skip_suffix=False):
     """Get format of given file.
 
     By suffix it detects: libsvm, arff, csv, h5, tgz, tar.gz, tar.bz2, zip,
-    matlab, octave.
-    By deeper inspection it detects: h5, matlab, octave, arff, csv, libsvm
+    matlab, octave, rdata.
+    By deeper inspection it detects: matlab, h5, rdata, octave, arff, libsvm,
+    csv. The file is read once, up to AUTODETECTION_MAXBUFLEN bytes, and all
+    checks look at these bytes only.
 
     If format is not known, return the file extension.
 
@@ -173,18 +225,18 @@ def get(fname, skip_suffix=False):
     @param skip_suffix: if detection by suffix (first priority) shall be skipped
     @type skip_suffix: boolean
     """
-    if not skip_suffix:
-        extension, found = _try_suffix(fname)
-        if found:
-            return extension
-
-    if _try_h5(fname): return 'h5'
-    elif _try_matlab(fname): return 'matlab'
-    elif _try_rdata(fname): return 'rdata'
-    elif _try_octave(fname): return 'octave'
-    elif _try_libsvm(fname): return 'libsvm'
-    elif _try_csv(fname): return 'csv'
-    elif _try_arff(fname): return 'arff'
+    extension, found = _try_suffix(fname)
+    if found and not skip_suffix:
+        return extension
+
+    buf = _read_prefix(fname)
+    if _try_matlab(buf): return 'matlab'
+    elif _try_h5(buf): return 'h5'
+    elif _try_rdata(buf): return 'rdata'
+    elif _try_octave(buf): return 'octave'
+    elif _try_arff(buf): return 'arff'
+    elif _try_libsvm(buf): return 'libsvm'
+    elif _try_csv(buf): return 'csv'
 
     return extension
 
@@ -213,7 +265,8 @@ def can_convert_h5_to(dst_type, h5_filename=None):
     if dst_type in ('matlab', 'octave'):
         return True
 
-    if h5_filename and h5_filename.endswith('.h5') and h5py.is_hdf5(h5_filename):
+    if h5_filename and h5_filename.endswith('.h5') and _try_h5(_read_prefix(h5_filename)):
+        import h5py # only needed here, the format is detected from the signature
         try:
             h5 = h5py.File(h5_filename, 'r')
 
@@ -221,7 +274,9 @@ def can_convert_h5_to(dst_type, h5_filename=None):
                 ordering=set(('label','data'))
                 if ordering.issubset(set(h5['data'].keys())):
                     return True # TODO check if this is sparse data / ndarray data
-            elif dst_type in ('csv', 'arff', 'rdata'): # csv/arff/RData support everything except sparse data
+            elif dst_type == 'arff':
+                return True
+            elif dst_type in ('csv', 'rdata'): # csv/RData support everything except sparse data
                 for k in list(h5['data'].keys()):
                     if k.endswith('_indptr') or k.endswith('_indices'):
                         return False
@@ -7,16 +7,21 @@ import os
 import unittest
 import sys
 import getopt
+import subprocess
 import datetime
 import numpy
+import h5py
+from scipy.sparse import csc_matrix
 
 import ml2h5
 import ml2h5.converter
+import ml2h5.data
 from mleval import other
 from ml2h5 import converter
 from ml2h5 import fileformat
 from ml2h5.converter.h5_csv import H5_CSV
 from ml2h5.converter.h5_arff import H5_ARFF
+from ml2h5.converter import arff
 from ml2h5.converter.h5_libsvm import H5_LibSVM
 from ml2h5.converter.h5_mat import H5_MAT
 from ml2h5.converter.h5_octave import H5_OCTAVE
@@ -39,6 +44,7 @@ FIXTURES = {
 
     'big-arff': '../fixtures/breastCancer.arff',
     'big-csv': '../fixtures/breastCancer.csv',
+    'big-libsvm': '../fixtures/big.libsvm',
 }
 
 RESULTS = {
@@ -63,12 +69,38 @@ class TestConversion(unittest.TestCase):
         self.assertEqual('h5', ff,
                          'wrong format found')
     
+    def test_detect_fileformats(self):
+        formats = {
+            'csv': 'csv', 'arff': 'arff', 'R': 'rdata', 'libsvm': 'libsvm',
+            'h5': 'h5', 'octave': 'octave', 'mat': 'matlab',
+        }
+        for key, format in formats.items():
+            self.assertEqual(fileformat.get(self.fixtures[key], skip_suffix=True), format,
+                             'wrong format detected by contents of %s' % self.fixtures[key])
+        self.assertEqual(fileformat.get('non-existsing-file.xyz', skip_suffix=True), 'xyz',
+                         'extension not returned for unknown format')
+
+    def test_lazy_handlers(self):
+        code = 'import sys, ml2h5.converter; print(sorted(m for m in sys.modules if ".h5_" in m))'
+        out = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(out.split(), [b'[]'], 'handler modules imported eagerly')
+        self.assertEqual(converter.get_handler('octave'), H5_OCTAVE, 'wrong handler')
+        self.assertRaises(KeyError, converter.get_handler, 'unknown')
+
     def test_read_csv(self):
         conv = H5_CSV(self.fixtures['csv'])
         data = conv.read()
         self.assertEqual(data['data']['int3'][3], 4,
                          'wrong first integer')
 
+    def test_get_datatype(self):
+        handler = BaseHandler(self.fixtures['h5'])
+        for values in (['1', '2'], ['1', '2.5'], ['nan', '1'], ['a', '1'],
+                       [1, 2], [numpy.nan, 1], [' 3', '+4'], ['1', '']):
+            self.assertEqual(handler.get_datatype(values),
+                             handler._get_datatype_python(values),
+                             'wrong datatype for %s' % values)
+
     def test_read_arff(self):
         conv = H5_ARFF(self.fixtures['arff'])
         data = conv.read()
@@ -81,9 +113,104 @@ class TestConversion(unittest.TestCase):
     #    self.assertEqual(data['data']['sepallength'][3], 4.6,
     #                     'wrong first integer')
 
+    def test_matlab_variables(self):
+        fname = self.result['generic'] + 'mat'
+        data = {
+            'name': 'matlab',
+            'comment': '',
+            'names': [],
+            'ordering': ['double', 'str'],
+            'data': {
+                'double': numpy.array([0.5, 1.5]),
+                'str': numpy.array(['a', '', 'b']),
+                'aux': numpy.zeros((10, 10)),
+            },
+        }
+        H5_MAT(fname).write(data)
+        contents = H5_MAT(fname).read()
+        self.assertEqual(sorted(contents['data'].keys()), ['double', 'str'],
+                         'variables not in ordering read')
+        self.assertEqual(contents['data']['str'], ['a', '', 'b'], 'wrong cell array')
+        handler = H5_MAT(fname)
+        handler.variables = ['str']
+        contents = handler.read()
+        self.assertEqual(contents['ordering'], ['str'], 'wrong ordering of variables read')
+        self.assertEqual(list(contents['data'].keys()), ['str'], 'wrong variables read')
+        handler.variables = ['aux', 'str']
+        contents = handler.read()
+        self.assertEqual(contents['ordering'], ['str', 'aux'], 'wrong ordering of variables read')
+        self.assertEqual(contents['data']['aux'].shape, (10, 10), 'variable not in ordering not read')
+
+    def test_matlab73(self):
+        fname = self.result['generic'] + 'mat'
+        data = {
+            'name': 'matlab',
+            'comment': '',
+            'names': [],
+            'ordering': ['double', 'int', 'sparse', 'str', 'class'],
+            'data': {
+                'double': numpy.array([[0.1, numpy.nan, 3.0], [-numpy.inf, 3.0, 4.0]]),
+                'int': numpy.array([1, 2, 3], dtype=numpy.int32),
+                'sparse': csc_matrix(numpy.array([[0., 1.5, 0.], [2., 0., 0.]])),
+                'str': ['a', '', '\xe4 b'],
+                'class': H5_ARFF(self.fixtures['arff']).read()['data']['class'],
+            },
+        }
+        handler = H5_MAT(fname)
+        handler.version = '7.3'
+        handler.write(data)
+        self.assertEqual(fileformat.get(fname, skip_suffix=True), 'matlab',
+                         'MATLAB 7.3 file not detected')
+        contents = H5_MAT(fname).read()
+        self.assertEqual(contents['ordering'], data['ordering'], 'wrong ordering')
+        self.assertTrue(numpy.array_equal(contents['data']['double'][1], data['data']['double'][1]),
+                        'wrong matrix')
+        self.assertEqual(contents['data']['int'].dtype, numpy.int32, 'wrong integer type')
+        self.assertEqual(contents['data']['int'].tolist(), [1, 2, 3], 'wrong row vector')
+        self.assertEqual((contents['data']['sparse'] != data['data']['sparse']).nnz, 0,
+                         'wrong sparse matrix')
+        self.assertEqual(contents['data']['str'], data['data']['str'], 'wrong cell array')
+        self.assertEqual(contents['data']['class'][:3], ['Iris-setosa'] * 3, 'wrong nominal values')
+        self.assertEqual(len(contents['data']['class']), 150, 'wrong number of nominal values')
+
     def test_read_rdata(self):
-        pass
-        # Rdata read not supported yet
+        conv = H5_RData(self.fixtures['R'])
+        data = conv.read()
+        self.assertEqual(data['name'], 'iris', 'wrong data set name')
+        self.assertEqual(data['data']['Sepal.Length'][2], 4.7,
+                         'wrong third value')
+        self.assertEqual(data['types'][-1], 'nominal:setosa,versicolor,virginica',
+                         'wrong factor levels')
+        self.assertEqual(data['data']['Species'].dset[[0, 50, 100]].tolist(), [0, 1, 2],
+                         'wrong factor codes')
+
+    def test_write_rdata(self):
+        fname = self.result['generic'] + 'RData'
+        data = {
+            'name': 'rdata',
+            'comment': '',
+            'names': ['double', 'int', 'str', 'class'],
+            'types': ['numeric', 'numeric', 'string', 'nominal:a,b'],
+            'ordering': ['double', 'int', 'str', 'class'],
+            'data': {
+                'double': numpy.array([0.5, numpy.nan, -numpy.inf]),
+                'int': numpy.array([1, 2, 3], dtype=numpy.int32),
+                'str': numpy.array(['a', '', '\xe4 b'], dtype=object),
+                'class': numpy.array(['b', 'a', 'b']),
+            },
+        }
+        H5_RData(fname).write(data)
+        self.assertEqual(fileformat.get(fname, skip_suffix=True), 'rdata',
+                         'RData file not detected')
+        contents = H5_RData(fname).read()
+        self.assertEqual(contents['ordering'], data['ordering'], 'wrong ordering')
+        self.assertEqual(contents['types'], data['types'], 'wrong types')
+        self.assertTrue(numpy.array_equal(contents['data']['double'][[0, 2]], [0.5, -numpy.inf]),
+                        'wrong doubles')
+        self.assertTrue(numpy.isnan(contents['data']['double'][1]), 'wrong NA')
+        self.assertEqual(contents['data']['int'].dtype, numpy.int32, 'wrong integer type')
+        self.assertEqual(contents['data']['str'].tolist(), ['a', '', '\xe4 b'], 'wrong strings')
+        self.assertEqual(contents['data']['class'][:].tolist(), ['b', 'a', 'b'], 'wrong factor')
 
     def test_read_octave(self):
         conv = H5_OCTAVE(self.fixtures['octave'])
@@ -91,6 +218,67 @@ class TestConversion(unittest.TestCase):
         self.assertEqual(data['data']['int2'][0,0], 172076,
                          'wrong first integer')
 
+    def test_read_octave_sparse(self):
+        fname = self.result['generic'] + 'octave'
+        f = open(fname, 'w')
+        f.write('# Created by Octave 3.0.1\n'
+                '# name: A\n# type: matrix\n# rows: 2\n# columns: 3\n'
+                ' 1 2.5 -Inf\n 4 NaN 6\n\n\n'
+                '# name: S\n# type: sparse matrix\n# nnz: 2\n# rows: 3\n# columns: 2\n'
+                '3 1 1.5\n1 2 2\n\n\n')
+        f.close()
+        data = H5_OCTAVE(fname).read()
+        self.assertEqual(data['data']['A'].shape, (2, 3), 'wrong matrix shape')
+        self.assertEqual(data['data']['A'][1, 2], 6, 'wrong matrix element')
+        self.assertEqual(data['data']['S'].toarray().tolist(), [[0, 2], [0, 0], [1.5, 0]],
+                         'wrong sparse matrix')
+
+        f = open(fname, 'w')
+        f.write('# Created by Octave 3.0.1\n'
+                '# name: S\n# type: sparse matrix\n# rows: 3\n# columns: 2\n'
+                '3 1 1.5\n1 2 2\n\n\n'
+                '# name: T\n# type: sparse matrix\n# rows: 3\n# columns: 2\n'
+                '3 1 1.5\n1 2\n\n\n')
+        f.close()
+        self.assertRaises(ml2h5.converter.ConversionError, H5_OCTAVE(fname).read)
+        f = open(fname, 'w')
+        f.write('# Created by Octave 3.0.1\n'
+                '# name: S\n# type: sparse matrix\n# rows: 3\n# columns: 2\n'
+                '3 1 1.5\n1 2 2\n\n\n')
+        f.close()
+        data = H5_OCTAVE(fname).read()
+        self.assertEqual(data['data']['S'].toarray().tolist(), [[0, 2], [0, 0], [1.5, 0]],
+                         'wrong sparse matrix without nnz')
+
+    def test_write_octave(self):
+        fname = self.result['generic'] + 'octave'
+        data = {
+            'name': 'octave',
+            'comment': '',
+            'names': [],
+            'ordering': ['double', 'int', 'sparse', 'str'],
+            'data': {
+                'double': numpy.array([[0.1, numpy.nan, -0.0], [-numpy.inf, 3.0, 0.0]]),
+                'int': numpy.array([[1, 2, 3], [4, 5, 6]], dtype=numpy.int32),
+                'sparse': csc_matrix(numpy.array([[0., 1.5], [2., 0.], [0., 1e-20]])),
+                'str': ['a', 'b c'],
+            },
+        }
+        H5_OCTAVE(fname).write(data)
+        self.assertTrue(' 2 3\n 1\n 4\n 2\n 5\n 3\n 6\n' in open(fname).read(),
+                        'int32 matrix not written column-major')
+        contents = H5_OCTAVE(fname).read()
+        self.assertTrue(numpy.array_equal(contents['data']['double'][1], data['data']['double'][1]),
+                        'wrong matrix')
+        self.assertTrue(numpy.isnan(contents['data']['double'][0, 1]), 'NaN not written')
+        self.assertEqual(numpy.signbit(contents['data']['double'][:, 2]).tolist(), [True, False],
+                         'sign of zero not written')
+        self.assertEqual(contents['data']['int'].tolist(), data['data']['int'].tolist(),
+                         'wrong int32 matrix')
+        self.assertEqual((contents['data']['sparse'] != data['data']['sparse']).nnz, 0,
+                         'wrong sparse matrix')
+        self.assertEqual(contents['data']['str'], data['data']['str'], 'wrong cell array')
+
     def test_read_matlab(self):
         conv = H5_MAT(self.fixtures['mat'])
         data = conv.read()
@@ -103,6 +291,200 @@ class TestConversion(unittest.TestCase):
         self.assertEqual(data['data']['data'][3][2], 1,
                          'wrong first integer')
         
+    def test_read_lazy(self):
+        conv = H5_LibSVM(self.fixtures['libsvm'])
+        conv.stream_to_h5(self.result['h5'])
+        data = BaseHandler(self.result['h5']).read(lazy=True)
+        expected = BaseHandler(self.result['h5']).read()
+        A = data['data']['data']
+        self.assertEqual(A.shape, expected['data']['data'].shape,
+                         'wrong shape of lazy sparse data')
+        self.assertEqual((A[:, 5:9] != expected['data']['data'][:, 5:9]).nnz, 0,
+                         'wrong lazy sparse slice')
+        self.assertTrue((data['data']['label'][5:9] == expected['data']['label'][5:9]).all(),
+                        'wrong lazy dense slice')
+
+    def test_close_lazy(self):
+        conv = converter.Converter(self.fixtures['csv'], self.result['h5'])
+        conv.run()
+        handler = BaseHandler(self.result['h5'])
+        dset = handler.read(lazy=True)['data']['int0'].dset
+        self.assertTrue(dset.id.valid, 'file of lazy data not open')
+        handler.close()
+        self.assertFalse(dset.id.valid, 'file of lazy data not closed')
+        handler.read_subset([0], [1])
+        self.assertEqual(handler.h5, None, 'file left open by read_subset')
+        conv = converter.Converter(self.result['h5'], self.result['generic'] + 'mat')
+        conv.run()
+        conv.verify()
+        self.assertEqual(conv.handler_in.h5, None, 'file left open by conversion')
+
+    def test_read_subset(self):
+        conv = converter.Converter(self.fixtures['csv'], self.result['h5'], merge=True)
+        conv.run()
+        handler = BaseHandler(self.result['h5'])
+        expected = handler.read_data_as_array()
+        attributes = [2, 0, 0]
+        examples = [3, 1, 3]
+        data = handler.read_subset(attributes, examples)
+        self.assertTrue((data == expected[examples][:, attributes]).all(),
+                        'wrong subset read')
+
+    def test_read_subset_sparse(self):
+        conv = H5_LibSVM(self.fixtures['libsvm'])
+        conv.stream_to_h5(self.result['h5'])
+        handler = BaseHandler(self.result['h5'])
+        expected = handler.read_data_as_array()
+        A = handler.read(lazy=True)['data']['data']
+        block = A.get_columns(5, 9, 3)
+        self.assertEqual(A._shape, None, 'indices scanned for shape')
+        self.assertTrue((block[:3].toarray() == A.load()[:3, 5:9].toarray()).all(),
+                        'wrong columns read')
+        handler.close()
+        attributes = [2, 0]
+        examples = [3, 1, 3]
+        data = handler.read_subset(attributes, examples)
+        self.assertTrue((data == expected[examples][:, attributes]).all(),
+                        'wrong sparse subset read')
+
+    def test_read_data_as_array(self):
+        conv = H5_LibSVM(self.fixtures['libsvm'])
+        conv.stream_to_h5(self.result['h5'])
+        handler = BaseHandler(self.result['h5'])
+        contents = handler.read()
+        expected = numpy.vstack([contents['data']['label'],
+                                 contents['data']['data'].toarray()]).T
+        self.assertTrue((handler.read_data_as_array() == expected).all(),
+                        'wrong dense array')
+        self.assertTrue((handler.read_data_as_array(sparse=True).toarray() == expected).all(),
+                        'wrong sparse array')
+        self.assertTrue((handler.read_data_as_array(memmap=self.result['generic'] + 'npy') == expected).all(),
+                        'wrong memory-mapped array')
+
+    def test_iter_data_rows(self):
+        conv = H5_CSV(self.fixtures['csv'], merge=True)
+        data = conv.read()
+        rows = []
+        for block in conv.iter_data_rows(data, block_size=2):
+            self.assertTrue(len(block) <= 2, 'block too large')
+            rows.extend(list(row) for row in block)
+        self.assertEqual(rows, conv.get_data_as_list(data),
+                         'wrong rows from blocks')
+        self.assertEqual(rows[3], [2, 1, 4, 4], 'wrong row')
+
+    def test_h5_compression(self):
+        conv = converter.Converter(self.fixtures['libsvm'], self.result['h5'],
+                                   compression='lzf')
+        conv.run(verify=True)
+        h5 = h5py.File(self.result['h5'], 'r')
+        self.assertEqual(h5['data/data'].compression, 'lzf', 'not compressed')
+        self.assertTrue(h5['data/data'].shuffle, 'not shuffled')
+        h5.close()
+        raw, stored = BaseHandler(self.result['h5']).get_storage_size()
+        self.assertTrue(stored < raw, 'compression did not reduce size')
+
+    def test_h5_strings(self):
+        handler = BaseHandler(self.result['h5'])
+        data = {
+            'name': 'strings',
+            'comment': '',
+            'names': ['nominal', 'short', 'long'],
+            'ordering': ['nominal', 'short', 'long'],
+            'data': {
+                'nominal': ['b', 'a', '\xe4', 'a', 'b', 'a'],
+                'short': ['a', 'b', 'c', 'd', 'e', '\xe4'],
+                'long': ['%d' % i * 100 for i in range(6)],
+            },
+        }
+        handler.write(data)
+        h5 = h5py.File(self.result['h5'], 'r')
+        self.assertEqual(h5['data/nominal'].dtype, numpy.uint8, 'nominal not stored as codes')
+        self.assertEqual(len(h5['data/nominal_categories']), 3, 'wrong number of categories')
+        self.assertEqual(h5['data/short'].dtype.kind, 'S', 'short strings not fixed width')
+        h5.close()
+        contents = handler.read()
+        for name in data['ordering']:
+            self.assertEqual(contents['data'][name].tolist(), data['data'][name],
+                             'wrong strings in %s' % name)
+
+    def test_arff_nominal_codes(self):
+        handler = H5_ARFF(self.fixtures['arff'])
+        data = handler.read()
+        self.assertEqual(data['data']['class'].dtype.kind, 'O', 'nominal attribute not a proxy')
+        self.assertEqual(len(data['data']['class'].categories), 3, 'wrong number of categories')
+        handler = BaseHandler(self.result['h5'])
+        handler.write(data)
+        h5 = h5py.File(self.result['h5'], 'r')
+        self.assertEqual(h5['data/class'].dtype, numpy.uint8, 'nominal not stored as codes')
+        h5.close()
+        contents = handler.read()
+        self.assertEqual(contents['data']['class'][:3].tolist(), ['Iris-setosa'] * 3,
+                         'wrong nominal values')
+
+    def test_arff_iter_data(self):
+        fp = open(self.fixtures['arff'])
+        af = arff.ArffFile.load_header(fp)
+        self.assertEqual(len(af.attributes), 5, 'wrong number of attributes')
+        rows = list(af.iter_data(fp))
+        fp.close()
+        self.assertEqual(len(rows), 150, 'wrong number of data points')
+        self.assertEqual(rows[0], ['5.1', '3.5', '1.4', '0.2', 'Iris-setosa'],
+                         'wrong data point')
+
+    def test_arff_write_columns(self):
+        af = arff.ArffFile()
+        af.define_attribute('int', 'numeric')
+        af.define_attribute('double', 'numeric')
+        af.define_attribute('str', 'string')
+        af.define_attribute('label', 'nominal', ['x', 'y'])
+        columns = [
+            numpy.array([1, -2, 3]),
+            numpy.array([0.1, numpy.nan, 1e20]),
+            numpy.array(['a', ' b', 'c d'], dtype=object),
+            numpy.array(['y', 'x', 'y']),
+        ]
+        self.assertEqual(af.write_columns(columns), af.write_data(zip(*columns)),
+                         'columns formatted differently from data points')
+
+    def test_arff_sparse(self):
+        A = csc_matrix(numpy.array([[0., 1.5, 0.], [2., 0., 0.], [0., 0., 3.]]))
+        data = {
+            'name': 'sparse',
+            'comment': '',
+            'names': ['a', 'b', 'c', 'label'],
+            'ordering': ['data', 'label'],
+            'types': ['numeric', 'numeric', 'numeric', 'nominal:x,y'],
+            'data': {'data': A, 'label': numpy.array(['y', 'x', 'y'])},
+        }
+        fname = self.result['generic'] + 'arff'
+        H5_ARFF(fname).write(data)
+        self.assertTrue('{1 2.0,3 y}' in open(fname).read(), 'not written sparse')
+        contents = H5_ARFF(fname).read()
+        self.assertEqual(contents['ordering'], ['double0', 'label'], 'wrong ordering')
+        self.assertEqual((contents['data']['double0'] != A).nnz, 0, 'wrong sparse data')
+        self.assertEqual(contents['data']['label'][:].tolist(), ['y', 'x', 'y'], 'wrong labels')
+
+    def test_arff_sparse_strings(self):
+        A = csc_matrix(numpy.array([[0., 1.5, 0.], [2., 0., 0.]]))
+        data = {
+            'name': 'sparse',
+            'comment': '',
+            'names': ['a', 'b', 'text'],
+            'ordering': ['data', 'text'],
+            'types': ['numeric', 'numeric', 'string'],
+            'data': {'data': A, 'text': numpy.array(['x', '', ' y'], dtype=object)},
+        }
+        fname = self.result['generic'] + 'arff'
+        H5_ARFF(fname).write(data)
+        contents = H5_ARFF(fname).read()
+        self.assertEqual((contents['data']['double0'] != A).nnz, 0, 'wrong sparse data')
+        self.assertEqual(list(contents['data']['text'][:]), ['x', '', ' y'], 'wrong strings')
+
+        f = open(fname, 'a')
+        f.write('{1}\n')
+        f.close()
+        self.assertRaises(ml2h5.converter.ConversionError, H5_ARFF(fname).read)
+
     # CONVERSIONS IN
     def conversion_in(self, file_in, file_out):
         conv = converter.Converter(file_in, file_out)
@@ -112,6 +494,85 @@ class TestConversion(unittest.TestCase):
     def test_h5in(self):
         self.conversion_in(self.fixtures['csv'],self.result['h5'])
         
+    def test_data_strings(self):
+        fname = self.result['generic'] + 'csv'
+        f = open(fname, 'w')
+        f.write('1,a\n2,bb\n3,a\n4,c\n')
+        f.close()
+        converter.Converter(fname, self.result['h5']).run()
+        self.assertEqual(ml2h5.data.get_correct(self.result['h5'], [0, 1, 3], 1),
+                         ['a', 'bb', 'c'], 'string values not decoded')
+        self.assertEqual(sorted(ml2h5.data.get_attribute_types(self.result['h5']).split(',')),
+                         ['Integer', 'String'], 'wrong attribute types')
+
+    def test_arff_nominal_correct(self):
+        converter.Converter(self.fixtures['arff'], self.result['h5']).run()
+        self.assertEqual(BaseHandler(self.result['h5']).read()['mldata'], ml2h5.VERSION_MLDATA,
+                         'wrong layout version')
+        self.assertEqual(ml2h5.data.get_correct(self.result['h5'], [0, 60, 120], 4),
+                         ['Iris-setosa', 'Iris-versicolor', 'Iris-virginica'],
+                         'nominal class not decoded')
+        self.assertTrue('String' in ml2h5.data.get_attribute_types(self.result['h5']).split(','),
+                        'nominal class not reported as string')
+
+    def test_csv2h5_stream(self):
+        conv = H5_CSV(self.fixtures['csv'], merge=True)
+        conv.block_size = 2
+        conv.stream_to_h5(self.result['h5'])
+        data = BaseHandler(self.result['h5']).read()
+        expected = H5_CSV(self.fixtures['csv'], merge=True).read()
+        self.assertEqual(data['ordering'], expected['ordering'],
+                         'streamed ordering differs')
+        for name in expected['ordering']:
+            self.assertTrue((data['data'][name] == expected['data'][name]).all(),
+                            'streamed data differs')
+
+    def test_csv2h5_stream_missing(self):
+        fname = self.result['generic'] + 'csv'
+        f = open(fname, 'w')
+        f.write('1,2\n3,4\n?,5\n?,6\n7,8\n')
+        f.close()
+        conv = H5_CSV(fname, merge=False)
+        conv.block_size = 2
+        conv.stream_to_h5(self.result['h5'])
+        data = BaseHandler(self.result['h5']).read()
+        self.assertEqual(data['ordering'], ['double0', 'int1'],
+                         'column with missing values not promoted')
+        self.assertTrue(numpy.isnan(data['data']['double0'][2:4]).all(),
+                        'missing values not NaN')
+        self.assertEqual(data['data']['double0'][4], 7, 'wrong value after missing values')
+
+    def test_csv2h5_stream_promote(self):
+        fname = self.result['generic'] + 'csv'
+        f = open(fname, 'w')
+        f.write('1,2,3\n4,5,6\n7,x,y\n8,9,10\n')
+        f.close()
+        conv = H5_CSV(fname, merge=False)
+        conv.block_size = 2
+        scans = []
+        iter_blocks = conv._iter_blocks
+        def _iter_blocks():
+            scans.append(1)
+            return iter_blocks()
+        conv._iter_blocks = _iter_blocks
+        conv.stream_to_h5(self.result['h5'])
+        self.assertEqual(len(scans), 2, 'file not rescanned once for all promoted columns')
+        data = BaseHandler(self.result['h5']).read()
+        self.assertEqual(data['ordering'], ['int0', 'str1', 'str2'], 'columns not promoted')
+        self.assertEqual(list(data['data']['str1'][:]), ['2', '5', 'x', '9'], 'wrong strings')
+        self.assertEqual(list(data['data']['str2'][:]), ['3', '6', 'y', '10'], 'wrong strings')
+
+    def test_csv_processes(self):
+        conv = H5_CSV(self.fixtures['csv'])
+        conv.processes = 2
+        data = conv.read()
+        expected = H5_CSV(self.fixtures['csv']).read()
+        self.assertEqual(data['ordering'], expected['ordering'],
+                         'parallel ordering differs')
+        for name in expected['ordering']:
+            self.assertTrue((data['data'][name] == expected['data'][name]).all(),
+                            'parallel data differs')
+
     def test_arff2h5(self):
         self.conversion_in(self.fixtures['arff'],self.result['h5'])
         
@@ -123,6 +584,82 @@ class TestConversion(unittest.TestCase):
     def test_libsvm2h5(self):
         self.conversion_in(self.fixtures['libsvm'],self.result['h5'])
         
+    def test_libsvm2h5_stream(self):
+        conv = H5_LibSVM(self.fixtures['libsvm'])
+        conv.block_size = 100
+        conv.stream_to_h5(self.result['h5'])
+        data = BaseHandler(self.result['h5']).read()
+        expected = H5_LibSVM(self.fixtures['libsvm']).read()
+        self.assertTrue((data['data']['data'].toarray() == expected['data']['data']).all(),
+                        'streamed data differs')
+        self.assertTrue((data['data']['label'] == expected['data']['label']).all(),
+                        'streamed labels differ')
+
+    def test_libsvm_parsers(self):
+        conv = H5_LibSVM(self.fixtures['libsvm'])
+        conv.parser = 'python'
+        expected = conv.read()
+        data = H5_LibSVM(self.fixtures['libsvm']).read()
+        self.assertTrue((data['data']['data'] == expected['data']['data']).all(),
+                        'numpy parser data differs')
+        self.assertTrue((data['data']['label'] == expected['data']['label']).all(),
+                        'numpy parser labels differ')
+        # extra token in one line, missing label in the next
+        self.assertRaises((IndexError, ValueError), conv._parse_lines_numpy,
+                          ['1 5 3:4\n', '3:4\n'])
+
+    def test_libsvm_processes(self):
+        conv = H5_LibSVM(self.fixtures['libsvm'])
+        conv.processes = 3
+        data = conv.read()
+        expected = H5_LibSVM(self.fixtures['libsvm']).read()
+        self.assertTrue((data['data']['data'] == expected['data']['data']).all(),
+                        'sharded data differs')
+        self.assertTrue((data['data']['label'] == expected['data']['label']).all(),
+                        'sharded labels differ')
+
+    def test_libsvm_write(self):
+        expected = H5_LibSVM(self.fixtures['libsvm']).read()
+        H5_LibSVM(self.result['generic'] + 'libsvm').write(expected)
+        data = H5_LibSVM(self.result['generic'] + 'libsvm').read()
+        self.assertTrue((data['data']['data'] == expected['data']['data']).all(),
+                        'written data differs')
+
+    def _format_libsvm_baseline(self, label, d):
+        """Format examples one by one as the original LibSVM writer did."""
+        lines = []
+        for i in range(d.shape[1]):
+            if type(label) == csc_matrix:
+                out = [','.join([str(j) for j in
+                                 label.indices[label.indptr[i]:label.indptr[i+1]]])]
+            else:
+                out = [str(label[i])]
+            if type(d) == csc_matrix:
+                for j in range(d.indptr[i], d.indptr[i+1]):
+                    out.append('%d:%.15g' % (d.indices[j]+1, d.data[j]))
+            else:
+                for j in range(len(d)):
+                    out.append(str(j+1) + ':' + str(d[j,i]))
+            lines.append(' '.join(out) + '\n')
+        return ''.join(lines)
+
+    def test_libsvm_write_format(self):
+        fname = self.result['generic'] + 'libsvm'
+        dense = numpy.array([[0.5, 1.0, -2.0], [1e-20, 0.0, 1.0/3]])
+        sparse = csc_matrix(numpy.array([[0., 1.5, 0.], [2., 0., 1e20], [0., 0., -1.0/3]]))
+        multilabel = csc_matrix(numpy.array([[1., 0., 1.], [0., 0., 1.], [1., 1., 0.]]))
+        labels = numpy.array([1, -1, 1])
+        for label, d in ((labels, dense), (labels, sparse), (multilabel, sparse)):
+            data = {
+                'name': 'libsvm',
+                'comment': '',
+                'ordering': ['label', 'data'],
+                'data': {'label': label, 'data': d},
+            }
+            H5_LibSVM(fname).write(data)
+            self.assertEqual(open(fname).read(), self._format_libsvm_baseline(label, d),
+                             'output differs from original writer')
+
     def test_octave2h5(self):
         self.conversion_in(self.fixtures['octave'],self.result['h5'])
 
@@ -130,8 +667,7 @@ class TestConversion(unittest.TestCase):
         self.conversion_in(self.fixtures['mat'],self.result['h5'])
         
     def test_rdata2h5(self):
-        # Rdata reading not supported
-        pass
+        self.conversion_in(self.fixtures['R'],self.result['h5'])
 
     #def test_uci2h5(self):
     #    self.conversion_in(self.fixtures['uci'],self.result['h5'])
@@ -147,7 +683,7 @@ class TestConversion(unittest.TestCase):
         self.conversion_out("csv",H5_CSV)
         self.conversion_out("arff",H5_ARFF)
         #self.conversion_out("libsvm",H5_LibSVM)
-        #self.conversion_out("Rdata",H5_RData)
+        self.conversion_out("RData",H5_RData)
         #self.conversion_out("data",H5_UCI)
         self.conversion_out("octave",H5_OCTAVE)
         self.conversion_out("mat",H5_MAT)
@@ -180,11 +716,34 @@ class PerformanceTests:
             f.write("\n")
         f.close()
         
+    def generate_libsvm(self, fname, attributes=1000, instances=100000, nnz=30):
+        """Generates the test libsvm file of given size
+
+        @param fname: filename of new file
+        @type fname: string
+        @param attributes: num of attributes
+        @type attributes: integer
+        @param instances: num of instances
+        @type instances: integer
+        @param nnz: num of non-zero attributes per instance
+        @type nnz: integer
+        """
+        f = open(fname, 'w')
+        for j in range(0,instances):
+            idx = sorted(random.sample(range(1, attributes+1), nnz))
+            f.write("%d" % random.choice((-1, 1)))
+            for i in idx:
+                f.write(" %d:%f" % (i, random.random()))
+            f.write("\n")
+        f.close()
+
     def setUp(self):
         """Set up the testing enviroment
         """
         if not os.path.exists(FIXTURES['big-arff']):
             self.generate_arff(FIXTURES['big-arff'])
+        if not os.path.exists(FIXTURES['big-libsvm']):
+            self.generate_libsvm(FIXTURES['big-libsvm'])
             
     def __init__(self):
         """Initialize by setting up the testing enviroment
@@ -229,12 +788,59 @@ class PerformanceTests:
 
         print(self.stop_test())
         
+    def test_libsvm_parsers(self):
+        """Measure time of reading libsvm with the python and numpy parser
+        """
+        for parser in ('python', 'numpy'):
+            print(self.start_test("LibSVM read - %s parser" % parser))
+
+            conv = H5_LibSVM(FIXTURES['big-libsvm'])
+            conv.parser = parser
+            conv.read()
+
+            print(self.stop_test())
+
+    def test_import_time(self, runs=5):
+        """Measure time of importing the converter in a fresh interpreter
+        """
+        print(self.start_test("Import ml2h5.converter - best of %d" % runs))
+
+        best = None
+        for i in range(runs):
+            start = datetime.datetime.now()
+            subprocess.check_call([sys.executable, '-c', 'import ml2h5.converter'])
+            delta = datetime.datetime.now() - start
+            if best is None or delta < best:
+                best = delta
+
+        print(best)
+
+    def test_get_datatype(self):
+        """Measure time of getting data types of int, double and string columns
+        """
+        handler = BaseHandler(RESULTS['h5'])
+        columns = {
+            'int': [str(i) for i in range(200000)],
+            'double': ['%f' % (i * 0.5) for i in range(200000)],
+            'str': [str(i) for i in range(200000)] + ['a'],
+        }
+        for name, values in columns.items():
+            for method in (handler._get_datatype_python, handler.get_datatype):
+                print(self.start_test("Get datatype - %s column, %s" % (name, method.__name__)))
+
+                method(values)
+
+                print(self.stop_test())
+
     def main(self):
         """Run tests
         TODO: Should be more generic similar to unittest module
         """
         self.test_many_attributes_conversion()
         self.test_many_attributes_types()
+        self.test_libsvm_parsers()
+        self.test_get_datatype()
+        self.test_import_time()
         
 __usage__ = """Usage:
   python tests.py             - runs correctness tests